@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'management.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -81,10 +82,67 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-        'TIMEOUT': 20, # Wait for up to 20 seconds
-    }
+        'OPTIONS': {
+            # Seconds a writer waits in SQLite's busy handler for the write lock.
+            # Beyond that management/writes.py retries the whole write with backoff.
+            'timeout': 5,
+            # Take the write lock at BEGIN, so two transactions that both read
+            # before writing queue up instead of failing with "database is locked".
+            'transaction_mode': 'IMMEDIATE',
+            # WAL lets readers carry on while a write is in progress.
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+        },
+    },
+    # Read-only snapshot of 'default' taken with SQLite's backup API
+    # (management/snapshots.py). Reporting views read from it through
+    # management.routers.AnalyticsRouter, so long reports never share a file
+    # with order entry. Refresh it with `manage.py refresh_snapshot`.
+    'analytics': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f"file:{BASE_DIR / 'analytics.sqlite3'}?mode=ro",
+        'OPTIONS': {'uri': True},
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['management.routers.AnalyticsRouter']
+# A snapshot older than this is refreshed in the background on the next
+# report; the stale one is served in the meantime.
+ANALYTICS_SNAPSHOT_MAX_AGE = 300
+
+# Write coordination (management/writes.py). Mutating API calls run in one
+# BEGIN IMMEDIATE transaction and are retried this many times while locked.
+SQLITE_WRITE_COORDINATION = True
+SQLITE_WRITE_RETRY_ATTEMPTS = 5
+SQLITE_WRITE_RETRY_BASE_DELAY = 0.05
+SQLITE_WRITE_RETRY_MAX_DELAY = 1.0
+# Hand writes to a single writer thread that commits whatever arrives within
+# SQLITE_GROUP_COMMIT_WINDOW seconds together. Helps multi-threaded servers.
+SQLITE_GROUP_COMMIT = False
+SQLITE_GROUP_COMMIT_MAX_BATCH = 32
+SQLITE_GROUP_COMMIT_WINDOW = 0.002
+
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# 'detail' holds the versioned customer/book/invoice detail payloads (management/cache.py).
+# LocMemCache evicts least-recently-used entries past MAX_ENTRIES; to share the
+# cache between worker processes use a file-based backend instead, e.g.
+#   'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#   'LOCATION': BASE_DIR / 'cache' / 'detail',
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'detail': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'detail-responses',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
 }
 
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -131,6 +189,8 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",  # The address of your Vue frontend
     "http://127.0.0.1:5173", # Also add the IP address version
 ]
+# Let the frontend read how old a report's data is (management/snapshots.py).
+CORS_EXPOSE_HEADERS = ['X-Report-Source', 'X-Snapshot-Age', 'X-Snapshot-Taken-At']
 
 
 
@@ -140,7 +200,31 @@ REST_FRAMEWORK = {
         # It is safe for a locally-hosted desktop application.
         'rest_framework.permissions.AllowAny',
     ],
+    # orjson-backed JSON (falls back to the stock encoder if orjson is missing),
+    # plus a compact columns/rows format via ?format=table.
+    'DEFAULT_RENDERER_CLASSES': [
+        'management.renderers.ORJSONRenderer',
+        'management.renderers.TabularJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
+# Responses at least this many bytes long are gzip/brotli compressed when the client accepts it.
+RESPONSE_COMPRESSION_MIN_SIZE = 1024
+RESPONSE_COMPRESSION_BROTLI_QUALITY = 5
+
+# Fully paid invoices older than this are moved to the archive tables by `manage.py archive_invoices`.
+INVOICE_ARCHIVE_AFTER_DAYS = 365
+INVOICE_ARCHIVE_CHUNK_SIZE = 500
+
+# Change feed (/api/changes/): deletions are remembered this long; clients
+# syncing from an older token get a full reset instead of a delta.
+SYNC_TOMBSTONE_RETENTION_DAYS = 90
+SYNC_OVERLAP_SECONDS = 5
+
+# Fan-out for /api/dashboard-events/. The in-process broker only reaches
+# streams served by the same ASGI worker.
+EVENT_BROKER = 'management.events.InProcessBroker'
+
 
 CSRF_COOKIE_HTTPONLY = False
\ No newline at end of file
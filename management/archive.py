@@ -0,0 +1,168 @@
+"""
+Hot/cold archival of settled invoices.
+
+Fully paid invoices older than INVOICE_ARCHIVE_AFTER_DAYS are moved, together
+with their items, payments and credit notes, into the Archived* tables. Each
+chunk runs in its own short transaction. Per-customer and per-book summary rows
+are topped up in the same transaction, so lifetime totals (see
+management/ledger.py) do not change when an invoice is archived.
+
+The live rows are removed with plain DELETEs rather than Model.delete(), so
+the per-row signal handlers never run. Their side effects are applied once
+per chunk instead: detail caches of the invoices, customers and books are
+bumped, the dashboard hears about the invoices, and each archived invoice
+gets a Tombstone so sync clients drop it from their copy of the (live-only)
+invoice feed. Items, payments and credit notes get no tombstones of their
+own, since the feed embeds them in the invoice.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import events
+from .cache import detail_cache
+from .models import (
+    ArchivedCreditNote, ArchivedCreditNoteItem, ArchivedInvoice, ArchivedInvoiceItem, ArchivedPayment,
+    BookArchiveSummary, CreditNote, CreditNoteItem, CustomerArchiveSummary, Invoice, InvoiceItem, Payment, Tombstone
+)
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 365
+DEFAULT_CHUNK_SIZE = 500
+
+
+def archivable_invoices(older_than_days=None):
+    if older_than_days is None:
+        older_than_days = getattr(settings, 'INVOICE_ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS)
+    cutoff = date.today() - timedelta(days=older_than_days)
+    return Invoice.objects.filter(status='PAID', invoice_date__lt=cutoff)
+
+
+def archive_settled_invoices(older_than_days=None, chunk_size=None, dry_run=False):
+    """Archive every settled invoice past the cut-off. Returns counts of rows moved."""
+    chunk_size = chunk_size or getattr(settings, 'INVOICE_ARCHIVE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    queryset = archivable_invoices(older_than_days).order_by('id')
+    totals = defaultdict(int)
+    if dry_run:
+        totals['invoices'] = queryset.count()
+        return dict(totals)
+
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        for key, value in archive_chunk(ids).items():
+            totals[key] += value
+    return dict(totals)
+
+
+@transaction.atomic
+def archive_chunk(invoice_ids):
+    # Re-check the status inside the transaction: a payment could have been
+    # reversed between picking the ids and getting here.
+    invoices = list(Invoice.objects.select_for_update().filter(id__in=invoice_ids, status='PAID'))
+    invoice_ids = [invoice.id for invoice in invoices]
+    items = list(InvoiceItem.objects.filter(invoice_id__in=invoice_ids))
+    payments = list(Payment.objects.filter(invoice_id__in=invoice_ids))
+    credit_notes = list(CreditNote.objects.filter(original_invoice_id__in=invoice_ids))
+    credit_items = list(CreditNoteItem.objects.filter(credit_note__original_invoice_id__in=invoice_ids).select_related('credit_note'))
+
+    ArchivedInvoice.objects.bulk_create([
+        ArchivedInvoice(id=i.id, customer_id=i.customer_id, invoice_date=i.invoice_date, due_date=i.due_date, status=i.status)
+        for i in invoices
+    ])
+    ArchivedInvoiceItem.objects.bulk_create([
+        ArchivedInvoiceItem(id=i.id, invoice_id=i.invoice_id, book_id=i.book_id, quantity=i.quantity, unit_price=i.unit_price)
+        for i in items
+    ])
+    ArchivedPayment.objects.bulk_create([
+        ArchivedPayment(id=p.id, invoice_id=p.invoice_id, payment_date=p.payment_date, amount=p.amount, notes=p.notes)
+        for p in payments
+    ])
+    ArchivedCreditNote.objects.bulk_create([
+        ArchivedCreditNote(id=c.id, customer_id=c.customer_id, original_invoice_id=c.original_invoice_id, date=c.date, reason=c.reason)
+        for c in credit_notes
+    ])
+    ArchivedCreditNoteItem.objects.bulk_create([
+        ArchivedCreditNoteItem(id=c.id, credit_note_id=c.credit_note_id, book_id=c.book_id, quantity=c.quantity, unit_price=c.unit_price)
+        for c in credit_items
+    ])
+
+    _add_to_summaries(invoices, items, payments, credit_items)
+    _delete_live_rows(invoices, items)
+    return {
+        'invoices': len(invoices), 'items': len(items), 'payments': len(payments),
+        'credit_notes': len(credit_notes), 'credit_note_items': len(credit_items),
+    }
+
+
+def _delete_live_rows(invoices, items):
+    invoice_ids = [invoice.id for invoice in invoices]
+    if not invoice_ids:
+        return
+    # Plain DELETEs on a cursor: QuerySet.delete() would send pre/post_delete
+    # for every row, because these models have receivers. Children first,
+    # since nothing cascades without the Collector.
+    placeholders = ', '.join(['%s'] * len(invoice_ids))
+    with connection.cursor() as cursor:
+        for sql in (
+            f'DELETE FROM {CreditNoteItem._meta.db_table} WHERE credit_note_id IN '
+            f'(SELECT id FROM {CreditNote._meta.db_table} WHERE original_invoice_id IN ({placeholders}))',
+            f'DELETE FROM {CreditNote._meta.db_table} WHERE original_invoice_id IN ({placeholders})',
+            f'DELETE FROM {InvoiceItem._meta.db_table} WHERE invoice_id IN ({placeholders})',
+            f'DELETE FROM {Payment._meta.db_table} WHERE invoice_id IN ({placeholders})',
+            f'DELETE FROM {Invoice._meta.db_table} WHERE id IN ({placeholders})',
+        ):
+            cursor.execute(sql, invoice_ids)
+
+    Tombstone.objects.bulk_create([Tombstone(model=Invoice._meta.model_name, object_id=pk) for pk in invoice_ids])
+    detail_cache.bump(
+        *[('invoice', pk) for pk in invoice_ids],
+        *[('customer', pk) for pk in {invoice.customer_id for invoice in invoices}],
+        *[('book', pk) for pk in {item.book_id for item in items}],
+    )
+    events.invoices_changed(invoice_ids)
+
+
+def _add_to_summaries(invoices, items, payments, credit_items):
+    customer_of = {invoice.id: invoice.customer_id for invoice in invoices}
+    customers = defaultdict(lambda: {'invoice_count': 0, 'total_invoiced': Decimal('0'), 'total_paid': Decimal('0'), 'total_credited': Decimal('0')})
+    books = defaultdict(lambda: {'invoice_count': 0, 'units_sold': 0, 'revenue': Decimal('0'), 'units_returned': 0, 'returns_value': Decimal('0')})
+
+    for invoice in invoices:
+        customers[invoice.customer_id]['invoice_count'] += 1
+    for book_id, _ in {(item.book_id, item.invoice_id) for item in items}:
+        books[book_id]['invoice_count'] += 1
+    for item in items:
+        customers[customer_of[item.invoice_id]]['total_invoiced'] += item.quantity * item.unit_price
+        books[item.book_id]['units_sold'] += item.quantity
+        books[item.book_id]['revenue'] += item.quantity * item.unit_price
+    for payment in payments:
+        customers[customer_of[payment.invoice_id]]['total_paid'] += payment.amount
+    for item in credit_items:
+        customers[customer_of[item.credit_note.original_invoice_id]]['total_credited'] += item.quantity * item.unit_price
+        books[item.book_id]['units_returned'] += item.quantity
+        books[item.book_id]['returns_value'] += item.quantity * item.unit_price
+
+    _upsert(CustomerArchiveSummary, 'customer_id', customers)
+    _upsert(BookArchiveSummary, 'book_id', books)
+
+
+def _upsert(model, key, deltas):
+    existing = model.objects.select_for_update().in_bulk(list(deltas))
+    created, updated = [], []
+    for pk, delta in deltas.items():
+        summary = existing.get(pk)
+        if summary is None:
+            created.append(model(**{key: pk}, **delta))
+            continue
+        for field, value in delta.items():
+            setattr(summary, field, getattr(summary, field) + value)
+        updated.append(summary)
+    model.objects.bulk_create(created)
+    if updated:
+        model.objects.bulk_update(updated, fields=list(next(iter(deltas.values()))))
@@ -0,0 +1,97 @@
+"""
+Versioned read-through cache for detail responses.
+
+Cached payloads are keyed by the object's current version token plus a global
+"reference" token, so nothing is ever invalidated in place: the save/delete
+hooks in management/signals.py just issue new tokens and stale entries age
+out through the cache backend's own eviction. Storage is whatever the
+`detail` alias in settings.CACHES points at (LocMemCache evicts LRU,
+FileBasedCache survives restarts and is shared between worker processes).
+"""
+import hashlib
+import threading
+import uuid
+
+from django.core.cache import caches
+from django.db import connection, transaction
+
+CACHE_ALIAS = 'detail'
+
+# Bumped whenever something whose *name* is embedded in other objects'
+# payloads changes (a school, author, publisher or route axis, a book title).
+REFERENCE = ('reference', 0)
+
+# Bumped by every invoice or credit-note line written; keys the sales forecast
+# (management/forecasting.py).
+SALES = ('sales', 0)
+
+
+def _new_token():
+    return uuid.uuid4().hex[:12]
+
+
+class DetailResponseCache:
+    def __init__(self, alias=CACHE_ALIAS):
+        self.alias = alias
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.stores = 0
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def versions(self, *objects):
+        keys = [f'version:{kind}:{pk}' for kind, pk in objects]
+        found = self.backend.get_many(keys)
+        missing = {key: _new_token() for key in keys if key not in found}
+        if missing:
+            self.backend.set_many(missing, timeout=None)
+            found.update(missing)
+        return [found[key] for key in keys]
+
+    def key(self, kind, pk, variant=''):
+        own, reference = self.versions((kind, pk), REFERENCE)
+        if variant:
+            variant = hashlib.md5(variant.encode()).hexdigest()[:16]
+        return f'response:{kind}:{pk}:{own}:{reference}:{variant}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, timeout=None)
+        with self._lock:
+            self.stores += 1
+
+    def bump(self, *objects):
+        """Give each (kind, pk) a fresh version, orphaning its cached payloads."""
+        objects = [(kind, pk) for kind, pk in objects if pk is not None]
+        if not objects:
+            return
+        self.backend.set_many({f'version:{kind}:{pk}': _new_token() for kind, pk in objects}, timeout=None)
+        # A reader inside the same window could cache pre-commit data under the
+        # new token, so bump once more after the transaction commits.
+        if connection.in_atomic_block:
+            transaction.on_commit(lambda: self.backend.set_many(
+                {f'version:{kind}:{pk}': _new_token() for kind, pk in objects}, timeout=None
+            ))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+detail_cache = DetailResponseCache()
@@ -0,0 +1,168 @@
+"""
+Set-based bulk catalogue operations: price lists, restocks and new titles.
+
+Each operation is one transaction of a few UPDATE / INSERT statements however
+many books it touches, and leaves a CatalogueAudit row describing what it did.
+update() and bulk_create() skip the model signals, so `updated_at`, the detail
+cache versions and the dashboard counters are handled here.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, PositiveIntegerField, Value, When
+from django.db.models.functions import Greatest, Round
+from django.utils import timezone
+
+from . import events
+from .cache import detail_cache
+from .models import Author, Book, CatalogueAudit, Publisher
+
+BATCH_SIZE = 500
+
+
+class CatalogueError(ValueError):
+    """A bulk operation that cannot be applied; the message is safe to show to the user."""
+
+
+def parse_decimal(raw, name):
+    try:
+        value = Decimal(str(raw))
+    except (InvalidOperation, ValueError, TypeError):
+        value = None
+    if value is None or not value.is_finite():
+        raise CatalogueError(f"'{name}' must be a number.")
+    return value
+
+
+def _id_list(raw, name):
+    if raw in (None, '', []):
+        return []
+    values = raw if isinstance(raw, (list, tuple)) else [raw]
+    try:
+        return sorted({int(value) for value in values})
+    except (TypeError, ValueError):
+        raise CatalogueError(f"'{name}' must be an id or a list of ids.")
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@transaction.atomic
+def reprice(percent=None, amount=None, publisher=None, author=None, book_ids=None, all_books=False, notes=''):
+    """
+    Change the price of every matching book by a percentage (10 = +10%) or by
+    an absolute amount, in one UPDATE. Prices are rounded to the kobo and
+    never go below zero. Without a publisher, author or book filter the whole
+    catalogue is repriced only when `all_books` is set.
+    """
+    if (percent is None) == (amount is None):
+        raise CatalogueError("Give exactly one of 'percent' or 'amount'.")
+    selection = {
+        'publisher': _id_list(publisher, 'publisher'),
+        'author': _id_list(author, 'author'),
+        'book_ids': _id_list(book_ids, 'book_ids'),
+    }
+    selection = {name: ids for name, ids in selection.items() if ids}
+    if not selection and not all_books:
+        raise CatalogueError("Filter by 'publisher', 'author' or 'book_ids', or pass 'all_books' to reprice the whole catalogue.")
+
+    money = DecimalField(max_digits=10, decimal_places=2)
+    if percent is not None:
+        percent = parse_decimal(percent, 'percent')
+        if percent <= Decimal('-100'):
+            raise CatalogueError("'percent' must be greater than -100.")
+        new_price = Round(F('price') * Value(1 + percent / 100, output_field=money), 2, output_field=money)
+    else:
+        amount = parse_decimal(amount, 'amount')
+        new_price = F('price') + Value(amount, output_field=money)
+
+    lookups = {'publisher': 'publisher_id__in', 'author': 'author_id__in', 'book_ids': 'pk__in'}
+    books = Book.objects.filter(**{lookups[name]: ids for name, ids in selection.items()})
+    before = dict(books.select_for_update().values_list('id', 'price'))
+    affected = books.update(
+        price=Greatest(new_price, Value(Decimal('0.00'), output_field=money), output_field=money),
+        updated_at=timezone.now(),
+    )
+    after = dict(books.values_list('id', 'price'))
+    detail_cache.bump(*(('book', pk) for pk in before))
+
+    return CatalogueAudit.objects.create(
+        operation='REPRICE',
+        parameters={
+            'percent': None if percent is None else str(percent),
+            'amount': None if amount is None else str(amount),
+            **selection,
+        },
+        affected=affected,
+        details={'prices': {pk: [str(before[pk]), str(after[pk])] for pk in sorted(before)}},
+        notes=notes,
+    )
+
+
+@transaction.atomic
+def restock(lines, notes=''):
+    """
+    Add stock to many books at once. `lines` is a list of
+    {'book_id': ..., 'quantity': ...}; repeated book ids are summed.
+    One CASE-based UPDATE per BATCH_SIZE books.
+    """
+    quantities = {}
+    for number, line in enumerate(lines or [], start=1):
+        try:
+            book_id, quantity = int(line['book_id']), int(line['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise CatalogueError(f"Line {number}: 'book_id' and 'quantity' must be whole numbers.")
+        if quantity <= 0:
+            raise CatalogueError(f"Line {number}: 'quantity' must be positive.")
+        quantities[book_id] = quantities.get(book_id, 0) + quantity
+    if not quantities:
+        raise CatalogueError('At least one restock line is required.')
+
+    found = set(Book.objects.select_for_update().filter(pk__in=quantities).values_list('id', flat=True))
+    missing = sorted(set(quantities) - found)
+    if missing:
+        raise CatalogueError(f"Unknown book id(s): {', '.join(map(str, missing))}.")
+
+    now = timezone.now()
+    affected = 0
+    for chunk in _chunks(sorted(quantities)):
+        added = Case(*(When(pk=pk, then=Value(quantities[pk])) for pk in chunk), output_field=PositiveIntegerField())
+        affected += Book.objects.filter(pk__in=chunk).update(quantity_in_stock=F('quantity_in_stock') + added, updated_at=now)
+    detail_cache.bump(*(('book', pk) for pk in quantities))
+
+    return CatalogueAudit.objects.create(
+        operation='RESTOCK',
+        parameters={'lines': len(lines)},
+        affected=affected,
+        details={'quantities': {pk: quantities[pk] for pk in sorted(quantities)}},
+        notes=notes,
+    )
+
+
+@transaction.atomic
+def create_books(rows, notes=''):
+    """
+    Insert many books in BATCH_SIZE INSERTs. `rows` are validated
+    BookWriteSerializer payloads; author and publisher ids are checked with
+    one query each instead of one lookup per book.
+    """
+    if not rows:
+        raise CatalogueError('At least one book is required.')
+    for model, field in ((Author, 'author_id'), (Publisher, 'publisher_id')):
+        wanted = {row[field] for row in rows}
+        missing = sorted(wanted - set(model.objects.filter(pk__in=wanted).values_list('id', flat=True)))
+        if missing:
+            raise CatalogueError(f"Unknown {model._meta.verbose_name} id(s): {', '.join(map(str, missing))}.")
+
+    books = Book.objects.bulk_create([Book(**row) for row in rows], batch_size=BATCH_SIZE)
+    events.counters_changed()
+
+    return CatalogueAudit.objects.create(
+        operation='CREATE',
+        parameters={'rows': len(rows)},
+        affected=len(books),
+        details={'book_ids': [book.pk for book in books]},
+        notes=notes,
+    )
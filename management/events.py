@@ -0,0 +1,185 @@
+"""
+Server-pushed dashboard updates.
+
+Invoice, payment and credit-note writes queue the touched invoice ids for the
+current transaction (see management/signals.py). On commit the ids are turned
+into one compact `ledger` event: the new balance and status of each invoice,
+the ids that no longer exist, and the dashboard counters. The event is
+encoded once and handed to every open /api/dashboard-events/ stream, so any
+number of dashboards cost one set of queries per write rather than a debtors
+query per tab. When nobody is subscribed nothing is computed at all.
+
+The broker is chosen by settings.EVENT_BROKER. The default InProcessBroker
+only reaches streams served by the same process; a deployment running several
+ASGI workers can point the setting at a broker with the same
+subscribe()/publish()/has_subscribers interface backed by Redis or Postgres
+LISTEN/NOTIFY.
+"""
+import asyncio
+import json
+import threading
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from .ledger import invoice_balance_annotations
+from .models import Book, CreditNote, Customer, Invoice
+
+DEFAULT_BROKER = 'management.events.InProcessBroker'
+OPEN_STATUSES = ('UNPAID', 'PARTIALLY_PAID')
+MONEY_FIELDS = ('total_amount', 'amount_paid', 'credit_applied', 'balance_due')
+CENT = Decimal('0.01')
+
+
+def encode_event(event, data):
+    """One Server-Sent Events frame."""
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":"))}\n\n'.encode()
+
+
+class Subscription:
+    """One open stream. Messages are delivered from any thread into the stream's event loop."""
+
+    def __init__(self, broker, max_pending):
+        self._broker = broker
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=max_pending)
+
+    def deliver(self, message):
+        try:
+            self._loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The stream's loop has gone away without closing us.
+            self.close()
+
+    def _put(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # A client this far behind is better off reloading than replaying.
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(encode_event('resync', {}))
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    def close(self):
+        self._broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    @property
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def subscribe(self):
+        subscription = Subscription(self, self.max_pending)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'EVENT_BROKER', DEFAULT_BROKER))()
+    return _broker
+
+
+def dashboard_counters():
+    return {
+        'customer_count': Customer.objects.count(),
+        'book_count': Book.objects.count(),
+        'debtors_count': Invoice.objects.filter(status__in=OPEN_STATUSES).count(),
+    }
+
+
+# --- Write-side collection ---
+
+_pending = threading.local()
+
+
+def _pending_sets():
+    if not hasattr(_pending, 'invoices'):
+        _pending.invoices, _pending.credit_notes, _pending.counters = set(), set(), False
+    return _pending
+
+
+def invoices_changed(invoice_ids=(), credit_note_ids=(), counters=False):
+    """
+    Note that these invoices (or the invoices these credit notes were raised
+    against) changed, and publish one event for everything noted once the
+    current transaction commits. Ids that are gone by then are reported as
+    removed.
+    """
+    if not get_broker().has_subscribers:
+        return
+    pending = _pending_sets()
+    pending.invoices.update(pk for pk in invoice_ids if pk is not None)
+    pending.credit_notes.update(pk for pk in credit_note_ids if pk is not None)
+    pending.counters = pending.counters or counters
+    # Every call registers a flush; only the first one after the commit finds
+    # anything to send. This keeps a rolled-back savepoint from swallowing it.
+    transaction.on_commit(_flush)
+
+
+def counters_changed():
+    invoices_changed(counters=True)
+
+
+def _flush():
+    pending = _pending_sets()
+    invoice_ids, credit_note_ids, counters = pending.invoices, pending.credit_notes, pending.counters
+    if not (invoice_ids or credit_note_ids or counters):
+        return
+    pending.invoices, pending.credit_notes, pending.counters = set(), set(), False
+    broker = get_broker()
+    if not broker.has_subscribers:
+        return
+
+    if credit_note_ids:
+        invoice_ids |= set(CreditNote.objects.filter(pk__in=credit_note_ids).values_list('original_invoice_id', flat=True))
+    invoices = []
+    if invoice_ids:
+        invoices = list(
+            Invoice.objects.filter(pk__in=invoice_ids).annotate(**invoice_balance_annotations())
+            .values('id', 'customer_id', 'due_date', 'status', *MONEY_FIELDS, customer_name=F('customer__school_name'))
+        )
+    today = date.today()
+    for row in invoices:
+        for field in MONEY_FIELDS:
+            row[field] = row[field].quantize(CENT, rounding=ROUND_HALF_UP)
+        row['days_overdue'] = (today - row['due_date']).days if row['due_date'] and row['due_date'] < today else 0
+    removed = sorted(invoice_ids - {row['id'] for row in invoices})
+
+    broker.publish(encode_event('ledger', {
+        'invoices': invoices,
+        'removed': removed,
+        'stats': dashboard_counters(),
+    }))
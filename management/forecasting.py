@@ -0,0 +1,303 @@
+"""
+Reorder forecasting for book stock.
+
+Net daily sales of every title (invoice items minus credit-note returns, live
+and archived) are loaded with one UNION query and scattered into a
+books x days NumPy matrix. Everything after that is array arithmetic over the
+whole catalogue at once:
+
+* seasonality: each title's sales rate in each school term relative to its
+  yearly rate, shrunk towards the catalogue-wide pattern for slow sellers;
+* velocity: recent sales with the current term's seasonality taken out,
+  blended with the long-run rate;
+* days of cover: stock divided into the day-by-day forecast for the year
+  ahead, using the seasonality of the term each future day falls in;
+* reorder quantity: forecast demand over the supplier lead time plus the
+  cover wanted after delivery, plus safety stock, minus stock on hand.
+
+The fitted model depends only on sales and the date, so it is cached under
+the `sales` version (see management/cache.py), which the InvoiceItem and
+CreditNoteItem signals bump. Stock levels are read fresh on every call.
+
+NumPy is an optional dependency (see requirements.txt). Without it
+reorder_suggestions() raises ForecastUnavailable, which the API reports as
+501 Not Implemented.
+"""
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Sum
+
+from .cache import SALES, detail_cache
+from .models import ArchivedCreditNoteItem, ArchivedInvoiceItem, Book, CreditNoteItem, InvoiceItem
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is an optional dependency
+    np = None
+
+DEFAULT_HISTORY_DAYS = 730
+DEFAULT_LEAD_TIME_DAYS = 14
+DEFAULT_COVER_DAYS = 30
+RECENT_DAYS = 28
+VOLATILITY_DAYS = 56
+LOOKAHEAD_DAYS = 365
+# How much recent (deseasonalised) sales count against the long-run rate.
+RECENT_WEIGHT = 0.6
+# A title needs about this many units sold before its own term pattern outweighs the catalogue's.
+SEASONALITY_PRIOR_UNITS = 50
+# Safety stock multiplier: about a 95% chance of not running out during the lead time.
+SERVICE_FACTOR = 1.65
+
+# Nigerian school calendar by month; anything not listed is holiday.
+DEFAULT_SCHOOL_TERMS = {
+    'first': (9, 10, 11, 12),
+    'second': (1, 2, 3, 4),
+    'third': (5, 6, 7),
+}
+HOLIDAY = 'holiday'
+
+
+class ForecastError(ValueError):
+    pass
+
+
+class ForecastUnavailable(ForecastError):
+    """This installation cannot forecast at all (numpy is missing); not the caller's fault."""
+
+
+def school_terms():
+    terms = getattr(settings, 'SCHOOL_TERMS', DEFAULT_SCHOOL_TERMS)
+    return [*terms, HOLIDAY], terms
+
+
+def _term_of_month():
+    """Array indexed by month (1-12) giving the term index; the last index is the holiday."""
+    names, terms = school_terms()
+    lookup = np.full(13, len(names) - 1, dtype=np.intp)
+    for index, months in enumerate(terms.values()):
+        lookup[list(months)] = index
+    return lookup
+
+
+def _day_terms(first_day, count):
+    days = np.datetime64(first_day, 'D') + np.arange(count)
+    months = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    return _term_of_month()[months]
+
+
+def daily_sales_query(start, end):
+    """One UNION ALL of (day, book_id, net units) over live and archived sales and returns."""
+    sold = {'units': Sum('quantity')}
+    returned = {'units': Sum(F('quantity') * -1)}
+    # Grouping by day first (and by an alias rather than the FK column, which
+    # Django would put first) lets SQLite scan the items table in storage
+    # order instead of through the book index.
+    parts = [
+        InvoiceItem.objects.filter(invoice__invoice_date__range=(start, end))
+        .annotate(day=F('invoice__invoice_date')).values('day', book_ref=F('book_id')).annotate(**sold),
+        ArchivedInvoiceItem.objects.filter(invoice__invoice_date__range=(start, end))
+        .annotate(day=F('invoice__invoice_date')).values('day', book_ref=F('book_id')).annotate(**sold),
+        CreditNoteItem.objects.filter(credit_note__date__range=(start, end))
+        .annotate(day=F('credit_note__date')).values('day', book_ref=F('book_id')).annotate(**returned),
+        ArchivedCreditNoteItem.objects.filter(credit_note__date__range=(start, end))
+        .annotate(day=F('credit_note__date')).values('day', book_ref=F('book_id')).annotate(**returned),
+    ]
+    return parts[0].union(*parts[1:], all=True)
+
+
+def sales_matrix(book_ids, start, days):
+    """Net units sold per book (rows, in `book_ids` order) per day from `start` (columns)."""
+    queryset = daily_sales_query(start, start + timedelta(days=days - 1))
+    # Run the compiled SQL on a plain cursor: the driver already returns dates,
+    # and skipping the ORM's per-row converters halves the load time.
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    matrix = np.zeros((len(book_ids), days))
+    if not rows:
+        return matrix
+    count = len(rows)
+    books = np.fromiter((row[1] for row in rows), dtype=np.int64, count=count)
+    offsets = np.fromiter((row[0].toordinal() for row in rows), dtype=np.intp, count=count) - start.toordinal()
+    units = np.fromiter((row[2] for row in rows), dtype=float, count=count)
+    positions = np.searchsorted(book_ids, books).clip(max=max(len(book_ids) - 1, 0))
+    known = book_ids[positions] == books if len(book_ids) else np.zeros(count, dtype=bool)
+    np.add.at(matrix, (positions[known], offsets[known]), units[known])
+    return matrix
+
+
+def fit(today, history_days=DEFAULT_HISTORY_DAYS):
+    """
+    Fit the per-title model on the `history_days` ending today. Returns
+    plain arrays (one row per book id) so it can be cached.
+    """
+    book_ids = np.fromiter(Book.objects.order_by('pk').values_list('pk', flat=True), dtype=np.int64)
+    start = today - timedelta(days=history_days - 1)
+    sales = sales_matrix(book_ids, start, history_days)
+    day_terms = _day_terms(start, history_days)
+    term_count = len(school_terms()[0])
+
+    # Seasonal index per book and term: term sales rate / overall sales rate.
+    term_days = np.bincount(day_terms, minlength=term_count)
+    term_units = sales @ np.eye(term_count)[day_terms]
+    total_units = sales.sum(axis=1)
+    overall_rate = total_units / history_days
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term_rate = term_units / np.maximum(term_days, 1)
+        own_index = np.where(overall_rate[:, None] > 0, term_rate / overall_rate[:, None], 1.0)
+        catalogue_rate = total_units.sum() / history_days
+        catalogue_index = term_units.sum(axis=0) / np.maximum(term_days, 1) / catalogue_rate if catalogue_rate > 0 else np.ones(term_count)
+    weight = np.clip(total_units, 0, None) / (np.clip(total_units, 0, None) + SEASONALITY_PRIOR_UNITS)
+    index = weight[:, None] * own_index + (1 - weight[:, None]) * catalogue_index
+    # A term with no days in the history tells us nothing: treat it as an average term.
+    index[:, term_days == 0] = 1.0
+    index = np.clip(index, 0, None)
+
+    # Base (deseasonalised) daily rate.
+    recent_units = sales[:, -RECENT_DAYS:].sum(axis=1)
+    recent_index = index[:, day_terms[-RECENT_DAYS:]].mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recent_base = np.where(recent_index > 0, recent_units / RECENT_DAYS / recent_index, 0.0)
+    base_rate = np.clip(RECENT_WEIGHT * recent_base + (1 - RECENT_WEIGHT) * overall_rate, 0, None)
+
+    return {
+        'book_ids': book_ids,
+        'base_rate': base_rate,
+        'index': index,
+        'sigma': sales[:, -VOLATILITY_DAYS:].std(axis=1),
+        'units_sold': total_units,
+        'recent_units': recent_units,
+        'history_start': start,
+    }
+
+
+def fitted_model(today, history_days=DEFAULT_HISTORY_DAYS):
+    """fit(), cached until the next sale or return (or the next day)."""
+    version, = detail_cache.versions(SALES)
+    key = f'forecast:{version}:{today.isoformat()}:{history_days}'
+    model = detail_cache.backend.get(key)
+    if model is None:
+        model = fit(today, history_days)
+        detail_cache.backend.set(key, model, timeout=24 * 60 * 60)
+    return model
+
+
+def _positive_int(value, name, maximum=LOOKAHEAD_DAYS):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ForecastError(f"'{name}' must be a whole number of days.")
+    if not 0 < value <= maximum:
+        raise ForecastError(f"'{name}' must be between 1 and {maximum}.")
+    return value
+
+
+def reorder_suggestions(lead_time_days=DEFAULT_LEAD_TIME_DAYS, cover_days=DEFAULT_COVER_DAYS, publisher=None,
+                        today=None, history_days=DEFAULT_HISTORY_DAYS):
+    """
+    Forecast every title and return reorder suggestions grouped by publisher,
+    most urgent (fewest days of cover) first.
+    """
+    if np is None:
+        raise ForecastUnavailable('Forecasting needs the numpy package (pip install numpy).')
+    lead_time_days = _positive_int(lead_time_days, 'lead_time_days')
+    cover_days = _positive_int(cover_days, 'cover_days')
+    today = today or date.today()
+    model = fitted_model(today, history_days)
+
+    books = Book.objects.order_by('pk').values_list(
+        'pk', 'title', 'price', 'quantity_in_stock',
+        'publisher_id', 'publisher__name', 'publisher__contact_person', 'publisher__phone_number',
+    )
+    if publisher:
+        if not str(publisher).isdigit():
+            raise ForecastError("'publisher' must be a publisher id.")
+        books = books.filter(publisher_id=publisher)
+    books = list(books)
+    if not books:
+        return _result(today, lead_time_days, cover_days, [], 0, 0)
+    ids, titles, prices, stock, publisher_ids, publisher_names, contacts, phones = zip(*books)
+    ids, stock = np.asarray(ids, dtype=np.int64), np.asarray(stock, dtype=float)
+
+    # Line the cached model up with the books read now (titles added since the fit have no sales).
+    positions = np.searchsorted(model['book_ids'], ids).clip(max=max(len(model['book_ids']) - 1, 0))
+    fitted = (model['book_ids'][positions] == ids) if len(model['book_ids']) else np.zeros(len(ids), dtype=bool)
+    base_rate = _align(model['base_rate'], positions, fitted, 0.0)
+    index = _align(model['index'], positions, fitted, 1.0)
+    sigma = _align(model['sigma'], positions, fitted, 0.0)
+    recent_units = _align(model['recent_units'], positions, fitted, 0.0)
+
+    # Day-by-day demand for the year ahead, every title at once.
+    horizon = max(LOOKAHEAD_DAYS, lead_time_days + cover_days)
+    future_terms = _day_terms(today, horizon)
+    demand = base_rate[:, None] * index[:, future_terms]
+    cumulative = demand.cumsum(axis=1)
+
+    runs_out = cumulative > stock[:, None]
+    days_of_cover = np.where(runs_out.any(axis=1), runs_out.argmax(axis=1), -1)
+    needed = cumulative[:, lead_time_days + cover_days - 1]
+    safety_stock = SERVICE_FACTOR * sigma * np.sqrt(lead_time_days)
+    suggested = np.ceil(np.clip(needed + safety_stock - stock, 0, None)).astype(np.int64)
+    velocity = demand[:, 0]
+    current_index = index[:, future_terms[0]]
+
+    groups = {}
+    for row in np.flatnonzero(suggested > 0):
+        group = groups.setdefault(publisher_ids[row], {
+            'publisher_id': publisher_ids[row],
+            'publisher': publisher_names[row],
+            'contact_person': contacts[row],
+            'phone_number': phones[row],
+            'books': [],
+            'total_units': 0,
+            'estimated_value': 0,
+        })
+        group['books'].append({
+            'id': int(ids[row]),
+            'title': titles[row],
+            'quantity_in_stock': int(stock[row]),
+            'daily_velocity': round(float(velocity[row]), 3),
+            'sold_last_28_days': int(recent_units[row]),
+            'seasonal_index': round(float(current_index[row]), 2),
+            'days_of_cover': int(days_of_cover[row]) if days_of_cover[row] >= 0 else None,
+            'forecast_demand': round(float(needed[row]), 1),
+            'safety_stock': int(np.ceil(safety_stock[row])),
+            'suggested_quantity': int(suggested[row]),
+        })
+        group['total_units'] += int(suggested[row])
+        group['estimated_value'] += prices[row] * int(suggested[row])
+
+    publishers = sorted(groups.values(), key=lambda group: min(_urgency(book) for book in group['books']))
+    for group in publishers:
+        group['books'].sort(key=_urgency)
+    return _result(today, lead_time_days, cover_days, publishers, len(ids), int(suggested.sum()))
+
+
+def _align(values, positions, fitted, default):
+    """Rows of a fitted array for the given books, `default` for books the model has not seen."""
+    if not fitted.any():
+        return np.full((len(fitted), *values.shape[1:]), default)
+    mask = fitted.reshape(-1, *[1] * (values.ndim - 1))
+    return np.where(mask, values[positions], default)
+
+
+def _urgency(book):
+    return (book['days_of_cover'] if book['days_of_cover'] is not None else LOOKAHEAD_DAYS, -book['suggested_quantity'])
+
+
+def _result(today, lead_time_days, cover_days, publishers, analysed, units):
+    names = school_terms()[0]
+    current = _day_terms(today, 1)[0] if np is not None else len(names) - 1
+    return {
+        'date': today,
+        'term': names[current],
+        'lead_time_days': lead_time_days,
+        'cover_days': cover_days,
+        'books_analysed': analysed,
+        'books_to_reorder': sum(len(group['books']) for group in publishers),
+        'units_to_reorder': units,
+        'publishers': publishers,
+    }
@@ -0,0 +1,330 @@
+"""
+Streaming CSV/XLSX import of books and customers.
+
+Rows are read one at a time and inserted in BATCH_SIZE bulk_create() calls,
+so memory stays flat however long the file is. Authors, publishers and route
+axes are matched by name (case-insensitively) against maps loaded with one
+query each; names not seen before are created in one INSERT per batch. Each
+row is validated against the model fields and a bad row is reported by its
+spreadsheet row number instead of failing the whole file.
+
+The whole import runs in one transaction. A dry run goes through every step
+and then rolls back, so it also reports constraint errors.
+"""
+import csv
+import io
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, When
+from django.utils import timezone
+
+from . import events
+from .models import Author, Book, Customer, Publisher, RouteAxis
+from .referrals import attach_customers, rebuild_closure
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 200
+
+
+class ImportFileError(ValueError):
+    """The file as a whole cannot be imported (unreadable, wrong columns, ...)."""
+
+
+class RowError(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+# --- Reading ---
+
+def _column_name(header):
+    return str(header or '').strip().lower().replace(' ', '_')
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def read_rows(fileobj, filename=''):
+    """Yield (row number, {column: value}) from a CSV or XLSX file, one row at a time."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        rows = _xlsx_rows(fileobj)
+    else:
+        rows = _csv_rows(fileobj)
+    header = [_column_name(name) for name in next(rows, [])]
+    if not any(header):
+        raise ImportFileError('The file is empty or has no header row.')
+    for number, values in enumerate(rows, start=2):
+        values = [_cell(value) for value in values]
+        if any(values):
+            yield number, dict(zip(header, values))
+
+
+def _csv_rows(fileobj):
+    text = fileobj if isinstance(fileobj, io.TextIOBase) else io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    try:
+        yield from csv.reader(text)
+    except (UnicodeDecodeError, csv.Error) as exc:
+        raise ImportFileError(f'Could not read the CSV file: {exc}')
+    finally:
+        # Leave the upload open: a write retried after a lock reads it again.
+        if text is not fileobj:
+            text.detach()
+
+
+def _xlsx_rows(fileobj):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFileError('Reading .xlsx files needs the openpyxl package; upload a CSV export instead.')
+    try:
+        workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    except Exception as exc:
+        raise ImportFileError(f'Could not read the workbook: {exc}')
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+# --- Reference resolution ---
+
+class NameMap:
+    """Case-insensitive name -> id for a lookup table with a unique `name`, loaded with one query."""
+
+    def __init__(self, model):
+        self.model = model
+        self.max_length = model._meta.get_field('name').max_length
+        self.ids = {}
+        for pk, name in model.objects.values_list('pk', 'name'):
+            self.ids.setdefault(name.casefold(), pk)
+        self.created = 0
+
+    def check(self, name):
+        if not name:
+            return 'This field cannot be blank.'
+        if len(name) > self.max_length:
+            return f'Ensure this value has at most {self.max_length} characters (it has {len(name)}).'
+        return None
+
+    def ensure(self, names):
+        """Create, in one INSERT, every name not already known."""
+        missing = {}
+        for name in names:
+            missing.setdefault(name.casefold(), name)
+        missing = {key: name for key, name in missing.items() if key not in self.ids}
+        if not missing:
+            return
+        for obj in self.model.objects.bulk_create([self.model(name=name) for name in missing.values()]):
+            self.ids[obj.name.casefold()] = obj.pk
+        self.created += len(missing)
+
+    def __getitem__(self, name):
+        return self.ids[name.casefold()]
+
+
+# --- Importers ---
+
+class SpreadsheetImport:
+    """
+    Base class: subclasses name their columns, turn a row into an unsaved
+    instance in build(), and fill in foreign keys in save_batch().
+    """
+    model = None
+    # column -> model field, validated with the field's own clean()
+    fields = {}
+    # columns naming a related row, resolved through a NameMap
+    references = {}
+    # columns that must be present and filled in even though the model field has a default
+    required = ()
+    batch_size = BATCH_SIZE
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.rows = self.created = self.skipped = 0
+        self.errors = []
+        self.error_count = 0
+        self.maps = {column: NameMap(model) for column, model in self.references.items()}
+
+    def run(self, rows):
+        with transaction.atomic():
+            batch = []
+            for number, row in rows:
+                if not self.rows:
+                    self.check_columns(row)
+                self.rows += 1
+                try:
+                    batch.append((number, row, self.build(number, row)))
+                except RowError as exc:
+                    self.skipped += 1
+                    self.add_error(number, exc.errors)
+                    continue
+                if len(batch) >= self.batch_size:
+                    self.save_batch(batch)
+                    batch = []
+            if batch:
+                self.save_batch(batch)
+            self.finish()
+            if self.dry_run:
+                transaction.set_rollback(True)
+        return self.report()
+
+    def check_columns(self, row):
+        wanted = [
+            column for column, field in self.fields.items()
+            if column in self.required or not self.model._meta.get_field(field).has_default()
+        ]
+        missing = [column for column in [*wanted, *self.references] if column not in row]
+        if missing:
+            raise ImportFileError(f"Missing column(s): {', '.join(missing)}. Expected: {', '.join([*self.fields, *self.references])}.")
+
+    def clean_fields(self, row):
+        values, errors = {}, {}
+        for column, field_name in self.fields.items():
+            field = self.model._meta.get_field(field_name)
+            raw = row.get(column, '')
+            if raw == '' and column in self.required:
+                errors[column] = ['This field cannot be blank.']
+                continue
+            if raw == '' and field.has_default():
+                values[field_name] = field.get_default()
+                continue
+            try:
+                values[field_name] = field.clean(raw, None)
+            except ValidationError as exc:
+                errors[column] = exc.messages
+        for column, names in self.maps.items():
+            message = names.check(row.get(column, ''))
+            if message:
+                errors[column] = [message]
+        return values, errors
+
+    def build(self, number, row):
+        values, errors = self.clean_fields(row)
+        if errors:
+            raise RowError(errors)
+        return self.model(**values)
+
+    def resolve_references(self, batch):
+        for column, names in self.maps.items():
+            names.ensure(row[column] for _, row, _ in batch)
+            for _, row, instance in batch:
+                setattr(instance, f'{column}_id', names[row[column]])
+
+    def save_batch(self, batch):
+        self.resolve_references(batch)
+        self.model.objects.bulk_create([instance for _, _, instance in batch])
+        self.created += len(batch)
+
+    def finish(self):
+        if self.created:
+            events.counters_changed()
+
+    def add_error(self, number, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': number, 'errors': errors})
+
+    def report(self):
+        return {
+            'rows': self.rows,
+            'created': self.created,
+            'skipped': self.skipped,
+            'created_references': {column: names.created for column, names in self.maps.items()},
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'dry_run': self.dry_run,
+        }
+
+
+class BookImport(SpreadsheetImport):
+    """Columns: title, author, publisher, price, quantity_in_stock (optional)."""
+    model = Book
+    fields = {'title': 'title', 'price': 'price', 'quantity_in_stock': 'quantity_in_stock'}
+    references = {'author': Author, 'publisher': Publisher}
+    # Book.price defaults to 0, but a catalogue row without a price is a mistake, not a free book.
+    required = ('price',)
+
+
+class CustomerImport(SpreadsheetImport):
+    """
+    Columns: school_name, route_axis, contact_person, phone_number, address,
+    referred_by_phone (optional). A referrer is looked up by phone number
+    among existing customers and the rest of the file, so a school may be
+    listed before the school that referred it.
+    """
+    model = Customer
+    fields = {'school_name': 'school_name', 'contact_person': 'contact_person', 'phone_number': 'phone_number', 'address': 'address'}
+    references = {'route_axis': RouteAxis}
+
+    def __init__(self, dry_run=False):
+        super().__init__(dry_run)
+        self.phones = dict(Customer.objects.values_list('phone_number', 'id'))
+        self.file_phones = {}
+        self.referrals = []
+
+    def build(self, number, row):
+        values, errors = self.clean_fields(row)
+        phone = values.get('phone_number')
+        if phone in self.phones:
+            errors.setdefault('phone_number', []).append(f'Already used by customer #{self.phones[phone]}.')
+        elif phone in self.file_phones:
+            errors.setdefault('phone_number', []).append(f'Already used on row {self.file_phones[phone]}.')
+        if errors:
+            raise RowError(errors)
+        self.file_phones[phone] = number
+        return Customer(**values)
+
+    def save_batch(self, batch):
+        super().save_batch(batch)
+        for number, row, customer in batch:
+            self.phones[customer.phone_number] = customer.pk
+            if row.get('referred_by_phone'):
+                self.referrals.append((number, customer.pk, row['referred_by_phone']))
+        # New customers have no referrer yet, so this is just their depth-0 rows.
+        attach_customers([customer for _, _, customer in batch])
+
+    def finish(self):
+        links = {}
+        for number, customer_id, phone in self.referrals:
+            referrer_id = self.phones.get(phone)
+            if referrer_id is None:
+                self.add_error(number, {'referred_by_phone': [f'No customer has phone number {phone}; imported without a referrer.']})
+            elif referrer_id == customer_id:
+                self.add_error(number, {'referred_by_phone': ['A school cannot refer itself; imported without a referrer.']})
+            else:
+                links[customer_id] = (referrer_id, number)
+
+        # Only new customers get a referrer, so a cycle can only run through the file itself.
+        for customer_id in list(links):
+            seen, current = {customer_id}, links[customer_id][0]
+            while current in links and current not in seen:
+                seen.add(current)
+                current = links[current][0]
+            if current == customer_id:
+                number = links.pop(customer_id)[1]
+                self.add_error(number, {'referred_by_phone': ['This referral would form a cycle; imported without a referrer.']})
+
+        now = timezone.now()
+        customer_ids = sorted(links)
+        for start in range(0, len(customer_ids), self.batch_size):
+            chunk = customer_ids[start:start + self.batch_size]
+            Customer.objects.filter(pk__in=chunk).update(
+                referred_by_id=Case(*(When(pk=pk, then=links[pk][0]) for pk in chunk)), updated_at=now
+            )
+        if links:
+            rebuild_closure()
+        super().finish()
+
+
+IMPORTERS = {'books': BookImport, 'customers': CustomerImport}
+
+
+def import_file(kind, fileobj, filename='', dry_run=False):
+    return IMPORTERS[kind](dry_run=dry_run).run(read_rows(fileobj, filename))
@@ -0,0 +1,95 @@
+"""
+Reusable SQL expressions for invoice and customer balances.
+
+Each helper returns a correlated subquery, so totals can be annotated onto
+any queryset without the row fan-out you get from summing several reverse
+joins in one GROUP BY.
+"""
+from decimal import Decimal
+
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import (
+    ArchivedCreditNoteItem, ArchivedInvoiceItem, ArchivedPayment, CreditNoteItem,
+    CustomerArchiveSummary, InvoiceItem, Payment
+)
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+ZERO = Value(Decimal('0.00'), output_field=MONEY)
+
+
+def _total(queryset, group_by, expression):
+    subquery = queryset.order_by().values(group_by).annotate(total=Sum(expression)).values('total')
+    return Coalesce(Subquery(subquery, output_field=MONEY), ZERO, output_field=MONEY)
+
+def _archived(field, outer):
+    subquery = CustomerArchiveSummary.objects.filter(customer=OuterRef(outer)).values(field)
+    return Coalesce(Subquery(subquery, output_field=MONEY), ZERO, output_field=MONEY)
+
+
+# --- Per-invoice totals ---
+
+def invoice_total_subquery(outer='pk'):
+    return _total(InvoiceItem.objects.filter(invoice=OuterRef(outer)), 'invoice', F('quantity') * F('unit_price'))
+
+def invoice_paid_subquery(outer='pk'):
+    return _total(Payment.objects.filter(invoice=OuterRef(outer)), 'invoice', F('amount'))
+
+def invoice_credited_subquery(outer='pk'):
+    return _total(
+        CreditNoteItem.objects.filter(credit_note__original_invoice=OuterRef(outer)),
+        'credit_note__original_invoice', F('quantity') * F('unit_price')
+    )
+
+def invoice_balance_annotations(outer='pk'):
+    """Annotations for an Invoice queryset: total_amount, amount_paid, credit_applied, balance_due."""
+    return {
+        'total_amount': invoice_total_subquery(outer),
+        'amount_paid': invoice_paid_subquery(outer),
+        'credit_applied': invoice_credited_subquery(outer),
+        'balance_due': invoice_total_subquery(outer) - invoice_paid_subquery(outer) - invoice_credited_subquery(outer),
+    }
+
+
+# --- Per-archived-invoice totals ---
+
+def archived_invoice_balance_annotations(outer='pk'):
+    """The same annotations as invoice_balance_annotations(), for an ArchivedInvoice queryset."""
+    total = _total(ArchivedInvoiceItem.objects.filter(invoice=OuterRef(outer)), 'invoice', F('quantity') * F('unit_price'))
+    paid = _total(ArchivedPayment.objects.filter(invoice=OuterRef(outer)), 'invoice', F('amount'))
+    credited = _total(
+        ArchivedCreditNoteItem.objects.filter(credit_note__original_invoice=OuterRef(outer)),
+        'credit_note__original_invoice', F('quantity') * F('unit_price')
+    )
+    return {'total_amount': total, 'amount_paid': paid, 'credit_applied': credited, 'balance_due': total - paid - credited}
+
+
+# --- Per-customer totals (live invoices plus the customer's archive summary) ---
+
+def customer_invoiced_subquery(outer='pk'):
+    live = _total(InvoiceItem.objects.filter(invoice__customer=OuterRef(outer)), 'invoice__customer', F('quantity') * F('unit_price'))
+    return live + _archived('total_invoiced', outer)
+
+def customer_paid_subquery(outer='pk'):
+    live = _total(Payment.objects.filter(invoice__customer=OuterRef(outer)), 'invoice__customer', F('amount'))
+    return live + _archived('total_paid', outer)
+
+def customer_credited_subquery(outer='pk'):
+    live = _total(
+        CreditNoteItem.objects.filter(credit_note__original_invoice__customer=OuterRef(outer)),
+        'credit_note__original_invoice__customer', F('quantity') * F('unit_price')
+    )
+    return live + _archived('total_credited', outer)
+
+def customer_balance_annotations(outer='pk'):
+    """
+    Annotations for any queryset that carries a customer id in `outer`:
+    total_invoiced, total_paid, total_credited and outstanding_balance.
+    """
+    return {
+        'total_invoiced': customer_invoiced_subquery(outer),
+        'total_paid': customer_paid_subquery(outer),
+        'total_credited': customer_credited_subquery(outer),
+        'outstanding_balance': customer_invoiced_subquery(outer) - customer_paid_subquery(outer) - customer_credited_subquery(outer),
+    }
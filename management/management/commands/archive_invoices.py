@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from management.archive import archive_settled_invoices
+
+
+class Command(BaseCommand):
+    help = 'Moves fully paid invoices older than INVOICE_ARCHIVE_AFTER_DAYS (with their items, payments and credit notes) to the archive tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive settled invoices older than this many days (default: INVOICE_ARCHIVE_AFTER_DAYS).')
+        parser.add_argument('--chunk-size', type=int, help='Invoices moved per transaction (default: INVOICE_ARCHIVE_CHUNK_SIZE).')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the invoices that would be archived.')
+
+    def handle(self, *args, **options):
+        counts = archive_settled_invoices(
+            older_than_days=options['days'], chunk_size=options['chunk_size'], dry_run=options['dry_run']
+        )
+        if options['dry_run']:
+            self.stdout.write(f"{counts.get('invoices', 0)} invoices would be archived.")
+            return
+        summary = ', '.join(f'{count} {name.replace("_", " ")}' for name, count in counts.items()) or 'nothing'
+        self.stdout.write(self.style.SUCCESS(f'Archived {summary}.'))
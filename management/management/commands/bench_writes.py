@@ -0,0 +1,139 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from management.models import Book, Customer, Invoice
+
+MODES = {
+    # name: (transaction_mode, settings)
+    'naive': (None, {'SQLITE_WRITE_COORDINATION': False, 'SQLITE_GROUP_COMMIT': False}),
+    'immediate': ('IMMEDIATE', {'SQLITE_WRITE_COORDINATION': True, 'SQLITE_GROUP_COMMIT': False}),
+    'group': ('IMMEDIATE', {'SQLITE_WRITE_COORDINATION': True, 'SQLITE_GROUP_COMMIT': True}),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Stress-tests concurrent order entry (invoice creation and payments through the API) with N parallel '
+        'writers, on a throwaway copy of the database, and reports throughput, failures and latency percentiles.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help='Parallel writer threads.')
+        parser.add_argument('--ops', type=int, default=50, help='Writes per writer.')
+        parser.add_argument('--mode', choices=[*MODES, 'all'], default='all',
+                            help='naive = deferred transactions, no retry; immediate = BEGIN IMMEDIATE + retry; '
+                                 'group = single-writer group commit.')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        database = connections['default'].settings_dict
+        if database['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('bench_writes only makes sense on SQLite.')
+        source, options_before = str(database['NAME']), dict(database.get('OPTIONS', {}))
+        # The group-commit writer thread keeps its connection for the life of the process, so run it last.
+        modes = list(MODES) if options['mode'] == 'all' else [options['mode']]
+
+        self.stdout.write(f"{'mode':<10} {'writers':>7} {'ok':>6} {'failed':>6} {'ops/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for mode in modes:
+            fd, copy = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(fd)
+            try:
+                self._copy_database(source, copy)
+                result = self._run(mode, copy, options)
+            finally:
+                connections['default'].close()
+                database['NAME'], database['OPTIONS'] = source, dict(options_before)
+                for path in (copy, f'{copy}-wal', f'{copy}-shm'):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._report(mode, options['writers'], result)
+
+    def _copy_database(self, source, target):
+        connections['default'].close()
+        with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+            src.backup(dst)
+
+    def _run(self, mode, path, options):
+        transaction_mode, overrides = MODES[mode]
+        database = connections['default'].settings_dict
+        database['NAME'] = path
+        database.setdefault('OPTIONS', {})['transaction_mode'] = transaction_mode
+        connections['default'].close()
+
+        rng = random.Random(options['seed'])
+        Book.objects.update(quantity_in_stock=1_000_000)
+        book_ids = list(Book.objects.values_list('id', flat=True))
+        customer_ids = list(Customer.objects.values_list('id', flat=True))
+        invoice_ids = list(Invoice.objects.exclude(status='PAID').values_list('id', flat=True))
+        if not (book_ids and customer_ids and invoice_ids):
+            raise CommandError('The database needs books, customers and open invoices; run seed_data first.')
+        connections['default'].close()
+
+        latencies, failures = [], Counter()
+        lock = threading.Lock()
+        start = threading.Barrier(options['writers'] + 1)
+
+        def writer(seed):
+            writer_rng = random.Random(seed)
+            client = APIClient()
+            start.wait()
+            for number in range(options['ops']):
+                if number % 2:
+                    url, payload = f'/api/invoices/{writer_rng.choice(invoice_ids)}/record_payment/', {'amount': '1.00'}
+                else:
+                    url, payload = '/api/invoices/', {
+                        'customer_id': writer_rng.choice(customer_ids), 'due_date': '2030-01-01', 'status': 'UNPAID',
+                        'items': [{'book_id': book_id, 'quantity': 1} for book_id in writer_rng.sample(book_ids, 2)],
+                    }
+                began = time.perf_counter()
+                try:
+                    response = client.post(url, payload, format='json')
+                    outcome = None if response.status_code < 300 else f'HTTP {response.status_code}'
+                except Exception as exc:
+                    outcome = type(exc).__name__ + (': database is locked' if 'locked' in str(exc) else '')
+                elapsed = time.perf_counter() - began
+                with lock:
+                    if outcome:
+                        failures[outcome] += 1
+                    else:
+                        latencies.append(elapsed)
+            connections.close_all()
+
+        # APIClient requests come from 'testserver', which a real ALLOWED_HOSTS never lists.
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], **overrides):
+            threads = [threading.Thread(target=writer, args=(rng.random(),)) for _ in range(options['writers'])]
+            for thread in threads:
+                thread.start()
+            start.wait()
+            began = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - began
+        return latencies, failures, wall
+
+    def _report(self, mode, writers, result):
+        latencies, failures, wall = result
+        if len(latencies) >= 2:
+            cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+            p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+        else:
+            p50 = p95 = p99 = latencies[0] if latencies else 0
+        longest = max(latencies, default=0)
+        self.stdout.write(
+            f"{mode:<10} {writers:>7} {len(latencies):>6} {sum(failures.values()):>6} {len(latencies) / wall:>8.1f} "
+            f"{p50 * 1000:>8.1f} {p95 * 1000:>8.1f} {p99 * 1000:>8.1f} {longest * 1000:>8.1f}"
+        )
+        for outcome, count in failures.most_common():
+            self.stdout.write(f'{"":<10} {count} x {outcome}')
@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from management.forecasting import (
+    DEFAULT_COVER_DAYS, DEFAULT_HISTORY_DAYS, DEFAULT_LEAD_TIME_DAYS, ForecastError, reorder_suggestions
+)
+
+
+class Command(BaseCommand):
+    help = 'Forecasts demand for every title from its sales history and prints reorder suggestions grouped by publisher.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lead-time', type=int, default=DEFAULT_LEAD_TIME_DAYS, help='Days between ordering and delivery.')
+        parser.add_argument('--cover-days', type=int, default=DEFAULT_COVER_DAYS, help='Days of stock wanted once the order arrives.')
+        parser.add_argument('--history-days', type=int, default=DEFAULT_HISTORY_DAYS, help='Days of sales history to fit on.')
+        parser.add_argument('--publisher', type=int, help='Only this publisher id.')
+        parser.add_argument('--json', action='store_true', help='Print the full result as JSON.')
+
+    def handle(self, *args, **options):
+        try:
+            result = reorder_suggestions(
+                lead_time_days=options['lead_time'], cover_days=options['cover_days'],
+                publisher=options['publisher'], history_days=options['history_days'],
+            )
+        except ForecastError as exc:
+            raise CommandError(exc)
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, cls=DjangoJSONEncoder, indent=2))
+            return
+
+        self.stdout.write(
+            f"{result['date']} ({result['term']} term): {result['books_to_reorder']} of {result['books_analysed']} titles "
+            f"need {result['units_to_reorder']} units, lead time {result['lead_time_days']} days, "
+            f"{result['cover_days']} days of cover."
+        )
+        for group in result['publishers']:
+            contact = ', '.join(filter(None, [group['contact_person'], group['phone_number']]))
+            self.stdout.write('')
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{group['publisher']}{f' ({contact})' if contact else ''}: {group['total_units']} units, about {group['estimated_value']:,.2f}"
+            ))
+            self.stdout.write(f"  {'title':<40} {'stock':>6} {'per day':>8} {'cover':>6} {'order':>6}")
+            for book in group['books']:
+                cover = '-' if book['days_of_cover'] is None else book['days_of_cover']
+                self.stdout.write(
+                    f"  {book['title'][:40]:<40} {book['quantity_in_stock']:>6} {book['daily_velocity']:>8.2f} {cover:>6} {book['suggested_quantity']:>6}"
+                )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from management.importers import IMPORTERS, ImportFileError, import_file
+
+
+class Command(BaseCommand):
+    help = 'Imports books or customers from a CSV or XLSX file in bulk batches, reporting bad rows by row number.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(IMPORTERS), help='What the file contains.')
+        parser.add_argument('path', help='Path to a .csv or .xlsx file with a header row.')
+        parser.add_argument('--dry-run', action='store_true', help='Validate and report without saving anything.')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], 'rb') as fileobj:
+                report = import_file(options['kind'], fileobj, options['path'], dry_run=options['dry_run'])
+        except (OSError, ImportFileError) as exc:
+            raise CommandError(str(exc))
+
+        for error in report['errors']:
+            messages = '; '.join(f"{column}: {' '.join(problems)}" for column, problems in error['errors'].items())
+            self.stderr.write(f"Row {error['row']}: {messages}")
+        if report['error_count'] > len(report['errors']):
+            self.stderr.write(f"... and {report['error_count'] - len(report['errors'])} more.")
+
+        created = ', '.join(f'{count} new {column.replace("_", " ")}(s)' for column, count in report['created_references'].items())
+        verb = 'Would import' if report['dry_run'] else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {report['created']} of {report['rows']} {options['kind']} ({created}); {report['skipped']} row(s) skipped."
+        ))
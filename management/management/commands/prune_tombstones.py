@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from management.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Deletes change-feed tombstones older than SYNC_TOMBSTONE_RETENTION_DAYS.'
+
+    def handle(self, *args, **kwargs):
+        deleted = prune_tombstones()
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} tombstones.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from management.referrals import rebuild_closure
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the customer referral closure table from Customer.referred_by in one recursive query.'
+
+    def handle(self, *args, **kwargs):
+        rows = rebuild_closure()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt referral closure table ({rows} paths).'))
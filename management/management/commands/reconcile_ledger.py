@@ -0,0 +1,56 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from management.reconcile import CHECKS, check_chunk, id_ranges
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes invoice statuses and the archive summaries from the underlying rows, chunk by chunk in a '
+        'process pool, and reports (or with --repair, fixes) every value that has drifted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', nargs='+', choices=sorted(CHECKS), default=list(CHECKS), help='Checks to run (default: all).')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Primary keys per chunk.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes; 1 runs everything in this process.')
+        parser.add_argument('--repair', action='store_true', help='Write the recomputed values back, in batches.')
+        parser.add_argument('--show', type=int, default=20, help='Drifted rows to print per check.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        tasks = [
+            (name, low, high)
+            for name in options['checks']
+            for low, high in id_ranges(CHECKS[name][0], options['chunk_size'])
+        ]
+        drift = {name: [] for name in options['checks']}
+
+        if options['workers'] <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                name, rows = check_chunk(*task)
+                drift[name].extend(rows)
+        else:
+            # Children open their own connections; don't hand them copies of ours. They are
+            # spawned rather than forked and set Django up before unpickling any task.
+            connections.close_all()
+            with ProcessPoolExecutor(options['workers'], mp_context=get_context('spawn'), initializer=django.setup) as pool:
+                for future in as_completed([pool.submit(check_chunk, *task) for task in tasks]):
+                    name, rows = future.result()
+                    drift[name].extend(rows)
+
+        self.stdout.write(f'Checked {len(tasks)} chunk(s) in {time.perf_counter() - started:.1f}s.')
+        for name, rows in drift.items():
+            style = self.style.WARNING if rows else self.style.SUCCESS
+            self.stdout.write(style(f'{name}: {len(rows)} drifted row(s).'))
+            for row in sorted(rows, key=lambda row: row.get('id', row.get('pk')))[:options['show']]:
+                self.stdout.write(f'  {row}')
+            if rows and options['repair']:
+                repaired = CHECKS[name][2](rows)
+                self.stdout.write(self.style.SUCCESS(f'{name}: repaired {repaired} row(s).'))
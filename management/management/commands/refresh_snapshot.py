@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from management.snapshots import refresh_snapshot, snapshot_age, snapshot_path
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies the live database to the read-only analytics snapshot that reports read from, '
+        'using SQLite\'s online backup API. With --every, keeps refreshing it at that interval.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=int, metavar='SECONDS', help='Refresh repeatedly, this many seconds apart.')
+        parser.add_argument('--if-older-than', type=int, metavar='SECONDS', help='Skip the refresh while the snapshot is younger than this.')
+
+    def handle(self, *args, **options):
+        while True:
+            self._refresh(options['if_older_than'])
+            if not options['every']:
+                return
+            time.sleep(options['every'])
+
+    def _refresh(self, if_older_than):
+        age = snapshot_age()
+        if if_older_than is not None and age is not None and age < if_older_than:
+            self.stdout.write(f'Snapshot is {age:.0f}s old; nothing to do.')
+            return
+        try:
+            elapsed = refresh_snapshot()
+        except RuntimeError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(f'Snapshot written to {snapshot_path()} in {elapsed:.2f}s.'))
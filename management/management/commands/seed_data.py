@@ -53,8 +53,9 @@ class Command(BaseCommand):
             customers.append(customer)
         
         # Add some referrals
-        for customer in random.sample(customers, 20):
-            possible_referrers = [c for c in customers if c.id != customer.id]
+        # Referrers are always created earlier, so the referral graph stays a tree.
+        for customer in random.sample(customers[1:], 20):
+            possible_referrers = [c for c in customers if c.id < customer.id]
             customer.referred_by = random.choice(possible_referrers)
             customer.save()
 
@@ -0,0 +1,72 @@
+"""
+HTTP middleware for the management API.
+"""
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.regex_helper import _lazy_re_compile
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+ACCEPT_ENCODING_RE = _lazy_re_compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*$')
+
+
+def accepted_encodings(header):
+    """Parse an Accept-Encoding header into {coding: q}, dropping anything with q=0."""
+    accepted = {}
+    for part in header.split(','):
+        match = ACCEPT_ENCODING_RE.match(part)
+        if not match:
+            continue
+        try:
+            quality = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+        if quality > 0:
+            accepted[match.group(1).lower()] = quality
+    return accepted
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compress responses larger than RESPONSE_COMPRESSION_MIN_SIZE bytes with
+    brotli (when the `brotli` package is installed) or gzip, whichever the
+    client prefers. Streaming responses are left alone so server-sent event
+    streams are flushed to the client as they are written.
+    """
+
+    def process_response(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        min_size = getattr(settings, 'RESPONSE_COMPRESSION_MIN_SIZE', 1024)
+        if len(response.content) < min_size:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        candidates = [coding for coding in ('br', 'gzip') if coding in accepted or '*' in accepted]
+        if brotli is None and 'br' in candidates:
+            candidates.remove('br')
+        if not candidates:
+            return response
+        coding = max(candidates, key=lambda c: accepted.get(c, accepted.get('*', 0)))
+
+        if coding == 'br':
+            compressed = brotli.compress(response.content, quality=getattr(settings, 'RESPONSE_COMPRESSION_BROTLI_QUALITY', 5))
+        else:
+            compressed = compress_string(response.content)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response.headers['Content-Length'] = str(len(compressed))
+        response.headers['Content-Encoding'] = coding
+        # The body changed, so a strong ETag no longer applies byte-for-byte.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_referral_paths(apps, schema_editor):
+    from management.referrals import rebuild_closure
+    rebuild_closure(using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerReferralPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='downline_paths', to='management.customer')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upline_paths', to='management.customer')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='management__ancesto_cb85d6_idx'), models.Index(fields=['descendant', 'depth'], name='management__descend_1cae14_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_referral_path')],
+            },
+        ),
+        migrations.RunPython(build_referral_paths, migrations.RunPython.noop),
+    ]
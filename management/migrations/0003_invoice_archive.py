@@ -0,0 +1,94 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0002_customer_referral_paths'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookArchiveSummary',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive_summary', serialize=False, to='management.book')),
+                ('invoice_count', models.PositiveIntegerField(default=0)),
+                ('units_sold', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('units_returned', models.PositiveIntegerField(default=0)),
+                ('returns_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CustomerArchiveSummary',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive_summary', serialize=False, to='management.customer')),
+                ('invoice_count', models.PositiveIntegerField(default=0)),
+                ('total_invoiced', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_paid', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_credited', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedCreditNote',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('reason', models.CharField(blank=True, max_length=255)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_credit_notes', to='management.customer')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedCreditNoteItem',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('quantity', models.PositiveIntegerField()),
+                ('unit_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='management.book')),
+                ('credit_note', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='management.archivedcreditnote')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedInvoice',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('invoice_date', models.DateField()),
+                ('due_date', models.DateField()),
+                ('status', models.CharField(choices=[('UNPAID', 'Unpaid'), ('PAID', 'Paid'), ('PARTIALLY_PAID', 'Partially Paid')], max_length=20)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_invoices', to='management.customer')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedcreditnote',
+            name='original_invoice',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credit_notes', to='management.archivedinvoice'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedInvoiceItem',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('quantity', models.PositiveIntegerField()),
+                ('unit_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='management.book')),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='management.archivedinvoice')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('payment_date', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('notes', models.TextField(blank=True)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payments', to='management.archivedinvoice')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedinvoice',
+            index=models.Index(fields=['customer', 'invoice_date'], name='management__custome_77022c_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0004_sync_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueAudit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('REPRICE', 'Reprice'), ('RESTOCK', 'Restock'), ('CREATE', 'Create')], max_length=20)),
+                ('parameters', models.JSONField(default=dict)),
+                ('affected', models.PositiveIntegerField(default=0)),
+                ('details', models.JSONField(default=dict)),
+                ('notes', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
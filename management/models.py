@@ -3,6 +3,7 @@ from django.db import models
 # NEW: We are making a dedicated model for RouteAxis
 class RouteAxis(models.Model):
     name = models.CharField(max_length=100, unique=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
@@ -10,6 +11,7 @@ class RouteAxis(models.Model):
 # NEW: We are making a dedicated model for Author
 class Author(models.Model):
     name = models.CharField(max_length=200, unique=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
@@ -18,6 +20,7 @@ class Publisher(models.Model):
     name = models.CharField(max_length=200, unique=True)
     contact_person = models.CharField(max_length=200, blank=True)
     phone_number = models.CharField(max_length=20, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
@@ -30,6 +33,10 @@ class Book(models.Model):
     # ADD THIS NEW LINE FOR THE MASTER PRICE
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     quantity_in_stock = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['title'])]
 
     def __str__(self):
         return self.title
@@ -50,10 +57,37 @@ class Customer(models.Model):
         blank=True,
         related_name='referred_customers'
     )
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['school_name'])]
 
     def __str__(self):
         return f"{self.school_name} ({self.route_axis})"
 
+
+class CustomerReferralPath(models.Model):
+    """
+    Closure table for the Customer.referred_by tree: one row per
+    (ancestor, descendant) pair, including a depth-0 row for every customer.
+    Kept in sync by the signal handlers in management/signals.py.
+    """
+    ancestor = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='downline_paths')
+    descendant = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='upline_paths')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_referral_path'),
+        ]
+        indexes = [
+            models.Index(fields=['ancestor', 'depth']),
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
+
 class Invoice(models.Model):
     STATUS_CHOICES = (
         ('UNPAID', 'Unpaid'),
@@ -65,6 +99,14 @@ class Invoice(models.Model):
     invoice_date = models.DateField(auto_now_add=True)
     due_date = models.DateField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='UNPAID')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # The debtors list and the admin's status filter: open invoices by due date.
+            models.Index(fields=['status', 'due_date']),
+            models.Index(fields=['due_date']),
+        ]
 
     def __str__(self):
         return f"Invoice #{self.id} for {self.customer.school_name}"
@@ -74,6 +116,7 @@ class InvoiceItem(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"{self.quantity} of {self.book.title}"
@@ -83,9 +126,10 @@ class Payment(models.Model):
     payment_date = models.DateField(auto_now_add=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     notes = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
-        return f"Payment of {self.amount} for Invoice #{self.invoice.id}"
+        return f"Payment of {self.amount} for Invoice #{self.invoice_id}"
     
     
 
@@ -95,9 +139,10 @@ class CreditNote(models.Model):
     original_invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE)
     date = models.DateField(auto_now_add=True)
     reason = models.CharField(max_length=255, blank=True, help_text="e.g., Unsold book returns")
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
-        return f"Credit Note #{self.id} for Invoice #{self.original_invoice.id}"
+        return f"Credit Note #{self.id} for Invoice #{self.original_invoice_id}"
 
 class CreditNoteItem(models.Model):
     credit_note = models.ForeignKey(CreditNote, related_name='items', on_delete=models.CASCADE)
@@ -105,6 +150,103 @@ class CreditNoteItem(models.Model):
     quantity = models.PositiveIntegerField()
     # The price at which the book was returned, usually the original sale price
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
-        return f"{self.quantity} of {self.book.title} returned"
\ No newline at end of file
+        return f"{self.quantity} of {self.book.title} returned"
+
+class Tombstone(models.Model):
+    """A deleted row, kept so the change feed (management/sync.py) can tell clients to drop it."""
+    model = models.CharField(max_length=50)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['model', 'deleted_at'])]
+
+    def __str__(self):
+        return f"{self.model} #{self.object_id} deleted at {self.deleted_at}"
+
+class CatalogueAudit(models.Model):
+    """One bulk catalogue operation (see management/catalogue.py) and what it changed."""
+    OPERATION_CHOICES = (
+        ('REPRICE', 'Reprice'),
+        ('RESTOCK', 'Restock'),
+        ('CREATE', 'Create'),
+    )
+
+    operation = models.CharField(max_length=20, choices=OPERATION_CHOICES)
+    parameters = models.JSONField(default=dict)
+    affected = models.PositiveIntegerField(default=0)
+    # Per-book before values (reprice), quantities added (restock) or new ids (create).
+    details = models.JSONField(default=dict)
+    notes = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.get_operation_display()} of {self.affected} book(s) at {self.created_at}"
+
+
+# --- Archive of settled invoices (see management/archive.py) ---
+# Rows keep their original primary keys, so references printed on receipts
+# and statements stay valid after an invoice moves out of the working tables.
+
+class ArchivedInvoice(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='archived_invoices')
+    invoice_date = models.DateField()
+    due_date = models.DateField()
+    status = models.CharField(max_length=20, choices=Invoice.STATUS_CHOICES)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['customer', 'invoice_date'])]
+
+    def __str__(self):
+        return f"Archived invoice #{self.id}"
+
+class ArchivedInvoiceItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    invoice = models.ForeignKey(ArchivedInvoice, related_name='items', on_delete=models.CASCADE)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+class ArchivedPayment(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    invoice = models.ForeignKey(ArchivedInvoice, related_name='payments', on_delete=models.CASCADE)
+    payment_date = models.DateField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    notes = models.TextField(blank=True)
+
+class ArchivedCreditNote(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='archived_credit_notes')
+    original_invoice = models.ForeignKey(ArchivedInvoice, related_name='credit_notes', on_delete=models.CASCADE)
+    date = models.DateField()
+    reason = models.CharField(max_length=255, blank=True)
+
+class ArchivedCreditNoteItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    credit_note = models.ForeignKey(ArchivedCreditNote, related_name='items', on_delete=models.CASCADE)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class CustomerArchiveSummary(models.Model):
+    """Lifetime totals of a customer's archived invoices, added to the live totals in management/ledger.py."""
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name='archive_summary')
+    invoice_count = models.PositiveIntegerField(default=0)
+    total_invoiced = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_credited = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+class BookArchiveSummary(models.Model):
+    """Lifetime sales and returns of a title on archived invoices."""
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='archive_summary')
+    invoice_count = models.PositiveIntegerField(default=0)
+    units_sold = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units_returned = models.PositiveIntegerField(default=0)
+    returns_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
@@ -0,0 +1,90 @@
+"""
+Customer-level payments allocated oldest-due-first across open invoices.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from . import events
+from .cache import detail_cache
+from .ledger import invoice_balance_annotations
+from .models import Invoice, Payment
+
+CENT = Decimal('0.01')
+OPEN_STATUSES = ('UNPAID', 'PARTIALLY_PAID')
+
+
+class PaymentError(ValueError):
+    """A payment that cannot be accepted; the message is safe to show to the cashier."""
+
+
+def parse_amount(raw):
+    """Parse a positive money amount, rounded to the kobo."""
+    try:
+        amount = Decimal(str(raw)).quantize(CENT, rounding=ROUND_HALF_UP)
+    except (ArithmeticError, ValueError, TypeError):
+        amount = None
+    if amount is None or not amount.is_finite() or amount <= Decimal('0.00'):
+        raise PaymentError('A valid, positive number is required for the amount.')
+    return amount
+
+
+@transaction.atomic
+def allocate_customer_payment(customer_id, amount, notes=''):
+    """
+    Split `amount` over the customer's open invoices, earliest due date first,
+    in one transaction: one annotated query for the balances, one bulk INSERT
+    for the payments and one UPDATE for the statuses. Returns the allocation
+    breakdown.
+    """
+    open_invoices = list(
+        Invoice.objects.select_for_update().filter(customer_id=customer_id, status__in=OPEN_STATUSES)
+        .annotate(**invoice_balance_annotations())
+        .filter(balance_due__gt=0)
+        .order_by('due_date', 'invoice_date', 'id')
+        .values('id', 'due_date', 'balance_due')
+    )
+    outstanding = sum((row['balance_due'].quantize(CENT, rounding=ROUND_HALF_UP) for row in open_invoices), Decimal('0.00'))
+    if not open_invoices:
+        raise PaymentError('This customer has no open invoices.')
+    # Nothing would account for cash beyond the open balances, so refuse it rather than drop it.
+    if amount > outstanding:
+        raise PaymentError(f'Payment amount (₦{amount:.2f}) exceeds the outstanding balance (₦{outstanding:.2f}).')
+
+    remaining = amount
+    allocations, payments, paid_ids = [], [], []
+    for row in open_invoices:
+        if remaining <= Decimal('0.00'):
+            break
+        balance = row['balance_due'].quantize(CENT, rounding=ROUND_HALF_UP)
+        applied = min(remaining, balance)
+        remaining -= applied
+        balance_after = balance - applied
+        new_status = 'PAID' if balance_after <= CENT else 'PARTIALLY_PAID'
+        if new_status == 'PAID':
+            paid_ids.append(row['id'])
+        payments.append(Payment(invoice_id=row['id'], amount=applied, notes=notes))
+        allocations.append({
+            'invoice_id': row['id'], 'due_date': row['due_date'], 'balance_before': balance,
+            'applied': applied, 'balance_after': balance_after, 'status': new_status,
+        })
+
+    Payment.objects.bulk_create(payments)
+    touched_ids = [allocation['invoice_id'] for allocation in allocations]
+    Invoice.objects.filter(id__in=touched_ids).update(
+        status=Case(When(id__in=paid_ids, then=Value('PAID')), default=Value('PARTIALLY_PAID')),
+        updated_at=timezone.now(),
+    )
+    # bulk_create() and update() skip the model signals that normally retire cached payloads.
+    detail_cache.bump(('customer', customer_id), *(('invoice', invoice_id) for invoice_id in touched_ids))
+    events.invoices_changed(touched_ids)
+
+    return {
+        'customer_id': customer_id,
+        'amount': amount,
+        'allocations': allocations,
+        'outstanding_before': outstanding,
+        'outstanding_after': outstanding - amount,
+    }
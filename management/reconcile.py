@@ -0,0 +1,199 @@
+"""
+Ledger reconciliation: prove that stored, derived values still match the rows
+they were derived from.
+
+Three checks, each run over a range of primary keys with one set-based query:
+
+* invoices           Invoice.status against the balance computed from items,
+                     payments and credit notes (management/ledger.py).
+* customer_summaries CustomerArchiveSummary against the archived invoices.
+* book_summaries     BookArchiveSummary (units and value sold and returned)
+                     against the archived items. Stock itself has no movement
+                     ledger to recompute it from, so these per-title sales and
+                     returns aggregates are what can be verified.
+
+The key space is cut into chunks that reconcile_ledger farms out to a process
+pool. Repairs are applied afterwards, in batches, by the calling process.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, Count, F, IntegerField, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Abs, Coalesce
+from django.utils import timezone
+
+from . import events
+from .cache import detail_cache
+from .ledger import MONEY, ZERO, _total, invoice_balance_annotations
+from .models import (
+    ArchivedCreditNoteItem, ArchivedInvoice, ArchivedInvoiceItem, ArchivedPayment, Book, BookArchiveSummary,
+    Customer, CustomerArchiveSummary, Invoice
+)
+from .writes import with_retry
+
+CENT = Decimal('0.01')
+REPAIR_BATCH_SIZE = 500
+
+
+def id_ranges(model, chunk_size):
+    bounds = model.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    return [(start, start + chunk_size) for start in range(bounds['low'], bounds['high'] + 1, chunk_size)]
+
+
+def _count(queryset, group_by, field='pk'):
+    subquery = queryset.order_by().values(group_by).annotate(n=Count(field, distinct=True)).values('n')
+    return Coalesce(Subquery(subquery, output_field=IntegerField()), Value(0), output_field=IntegerField())
+
+
+def _count_units(queryset):
+    subquery = queryset.order_by().values('book').annotate(units=Sum('quantity')).values('units')
+    return Coalesce(Subquery(subquery, output_field=IntegerField()), Value(0), output_field=IntegerField())
+
+
+# --- Invoice status ---
+
+def expected_status():
+    """
+    Status implied by the annotated totals. Only payments move an invoice out
+    of UNPAID (record_payment and allocate_customer_payment); a credit note
+    lowers the balance but leaves the status alone. So PAID needs payments
+    that, with any credit, settle the invoice, and PARTIALLY_PAID needs
+    payments (net of refunds) above zero.
+    """
+    return Case(
+        When(amount_paid__gt=0, total_amount__gt=0, balance_due__lte=CENT, then=Value('PAID')),
+        When(amount_paid__gt=0, then=Value('PARTIALLY_PAID')),
+        default=Value('UNPAID'),
+    )
+
+
+def invoice_drift(low, high):
+    return list(
+        Invoice.objects.filter(pk__gte=low, pk__lt=high)
+        .annotate(**invoice_balance_annotations())
+        .annotate(expected=expected_status())
+        .exclude(status=F('expected'))
+        .values('id', 'customer_id', 'status', 'expected', 'total_amount', 'amount_paid', 'credit_applied', 'balance_due')
+    )
+
+
+def repair_invoices(rows):
+    by_status = defaultdict(list)
+    for row in rows:
+        by_status[row['expected']].append(row)
+    repaired = 0
+    for status, group in by_status.items():
+        for start in range(0, len(group), REPAIR_BATCH_SIZE):
+            batch = group[start:start + REPAIR_BATCH_SIZE]
+            ids = [row['id'] for row in batch]
+
+            def apply():
+                count = Invoice.objects.filter(pk__in=ids).update(status=status, updated_at=timezone.now())
+                # update() skips the signals that retire cached payloads and notify dashboards.
+                detail_cache.bump(*(('invoice', row['id']) for row in batch), *(('customer', row['customer_id']) for row in batch))
+                events.invoices_changed(ids)
+                return count
+
+            repaired += with_retry(apply)
+    return repaired
+
+
+# --- Archive summaries ---
+
+def _summary_drift(queryset, expected, summary, count_fields, money_fields):
+    """Rows of `queryset` whose `summary` row disagrees with the `expected` aggregates."""
+    actual = {
+        f'actual_{field}': Coalesce(F(f'{summary}__{field}'), Value(0) if field in count_fields else ZERO)
+        for field in [*count_fields, *money_fields]
+    }
+    drifted = Q()
+    for field in count_fields:
+        drifted |= ~Q(**{f'expected_{field}': F(f'actual_{field}')})
+    for field in money_fields:
+        drifted |= Q(**{f'difference_{field}__gt': CENT / 2})
+    return list(
+        queryset.annotate(**{f'expected_{field}': value for field, value in expected.items()}, **actual)
+        .annotate(**{
+            f'difference_{field}': Abs(F(f'expected_{field}') - F(f'actual_{field}'), output_field=MONEY)
+            for field in money_fields
+        })
+        .filter(drifted)
+        .values('pk', *[f'{kind}_{field}' for field in expected for kind in ('expected', 'actual')])
+    )
+
+
+def customer_summary_drift(low, high):
+    customer = OuterRef('pk')
+    expected = {
+        'invoice_count': _count(ArchivedInvoice.objects.filter(customer=customer), 'customer'),
+        'total_invoiced': _total(ArchivedInvoiceItem.objects.filter(invoice__customer=customer), 'invoice__customer', F('quantity') * F('unit_price')),
+        'total_paid': _total(ArchivedPayment.objects.filter(invoice__customer=customer), 'invoice__customer', F('amount')),
+        'total_credited': _total(
+            ArchivedCreditNoteItem.objects.filter(credit_note__original_invoice__customer=customer),
+            'credit_note__original_invoice__customer', F('quantity') * F('unit_price')
+        ),
+    }
+    return _summary_drift(
+        Customer.objects.filter(pk__gte=low, pk__lt=high), expected, 'archive_summary',
+        count_fields=['invoice_count'], money_fields=['total_invoiced', 'total_paid', 'total_credited'],
+    )
+
+
+def book_summary_drift(low, high):
+    book = OuterRef('pk')
+    sold = ArchivedInvoiceItem.objects.filter(book=book)
+    returned = ArchivedCreditNoteItem.objects.filter(book=book)
+    expected = {
+        'invoice_count': _count(sold, 'book', 'invoice'),
+        'units_sold': _count_units(sold),
+        'revenue': _total(sold, 'book', F('quantity') * F('unit_price')),
+        'units_returned': _count_units(returned),
+        'returns_value': _total(returned, 'book', F('quantity') * F('unit_price')),
+    }
+    return _summary_drift(
+        Book.objects.filter(pk__gte=low, pk__lt=high), expected, 'archive_summary',
+        count_fields=['invoice_count', 'units_sold', 'units_returned'], money_fields=['revenue', 'returns_value'],
+    )
+
+
+def repair_summaries(model, kind, rows):
+    key = model._meta.pk.name
+    fields = [name[len('expected_'):] for name in rows[0] if name.startswith('expected_')] if rows else []
+    repaired = 0
+    for start in range(0, len(rows), REPAIR_BATCH_SIZE):
+        batch = rows[start:start + REPAIR_BATCH_SIZE]
+
+        def apply():
+            existing = model.objects.in_bulk([row['pk'] for row in batch])
+            created, updated = [], []
+            for row in batch:
+                values = {field: row[f'expected_{field}'] for field in fields}
+                summary = existing.get(row['pk'])
+                if summary is None:
+                    created.append(model(**{f'{key}_id': row['pk']}, **values))
+                    continue
+                for field, value in values.items():
+                    setattr(summary, field, value)
+                updated.append(summary)
+            model.objects.bulk_create(created)
+            model.objects.bulk_update(updated, fields=fields)
+            detail_cache.bump(*((kind, row['pk']) for row in batch))
+            return len(batch)
+
+        repaired += with_retry(apply)
+    return repaired
+
+
+# name -> (model whose key space is chunked, drift function, repair function)
+CHECKS = {
+    'invoices': (Invoice, invoice_drift, repair_invoices),
+    'customer_summaries': (Customer, customer_summary_drift, lambda rows: repair_summaries(CustomerArchiveSummary, 'customer', rows)),
+    'book_summaries': (Book, book_summary_drift, lambda rows: repair_summaries(BookArchiveSummary, 'book', rows)),
+}
+
+
+def check_chunk(name, low, high):
+    """Run one check over one key range. Top-level so a process pool can pickle it."""
+    return name, CHECKS[name][1](low, high)
@@ -0,0 +1,116 @@
+"""
+Maintenance of the CustomerReferralPath closure table.
+
+Every customer owns a depth-0 row pointing at itself, plus one row for each
+of its ancestors in the referral tree. With that in place a whole downline is
+a single indexed lookup on `ancestor`, and a whole upline one on `descendant`.
+"""
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .models import Customer, CustomerReferralPath
+
+BATCH_SIZE = 1000
+
+
+class ReferralCycleError(ValueError):
+    """Raised when a referred_by change would make a customer its own referrer."""
+
+
+def would_create_cycle(customer_id, referrer_id):
+    if not customer_id or not referrer_id:
+        return False
+    if customer_id == referrer_id:
+        return True
+    # The new referrer must not sit anywhere in this customer's downline.
+    return CustomerReferralPath.objects.filter(ancestor_id=customer_id, descendant_id=referrer_id).exists()
+
+
+def attach_customers(customers):
+    """Insert closure rows for newly created customers, which have no downline yet."""
+    parent_ids = {c.referred_by_id for c in customers if c.referred_by_id}
+    uplines = defaultdict(list)
+    if parent_ids:
+        for ancestor_id, descendant_id, depth in CustomerReferralPath.objects.filter(
+            descendant_id__in=parent_ids
+        ).values_list('ancestor_id', 'descendant_id', 'depth'):
+            uplines[descendant_id].append((ancestor_id, depth))
+
+    rows = []
+    for customer in customers:
+        rows.append(CustomerReferralPath(ancestor_id=customer.pk, descendant_id=customer.pk, depth=0))
+        for ancestor_id, depth in uplines.get(customer.referred_by_id, ()):
+            rows.append(CustomerReferralPath(ancestor_id=ancestor_id, descendant_id=customer.pk, depth=depth + 1))
+    CustomerReferralPath.objects.bulk_create(rows, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def move_customer(customer_id, referrer_id):
+    """Re-hang a customer (and its whole downline) under a new referrer, or make it a root."""
+    if would_create_cycle(customer_id, referrer_id):
+        raise ReferralCycleError(f"Customer {referrer_id} is in the downline of customer {customer_id}.")
+
+    with transaction.atomic():
+        subtree = list(CustomerReferralPath.objects.filter(ancestor_id=customer_id).values_list('descendant_id', 'depth'))
+        if not subtree:
+            subtree = [(customer_id, 0)]
+            CustomerReferralPath.objects.create(ancestor_id=customer_id, descendant_id=customer_id, depth=0)
+        subtree_ids = [descendant_id for descendant_id, _ in subtree]
+
+        # Cut every path that enters the subtree from above...
+        CustomerReferralPath.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if not referrer_id:
+            return
+
+        # ...and graft it under the new referrer's upline.
+        upline = CustomerReferralPath.objects.filter(descendant_id=referrer_id).values_list('ancestor_id', 'depth')
+        CustomerReferralPath.objects.bulk_create(
+            [
+                CustomerReferralPath(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=up_depth + down_depth + 1)
+                for ancestor_id, up_depth in upline
+                for descendant_id, down_depth in subtree
+            ],
+            batch_size=BATCH_SIZE,
+        )
+
+
+def detach_customer(customer_id):
+    """
+    Called before a customer is deleted. Its own rows cascade away, but its
+    referred customers become roots (referred_by is SET_NULL), so the paths
+    linking its upline to its downline have to go too.
+    """
+    ancestor_ids = list(CustomerReferralPath.objects.filter(descendant_id=customer_id, depth__gt=0).values_list('ancestor_id', flat=True))
+    if not ancestor_ids:
+        return
+    descendant_ids = list(CustomerReferralPath.objects.filter(ancestor_id=customer_id, depth__gt=0).values_list('descendant_id', flat=True))
+    if descendant_ids:
+        CustomerReferralPath.objects.filter(ancestor_id__in=ancestor_ids, descendant_id__in=descendant_ids).delete()
+
+
+def rebuild_closure(using=None):
+    """
+    Rebuild the whole closure table from Customer.referred_by with one
+    recursive CTE. Used by the migration, bulk imports and the
+    `rebuild_referrals` command. Pre-existing cycles are cut off at a depth
+    equal to the number of customers and deduplicated by shortest path.
+    """
+    conn = connections[using or DEFAULT_DB_ALIAS]
+    paths = CustomerReferralPath._meta.db_table
+    customers = Customer._meta.db_table
+    with transaction.atomic(using=conn.alias), conn.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {paths}')
+        cursor.execute(
+            f'''
+            INSERT INTO {paths} (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+                SELECT id, id, 0 FROM {customers}
+                UNION ALL
+                SELECT tree.ancestor_id, child.id, tree.depth + 1
+                FROM tree JOIN {customers} AS child ON child.referred_by_id = tree.descendant_id
+                WHERE tree.depth < (SELECT COUNT(*) FROM {customers})
+            )
+            SELECT ancestor_id, descendant_id, MIN(depth) FROM tree GROUP BY ancestor_id, descendant_id
+            '''
+        )
+        return cursor.rowcount
@@ -0,0 +1,72 @@
+"""
+Response renderers for the API.
+
+ORJSONRenderer is a drop-in replacement for DRF's JSONRenderer that encodes
+with orjson when it is installed (and falls back to the stock encoder when it
+is not). Anything orjson does not handle natively - Decimal, dates, lazy
+strings - goes through DRF's own JSONEncoder.default, so the wire format is
+the same as before, only faster to produce.
+
+TabularJSONRenderer is an opt-in compact format for list endpoints, selected
+with `Accept: application/vnd.abims.table+json` or `?format=table`: the column
+names are sent once and every row is a plain array.
+"""
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+# U+2028 / U+2029 are valid JSON but not valid JavaScript source; escape them
+# the same way DRF's JSONRenderer does.
+LINE_SEPARATOR = '\u2028'.encode()
+PARAGRAPH_SEPARATOR = '\u2029'.encode()
+
+
+class ORJSONRenderer(JSONRenderer):
+    _fallback_default = staticmethod(encoders.JSONEncoder().default)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        # orjson only pretty-prints with a fixed indent; leave indented output
+        # (e.g. the browsable API) to the stock renderer.
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(
+            data, default=self._fallback_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+        if LINE_SEPARATOR in ret or PARAGRAPH_SEPARATOR in ret:
+            ret = ret.replace(LINE_SEPARATOR, b'\\u2028').replace(PARAGRAPH_SEPARATOR, b'\\u2029')
+        return ret
+
+
+def tabulate(data):
+    """
+    Turn a list of flat dicts into {'columns': [...], 'rows': [[...], ...]}.
+    Paginated payloads keep their envelope and only `results` is converted;
+    anything else (detail objects, errors) is returned unchanged.
+    """
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        return {**data, 'results': tabulate(data['results'])}
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        return data
+
+    columns = {}
+    for row in data:
+        columns.update(dict.fromkeys(row))
+    columns = list(columns)
+    return {'columns': columns, 'rows': [[row.get(column) for column in columns] for row in data]}
+
+
+class TabularJSONRenderer(ORJSONRenderer):
+    media_type = 'application/vnd.abims.table+json'
+    format = 'table'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(tabulate(data), accepted_media_type, renderer_context)
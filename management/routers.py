@@ -0,0 +1,40 @@
+"""
+Database router for the analytics snapshot.
+
+Reads go to the 'analytics' alias only inside reporting_reads(True), which
+the @reporting view decorator (management/snapshots.py) opens around report
+views. The flag is a context variable, so it follows the request into the
+thread or task that runs it and never leaks into other requests. Writes
+always go to 'default', and nothing is ever migrated on the snapshot: it is
+a byte-for-byte copy of 'default'.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+ANALYTICS_DB = 'analytics'
+
+_reporting = ContextVar('reporting', default=False)
+
+
+@contextmanager
+def reporting_reads(enabled=True):
+    token = _reporting.set(enabled)
+    try:
+        yield
+    finally:
+        _reporting.reset(token)
+
+
+class AnalyticsRouter:
+    def db_for_read(self, model, **hints):
+        return ANALYTICS_DB if _reporting.get() else None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Snapshot rows are copies of 'default' rows.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return False if db == ANALYTICS_DB else None
@@ -1,51 +1,160 @@
 from rest_framework import serializers
-from django.db.models import Sum, F, Value, DecimalField
+from rest_framework.permissions import SAFE_METHODS
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Sum, F, Value, DecimalField, Prefetch, Count, Max
 from django.db.models.functions import Coalesce
 from datetime import date
 
 from .models import (
     Customer, Book, Publisher, Invoice, InvoiceItem,
-    Payment, Author, RouteAxis, CreditNote, CreditNoteItem
+    Payment, Author, RouteAxis, CreditNote, CreditNoteItem,
+    ArchivedInvoice, ArchivedInvoiceItem, ArchivedPayment, CatalogueAudit
 )
+from .ledger import customer_balance_annotations, invoice_balance_annotations, invoice_credited_subquery
+from .referrals import would_create_cycle
+
+# How many history rows detail endpoints embed; clients may ask for up to
+# HISTORY_PREVIEW_MAX with ?history=N and page through the rest via the
+# /books/{id}/sales/ and /customers/{id}/invoices/ sub-resources.
+HISTORY_PREVIEW_LIMIT = 10
+HISTORY_PREVIEW_MAX = 100
+
+
+# --- Sparse fieldsets ---
+
+def parse_field_list(raw):
+    """Turn a ?fields=a,b,c style query parameter into a list of names."""
+    return [name.strip() for name in (raw or '').split(',') if name.strip()]
+
+
+class SparseFieldsetMixin:
+    """
+    Lets read requests trim a serializer with ?fields=id,name and swap a flat
+    relation for a nested object with ?expand=publisher (see
+    Meta.expandable_fields). Only the top-level serializer, the one built with
+    the request in its context, looks at the query string.
+
+    Meta.query_hints maps a field to the joins ('select'), prefetches
+    ('prefetch'), related columns ('only') and annotations ('annotate', name
+    to a function returning the expression) it needs, so optimize_queryset()
+    can load exactly what the requested fields render.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = kwargs.get('context', {}).get('request')
+        if request is None or request.method not in SAFE_METHODS:
+            return
+        fields = parse_field_list(request.query_params.get('fields'))
+        expand = parse_field_list(request.query_params.get('expand'))
+
+        for name, (serializer_class, options) in getattr(self.Meta, 'expandable_fields', {}).items():
+            if name in expand:
+                self.fields[name] = serializer_class(**options)
+        if fields:
+            for name in set(self.fields) - set(fields) - set(expand):
+                self.fields.pop(name)
+
+    @classmethod
+    def unknown_fields(cls, fields):
+        """Names in ?fields= that this serializer can neither render nor expand, in request order."""
+        known = set(cls().fields) | set(getattr(cls.Meta, 'expandable_fields', {}))
+        return [name for name in fields if name not in known]
+
+    @classmethod
+    def optimize_queryset(cls, queryset, fields, expand=()):
+        hints = getattr(cls.Meta, 'query_hints', {})
+        expandable = getattr(cls.Meta, 'expandable_fields', {})
+        declared = cls().fields
+        expand = [name for name in expand if name in expandable]
+
+        if not fields:
+            # Full shape: the view's own queryset already covers it, only add what expansions need.
+            for name in expand:
+                queryset = queryset.select_related(*hints.get(name, {}).get('select', ()))
+            return queryset
+
+        model = cls.Meta.model
+        select, prefetch, columns, annotations = [], [], ['pk'], {}
+        restrict_columns = not expand
+        for name in [*fields, *expand]:
+            if name in hints:
+                select += hints[name].get('select', [])
+                prefetch += [p for p in hints[name].get('prefetch', []) if p not in prefetch]
+                columns += hints[name].get('only', [])
+                annotations.update(hints[name].get('annotate', {}))
+            elif name in declared:
+                try:
+                    model_field = model._meta.get_field(declared[name].source)
+                except FieldDoesNotExist:
+                    model_field = None
+                if model_field is not None and model_field.concrete:
+                    columns.append(model_field.name)
+                else:
+                    restrict_columns = False
+
+        queryset = queryset.select_related(None).prefetch_related(None)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        if restrict_columns:
+            queryset = queryset.only(*columns)
+        # The view's queryset may already carry the annotation (e.g. to order by it).
+        missing = {name: make() for name, make in annotations.items() if name not in queryset.query.annotations}
+        if missing:
+            queryset = queryset.annotate(**missing)
+        return queryset
+
 
 # --- Base "Read" Serializers ---
-class PublisherSerializer(serializers.ModelSerializer):
+class PublisherSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Publisher
         fields = ['id', 'name', 'contact_person', 'phone_number']
 
-class AuthorSerializer(serializers.ModelSerializer):
+class AuthorSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Author
         fields = ['id', 'name']
 
-class RouteAxisSerializer(serializers.ModelSerializer):
+class RouteAxisSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = RouteAxis
         fields = ['id', 'name']
 
-class BookSerializer(serializers.ModelSerializer):
+class BookSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     publisher = serializers.StringRelatedField()
     author = serializers.StringRelatedField()
     class Meta:
         model = Book
         fields = ['id', 'title', 'author', 'publisher', 'price', 'quantity_in_stock']
+        expandable_fields = {'author': (AuthorSerializer, {'read_only': True}), 'publisher': (PublisherSerializer, {'read_only': True})}
+        query_hints = {
+            'author': {'select': ['author'], 'only': ['author__name']},
+            'publisher': {'select': ['publisher'], 'only': ['publisher__name']},
+        }
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     route_axis = serializers.StringRelatedField()
     referred_by = serializers.StringRelatedField()
     class Meta:
         model = Customer
         fields = ['id', 'school_name', 'route_axis', 'address', 'contact_person', 'phone_number', 'referred_by']
+        expandable_fields = {'route_axis': (RouteAxisSerializer, {'read_only': True})}
+        query_hints = {
+            'route_axis': {'select': ['route_axis'], 'only': ['route_axis__name']},
+            'referred_by': {'select': ['referred_by__route_axis'], 'only': ['referred_by__school_name', 'referred_by__route_axis__name']},
+        }
 
-class InvoiceItemSerializer(serializers.ModelSerializer):
+class InvoiceItemSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     book = serializers.StringRelatedField()
     book_id = serializers.IntegerField(source='book.id', read_only=True)
     class Meta:
         model = InvoiceItem
         fields = ['id', 'book', 'book_id', 'quantity', 'unit_price']
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = ['id', 'payment_date', 'amount', 'notes']
@@ -59,7 +168,7 @@ def get_credit_total_for_invoice(invoice_obj):
 
 # --- Complex "Read" and Detail Serializers ---
 
-class InvoiceSerializer(serializers.ModelSerializer):
+class InvoiceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     customer_name = serializers.CharField(source='customer.school_name', read_only=True)
     items = InvoiceItemSerializer(many=True, read_only=True)
     payments = PaymentSerializer(source='payment_set', many=True, read_only=True)
@@ -70,19 +179,33 @@ class InvoiceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Invoice
         fields = ['id', 'customer_name', 'invoice_date', 'due_date', 'status', 'items', 'payments', 'total_amount', 'amount_paid', 'credit_applied', 'balance_due']
+        expandable_fields = {'customer': (CustomerSerializer, {'read_only': True})}
+        query_hints = {
+            'customer_name': {'select': ['customer'], 'only': ['customer__school_name']},
+            'customer': {'select': ['customer__route_axis', 'customer__referred_by__route_axis']},
+            'items': {'prefetch': ['items__book']},
+            'payments': {'prefetch': ['payment_set']},
+            'total_amount': {'prefetch': ['items']},
+            'amount_paid': {'prefetch': ['payment_set']},
+            'credit_applied': {'annotate': {'credit_applied': invoice_credited_subquery}},
+            'balance_due': {'prefetch': ['items', 'payment_set'], 'annotate': {'credit_applied': invoice_credited_subquery}},
+        }
 
     def get_total_amount(self, obj):
         return sum(item.quantity * (item.unit_price or 0) for item in obj.items.all())
     def get_amount_paid(self, obj):
         return sum(payment.amount for payment in obj.payment_set.all())
     def get_credit_applied(self, obj):
+        # Use the ledger.invoice_credited_subquery() annotation when the queryset carries one.
+        if getattr(obj, 'credit_applied', None) is not None:
+            return obj.credit_applied
         return get_credit_total_for_invoice(obj)
     def get_balance_due(self, obj):
         return self.get_total_amount(obj) - self.get_amount_paid(obj) - self.get_credit_applied(obj)
 
-class DebtorInvoiceSerializer(serializers.ModelSerializer):
+class DebtorInvoiceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     customer_name = serializers.CharField(source='customer.school_name', read_only=True)
-    customer_id = serializers.IntegerField(source='customer.id', read_only=True)
+    customer_id = serializers.IntegerField(read_only=True)
     days_overdue = serializers.SerializerMethodField()
     total_amount = serializers.SerializerMethodField()
     amount_paid = serializers.SerializerMethodField()
@@ -91,62 +214,168 @@ class DebtorInvoiceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Invoice
         fields = ['id', 'customer_name', 'customer_id', 'due_date', 'status', 'total_amount', 'amount_paid', 'credit_applied', 'balance_due', 'days_overdue']
+        query_hints = {
+            'customer_name': {'select': ['customer'], 'only': ['customer__school_name']},
+            'customer_id': {'only': ['customer']},
+            'days_overdue': {'only': ['due_date']},
+            'total_amount': {'prefetch': ['items']},
+            'amount_paid': {'prefetch': ['payment_set']},
+            'credit_applied': {'annotate': {'credit_applied': invoice_credited_subquery}},
+            'balance_due': {'prefetch': ['items', 'payment_set'], 'annotate': {'credit_applied': invoice_credited_subquery}},
+        }
     
     def get_days_overdue(self, obj):
         if obj.due_date and obj.due_date < date.today(): return (date.today() - obj.due_date).days
         return 0
     def get_total_amount(self, obj): return sum(item.quantity * (item.unit_price or 0) for item in obj.items.all())
     def get_amount_paid(self, obj): return sum(payment.amount for payment in obj.payment_set.all())
-    def get_credit_applied(self, obj): return get_credit_total_for_invoice(obj)
+    def get_credit_applied(self, obj):
+        # DebtorsListView annotates credit_applied; the query only runs for a bare instance.
+        if getattr(obj, 'credit_applied', None) is not None:
+            return obj.credit_applied
+        return get_credit_total_for_invoice(obj)
     def get_balance_due(self, obj): return self.get_total_amount(obj) - self.get_amount_paid(obj) - self.get_credit_applied(obj)
 
-class NestedInvoiceSerializer(serializers.ModelSerializer):
+class ArchivedInvoiceItemSerializer(serializers.ModelSerializer):
+    book = serializers.StringRelatedField()
+    class Meta:
+        model = ArchivedInvoiceItem
+        fields = ['id', 'book', 'book_id', 'quantity', 'unit_price']
+
+class ArchivedPaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedPayment
+        fields = ['id', 'payment_date', 'amount', 'notes']
+
+class ArchivedInvoiceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """InvoiceSerializer's shape for archived invoices. Expects ledger.archived_invoice_balance_annotations()."""
+    customer_name = serializers.CharField(source='customer.school_name', read_only=True)
+    items = ArchivedInvoiceItemSerializer(many=True, read_only=True)
+    payments = ArchivedPaymentSerializer(many=True, read_only=True)
+    total_amount = serializers.SerializerMethodField(); amount_paid = serializers.SerializerMethodField(); credit_applied = serializers.SerializerMethodField(); balance_due = serializers.SerializerMethodField()
+    archived = serializers.SerializerMethodField()
+    class Meta:
+        model = ArchivedInvoice
+        fields = ['id', 'customer_name', 'invoice_date', 'due_date', 'status', 'items', 'payments', 'total_amount', 'amount_paid', 'credit_applied', 'balance_due', 'archived']
+    def get_total_amount(self, obj): return obj.total_amount
+    def get_amount_paid(self, obj): return obj.amount_paid
+    def get_credit_applied(self, obj): return obj.credit_applied
+    def get_balance_due(self, obj): return obj.balance_due
+    def get_archived(self, obj): return True
+
+class NestedInvoiceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Expects an Invoice queryset annotated with ledger.invoice_balance_annotations()."""
     total_amount = serializers.SerializerMethodField(); amount_paid = serializers.SerializerMethodField(); credit_applied = serializers.SerializerMethodField(); balance_due = serializers.SerializerMethodField()
     class Meta:
         model = Invoice
         fields = ['id', 'invoice_date', 'status', 'total_amount', 'amount_paid', 'credit_applied', 'balance_due']
-    def get_total_amount(self, obj): return sum(item.quantity * (item.unit_price or 0) for item in obj.items.all())
-    def get_amount_paid(self, obj): return sum(payment.amount for payment in obj.payment_set.all())
-    def get_credit_applied(self, obj): return get_credit_total_for_invoice(obj)
-    def get_balance_due(self, obj): return self.get_total_amount(obj) - self.get_amount_paid(obj) - self.get_credit_applied(obj)
+    def get_total_amount(self, obj): return obj.total_amount
+    def get_amount_paid(self, obj): return obj.amount_paid
+    def get_credit_applied(self, obj): return obj.credit_applied
+    def get_balance_due(self, obj): return obj.balance_due
 
-class BookSaleHistorySerializer(serializers.ModelSerializer):
+class ArchivedNestedInvoiceSerializer(NestedInvoiceSerializer):
+    """NestedInvoiceSerializer for archived invoices. Expects ledger.archived_invoice_balance_annotations()."""
+    archived = serializers.SerializerMethodField()
+    class Meta:
+        model = ArchivedInvoice
+        fields = [*NestedInvoiceSerializer.Meta.fields, 'archived']
+    def get_archived(self, obj): return True
+
+
+def history_limit(context):
+    """Number of recent history rows a detail serializer should embed (?history=N)."""
+    request = context.get('request')
+    raw = request.query_params.get('history') if request is not None else None
+    if raw and raw.isdigit():
+        return min(int(raw), HISTORY_PREVIEW_MAX)
+    return HISTORY_PREVIEW_LIMIT
+
+class BookSaleHistorySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     customer_name = serializers.CharField(source='invoice.customer.school_name', read_only=True); invoice_id = serializers.IntegerField(source='invoice.id', read_only=True); date = serializers.DateField(source='invoice.invoice_date', read_only=True)
     class Meta: model = InvoiceItem; fields = ['invoice_id', 'date', 'customer_name', 'quantity', 'unit_price']
 
-class BookDetailSerializer(serializers.ModelSerializer):
-    author = AuthorSerializer(read_only=True); publisher = PublisherSerializer(read_only=True); sale_history = BookSaleHistorySerializer(many=True, read_only=True, source='invoiceitem_set')
-    class Meta: model = Book; fields = ['id', 'title', 'author', 'publisher', 'price', 'quantity_in_stock', 'sale_history']
+class ArchivedBookSaleHistorySerializer(BookSaleHistorySerializer):
+    archived = serializers.SerializerMethodField()
+    class Meta: model = ArchivedInvoiceItem; fields = [*BookSaleHistorySerializer.Meta.fields, 'archived']
+    def get_archived(self, obj): return True
 
-class ReferredCustomerSerializer(serializers.ModelSerializer):
+class BookDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    author = AuthorSerializer(read_only=True); publisher = PublisherSerializer(read_only=True); sale_history = serializers.SerializerMethodField(); lifetime_totals = serializers.SerializerMethodField()
+    class Meta:
+        model = Book
+        fields = ['id', 'title', 'author', 'publisher', 'price', 'quantity_in_stock', 'sale_history', 'lifetime_totals']
+        query_hints = {
+            'author': {'select': ['author'], 'only': ['author__name']},
+            'publisher': {'select': ['publisher'], 'only': ['publisher__name', 'publisher__contact_person', 'publisher__phone_number']},
+            'sale_history': {},
+            'lifetime_totals': {'select': ['archive_summary']},
+        }
+    def get_sale_history(self, obj):
+        recent = InvoiceItem.objects.filter(book=obj).select_related('invoice__customer').order_by('-invoice__invoice_date', '-id')[:history_limit(self.context)]
+        return BookSaleHistorySerializer(recent, many=True).data
+    def get_lifetime_totals(self, obj):
+        totals = InvoiceItem.objects.filter(book=obj).aggregate(
+            units_sold=Coalesce(Sum('quantity'), Value(0)),
+            revenue=Coalesce(Sum(F('quantity') * F('unit_price')), Value(0), output_field=DecimalField()),
+            invoice_count=Count('invoice', distinct=True),
+            last_sold=Max('invoice__invoice_date'),
+        )
+        archived = getattr(obj, 'archive_summary', None)
+        if archived is not None:
+            totals['units_sold'] += archived.units_sold
+            totals['invoice_count'] += archived.invoice_count
+            totals['revenue'] += archived.revenue
+        return totals
+
+class ReferredCustomerSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta: model = Customer; fields = ['id', 'school_name', 'route_axis']
 
-class CustomerDetailSerializer(serializers.ModelSerializer):
-    route_axis = serializers.StringRelatedField(); referred_by = ReferredCustomerSerializer(read_only=True); invoices = NestedInvoiceSerializer(many=True, read_only=True, source='invoice_set'); referred_customers = ReferredCustomerSerializer(many=True, read_only=True)
+class CustomerDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    route_axis = serializers.StringRelatedField(); referred_by = ReferredCustomerSerializer(read_only=True); invoices = serializers.SerializerMethodField(); referred_customers = ReferredCustomerSerializer(many=True, read_only=True); lifetime_totals = serializers.SerializerMethodField()
     class Meta:
         model = Customer
-        fields = ['id', 'school_name', 'route_axis', 'address', 'contact_person', 'phone_number', 'referred_by', 'invoices', 'referred_customers']
+        fields = ['id', 'school_name', 'route_axis', 'address', 'contact_person', 'phone_number', 'referred_by', 'invoices', 'referred_customers', 'lifetime_totals']
+        query_hints = {
+            'route_axis': {'select': ['route_axis'], 'only': ['route_axis__name']},
+            'referred_by': {'select': ['referred_by'], 'only': ['referred_by__school_name', 'referred_by__route_axis']},
+            'invoices': {},
+            'referred_customers': {'prefetch': ['referred_customers']},
+            'lifetime_totals': {},
+        }
+    def get_invoices(self, obj):
+        recent = Invoice.objects.filter(customer=obj).annotate(**invoice_balance_annotations()).order_by('-invoice_date', '-id')[:history_limit(self.context)]
+        return NestedInvoiceSerializer(recent, many=True).data
+    def get_lifetime_totals(self, obj):
+        return Customer.objects.filter(pk=obj.pk).annotate(
+            invoice_count=Count('invoice') + Coalesce(F('archive_summary__invoice_count'), Value(0)), **customer_balance_annotations()
+        ).values('invoice_count', 'total_invoiced', 'total_paid', 'total_credited', 'outstanding_balance').first()
 
 # THIS IS THE NEWLY ADDED SERIALIZER
-class AuthorDetailSerializer(serializers.ModelSerializer):
+class AuthorDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     books = BookSerializer(many=True, read_only=True, source='book_set')
     class Meta:
         model = Author
         fields = ['id', 'name', 'books']
+        query_hints = {'books': {'prefetch': ['book_set__publisher']}}
 
 # THIS IS THE NEWLY ADDED SERIALIZER
-class PublisherDetailSerializer(serializers.ModelSerializer):
+class PublisherDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     books = BookSerializer(many=True, read_only=True, source='book_set')
     class Meta:
         model = Publisher
         fields = ['id', 'name', 'contact_person', 'phone_number', 'books']
+        query_hints = {'books': {'prefetch': ['book_set__author']}}
 
 # THIS IS THE NEWLY ADDED SERIALIZER
-class RouteAxisDetailSerializer(serializers.ModelSerializer):
+class RouteAxisDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     customers = CustomerSerializer(many=True, read_only=True, source='customer_set')
     class Meta:
         model = RouteAxis
         fields = ['id', 'name', 'customers']
+        query_hints = {
+            'customers': {'prefetch': [Prefetch('customer_set', queryset=Customer.objects.select_related('route_axis', 'referred_by__route_axis'))]},
+        }
 
 
 # --- "Write" Serializers for Creating/Updating Data ---
@@ -157,6 +386,10 @@ class CustomerWriteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = ['school_name', 'contact_person', 'phone_number', 'address', 'route_axis_id', 'referred_by_id']
+    def validate_referred_by_id(self, value):
+        if value and self.instance is not None and would_create_cycle(self.instance.pk, value):
+            raise serializers.ValidationError("A school cannot be referred by itself or by a school in its own referral downline.")
+        return value
     def create(self, validated_data):
         route_axis_id = validated_data.pop('route_axis_id'); axis = RouteAxis.objects.get(id=route_axis_id); referred_by_id = validated_data.pop('referred_by_id', None); referred_by = None
         if referred_by_id: referred_by = Customer.objects.get(id=referred_by_id)
@@ -197,6 +430,9 @@ class InvoiceWriteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Invoice
         fields = ['customer_id', 'due_date', 'status', 'items']
+    # One transaction for the invoice, its items and the stock moves, so
+    # dashboards get a single event for the whole invoice.
+    @transaction.atomic
     def create(self, validated_data):
         items_data = validated_data.pop('items')
         for item_data in items_data:
@@ -213,6 +449,11 @@ class InvoiceWriteSerializer(serializers.ModelSerializer):
             book.quantity_in_stock -= item_data['quantity']; book.save()
         return invoice
 
+class CatalogueAuditSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CatalogueAudit
+        fields = ['id', 'operation', 'parameters', 'affected', 'details', 'notes', 'created_at']
+
 class CreditNoteItemWriteSerializer(serializers.ModelSerializer):
     book_id = serializers.IntegerField()
     class Meta:
@@ -224,6 +465,7 @@ class CreditNoteWriteSerializer(serializers.ModelSerializer):
     class Meta:
         model = CreditNote
         fields = ['customer', 'original_invoice', 'reason', 'items']
+    @transaction.atomic
     def create(self, validated_data):
         items_data = validated_data.pop('items')
         credit_note = CreditNote.objects.create(**validated_data)
@@ -0,0 +1,187 @@
+"""
+Model signal handlers for the management app. Wired up in ManagementConfig.ready().
+"""
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import events, referrals
+from .cache import REFERENCE, SALES, detail_cache
+from .models import (
+    Author, Book, CreditNote, CreditNoteItem, Customer, Invoice, InvoiceItem, Payment, Publisher, RouteAxis, Tombstone
+)
+
+# Models with a feed in management/sync.py. Items, payments and credit notes
+# travel inside their invoice, whose updated_at they touch.
+SYNCED_MODELS = [Author, Book, Customer, Invoice, Publisher, RouteAxis]
+
+
+# --- Referral closure table ---
+
+@receiver(post_init, sender=Customer)
+def remember_referrer(sender, instance, **kwargs):
+    # Read straight from __dict__ so a deferred field is never fetched here.
+    instance._saved_referred_by_id = instance.__dict__.get('referred_by_id')
+
+
+@receiver(pre_save, sender=Customer)
+def guard_referral_cycle(sender, instance, **kwargs):
+    if instance.pk and referrals.would_create_cycle(instance.pk, instance.referred_by_id):
+        raise referrals.ReferralCycleError(f"Customer {instance.referred_by_id} is in the downline of customer {instance.pk}.")
+
+
+@receiver(post_save, sender=Customer)
+def sync_referral_paths(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        referrals.attach_customers([instance])
+    elif instance.referred_by_id != getattr(instance, '_saved_referred_by_id', None):
+        referrals.move_customer(instance.pk, instance.referred_by_id)
+    instance._saved_referred_by_id = instance.referred_by_id
+
+
+@receiver(pre_delete, sender=Customer)
+def detach_referral_paths(sender, instance, **kwargs):
+    referrals.detach_customer(instance.pk)
+
+
+# --- Detail response cache versions ---
+
+def _invoice_customer_id(instance):
+    # Creating items and payments usually goes through an Invoice already in memory.
+    if type(instance).invoice.is_cached(instance):
+        return instance.invoice.customer_id
+    return Invoice.objects.filter(pk=instance.invoice_id).values_list('customer_id', flat=True).first()
+
+
+@receiver(post_init, sender=Book)
+def remember_title(sender, instance, **kwargs):
+    instance._saved_title = instance.__dict__.get('title')
+
+
+@receiver([post_save, post_delete], sender=Book)
+def bump_book(sender, instance, **kwargs):
+    objects = [('book', instance.pk)]
+    if kwargs.get('created') is False and instance.title == getattr(instance, '_saved_title', instance.title):
+        detail_cache.bump(*objects)
+    else:
+        detail_cache.bump(*objects, REFERENCE)
+    instance._saved_title = instance.title
+
+
+# The school name and route axis are embedded in invoice and referral payloads;
+# the referrer's detail lists the schools it referred.
+CUSTOMER_EMBEDDED_FIELDS = ('school_name', 'route_axis_id')
+
+
+def _customer_cache_fields(instance):
+    return {name: instance.__dict__.get(name) for name in (*CUSTOMER_EMBEDDED_FIELDS, 'referred_by_id')}
+
+
+@receiver(post_init, sender=Customer)
+def remember_customer_fields(sender, instance, **kwargs):
+    instance._saved_cache_fields = _customer_cache_fields(instance)
+
+
+@receiver([post_save, post_delete], sender=Customer)
+def bump_customer(sender, instance, **kwargs):
+    saved, current = getattr(instance, '_saved_cache_fields', {}), _customer_cache_fields(instance)
+    objects = [('customer', instance.pk)]
+    if kwargs.get('created') is not False or any(saved.get(name) != current[name] for name in CUSTOMER_EMBEDDED_FIELDS):
+        objects.append(REFERENCE)
+    elif saved.get('referred_by_id') != current['referred_by_id']:
+        objects += [('customer', saved.get('referred_by_id')), ('customer', current['referred_by_id'])]
+    detail_cache.bump(*objects)
+    instance._saved_cache_fields = current
+
+
+@receiver([post_save, post_delete], sender=Author)
+@receiver([post_save, post_delete], sender=Publisher)
+@receiver([post_save, post_delete], sender=RouteAxis)
+def bump_reference(sender, instance, **kwargs):
+    detail_cache.bump(REFERENCE)
+
+
+@receiver([post_save, post_delete], sender=Invoice)
+def bump_invoice(sender, instance, **kwargs):
+    detail_cache.bump(('invoice', instance.pk), ('customer', instance.customer_id))
+
+
+@receiver([post_save, post_delete], sender=InvoiceItem)
+def bump_invoice_item(sender, instance, **kwargs):
+    detail_cache.bump(('invoice', instance.invoice_id), ('customer', _invoice_customer_id(instance)), ('book', instance.book_id), SALES)
+
+
+@receiver([post_save, post_delete], sender=Payment)
+def bump_payment(sender, instance, **kwargs):
+    detail_cache.bump(('invoice', instance.invoice_id), ('customer', _invoice_customer_id(instance)))
+
+
+@receiver([post_save, post_delete], sender=CreditNote)
+def bump_credit_note(sender, instance, **kwargs):
+    detail_cache.bump(('invoice', instance.original_invoice_id), ('customer', instance.customer_id))
+
+
+@receiver([post_save, post_delete], sender=CreditNoteItem)
+def bump_credit_note_item(sender, instance, **kwargs):
+    credit_note = CreditNote.objects.filter(pk=instance.credit_note_id).values('original_invoice_id', 'customer_id').first() or {}
+    detail_cache.bump(
+        ('invoice', credit_note.get('original_invoice_id')), ('customer', credit_note.get('customer_id')), ('book', instance.book_id), SALES
+    )
+
+
+# --- Delta-sync change feed ---
+
+def record_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.pk)
+
+
+# Connected per model: a receiver without a sender would make every delete in
+# the project (Tombstone pruning, sessions, closure rows) skip the fast path.
+for model in SYNCED_MODELS:
+    post_delete.connect(record_tombstone, sender=model, dispatch_uid=f'record_tombstone_{model._meta.label_lower}')
+
+
+@receiver([post_save, post_delete], sender=InvoiceItem)
+@receiver([post_save, post_delete], sender=Payment)
+def touch_invoice(sender, instance, **kwargs):
+    # The invoice feed embeds items and payments, so a change to either is a change to the invoice.
+    Invoice.objects.filter(pk=instance.invoice_id).update(updated_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=CreditNote)
+def touch_credited_invoice(sender, instance, **kwargs):
+    Invoice.objects.filter(pk=instance.original_invoice_id).update(updated_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=CreditNoteItem)
+def touch_credited_invoice_for_item(sender, instance, **kwargs):
+    Invoice.objects.filter(creditnote=instance.credit_note_id).update(updated_at=timezone.now())
+
+
+# --- Dashboard push events ---
+
+@receiver([post_save, post_delete], sender=Invoice)
+@receiver([post_save, post_delete], sender=InvoiceItem)
+@receiver([post_save, post_delete], sender=Payment)
+def publish_invoice_change(sender, instance, **kwargs):
+    events.invoices_changed([instance.pk if sender is Invoice else instance.invoice_id])
+
+
+@receiver([post_save, post_delete], sender=CreditNote)
+def publish_credit_note_change(sender, instance, **kwargs):
+    events.invoices_changed([instance.original_invoice_id])
+
+
+@receiver([post_save, post_delete], sender=CreditNoteItem)
+def publish_credit_note_item_change(sender, instance, **kwargs):
+    events.invoices_changed(credit_note_ids=[instance.credit_note_id])
+
+
+@receiver([post_save, post_delete], sender=Customer)
+@receiver([post_save, post_delete], sender=Book)
+def publish_counter_change(sender, instance, created=True, **kwargs):
+    # Only creates and deletes move the dashboard counters.
+    if created:
+        events.counters_changed()
@@ -0,0 +1,137 @@
+"""
+Read-only analytics snapshot of the live database.
+
+refresh_snapshot() copies 'default' into a temporary file next to the
+snapshot with SQLite's online backup API, then renames it over the old one.
+Under WAL the copy is an ordinary reader, so clerks keep writing while it
+runs. Connections already open keep reading the old file until they close,
+which Django does at the end of each request. The snapshot's age is the
+modification time of that file, set to the moment the copy started.
+
+Views wrapped in @reporting send their reads to the snapshot (see
+management/routers.py) and say how old it is in the X-Snapshot-Age
+header. They kick off a background refresh when it is older than
+ANALYTICS_SNAPSHOT_MAX_AGE. Without a snapshot, or when 'default' is not
+SQLite, they read the live database as before.
+
+Only reports that may trail the ledger by a few minutes use it: business
+insights and the debtors ?format=table export. Customer statements and the
+on-screen debtors list always read the live database.
+"""
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+
+from .routers import ANALYTICS_DB, reporting_reads
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE = 300
+
+_refresh_lock = threading.Lock()
+
+
+def snapshot_path():
+    """Filesystem path of the snapshot, or None when there is no SQLite analytics alias."""
+    database = settings.DATABASES.get(ANALYTICS_DB)
+    if not database or database['ENGINE'] != 'django.db.backends.sqlite3':
+        return None
+    name = str(database['NAME'])
+    return urlsplit(name).path if name.startswith('file:') else name
+
+
+def snapshot_supported():
+    return snapshot_path() is not None and connections['default'].vendor == 'sqlite'
+
+
+def snapshot_taken_at():
+    """When the current snapshot was taken (a unix timestamp), or None if there is none."""
+    path = snapshot_path()
+    try:
+        return os.stat(path).st_mtime if path else None
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_age():
+    taken_at = snapshot_taken_at()
+    return None if taken_at is None else max(0.0, time.time() - taken_at)
+
+
+def refresh_snapshot():
+    """Copy the live database to the snapshot file. Returns the seconds the copy took."""
+    if not snapshot_supported():
+        raise RuntimeError('Analytics snapshots need SQLite for both the default and the analytics database.')
+    source, target = str(connections['default'].settings_dict['NAME']), snapshot_path()
+    started = time.time()
+    fd, temporary = tempfile.mkstemp(prefix='.snapshot-', suffix='.sqlite3', dir=os.path.dirname(target) or '.')
+    os.close(fd)
+    try:
+        live, copy = sqlite3.connect(source, timeout=30), sqlite3.connect(temporary)
+        try:
+            # One step: a WAL reader sees a consistent database and blocks no one.
+            live.backup(copy)
+            # The copy inherits WAL mode, which a read-only connection cannot open without its -shm file.
+            copy.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            live.close()
+            copy.close()
+        shutil.copymode(source, temporary)
+        os.utime(temporary, (started, started))
+        os.replace(temporary, target)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return time.time() - started
+
+
+def refresh_in_background():
+    """Start a refresh unless one is already running in this process."""
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            refresh_snapshot()
+        except Exception:
+            logger.exception('Refreshing the analytics snapshot failed.')
+        finally:
+            _refresh_lock.release()
+
+    threading.Thread(target=run, name='analytics-snapshot', daemon=True).start()
+    return True
+
+
+def reporting(view):
+    """
+    Decorator for read-only report views (functions or ViewSet methods): their
+    queries go to the analytics snapshot when there is one, and the response
+    carries X-Report-Source and, for the snapshot, X-Snapshot-Age in seconds.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        taken_at = snapshot_taken_at() if snapshot_supported() else None
+        age = None if taken_at is None else max(0, int(time.time() - taken_at))
+        if age is not None and age > getattr(settings, 'ANALYTICS_SNAPSHOT_MAX_AGE', DEFAULT_MAX_AGE):
+            refresh_in_background()
+        with reporting_reads(taken_at is not None):
+            response = view(*args, **kwargs)
+        if taken_at is None:
+            response['X-Report-Source'] = 'live'
+        else:
+            response['X-Report-Source'] = 'snapshot'
+            response['X-Snapshot-Age'] = str(age)
+            response['X-Snapshot-Taken-At'] = datetime.fromtimestamp(taken_at, tz=dt_timezone.utc).isoformat(timespec='seconds')
+        return response
+    return wrapper
@@ -0,0 +1,177 @@
+"""
+Customer account statements.
+
+One SQL statement builds the whole ledger of a customer: live and archived
+invoices (debits), payments and credit notes (credits) are unioned into one
+chronological list, a window function carries the running balance down it,
+and the opening and closing balances of the requested period come from the
+same CTE. Amounts are summed as whole kobo so a long history does not pick
+up floating-point error on SQLite.
+
+Lines are ordered by (date, kind, id) and paged with a keyset cursor on that
+triple, so the last page of a ten-year history costs the same as the first.
+"""
+import base64
+from datetime import date
+from decimal import Decimal
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.dateparse import parse_date
+
+from .models import (
+    ArchivedCreditNote, ArchivedCreditNoteItem, ArchivedInvoice, ArchivedInvoiceItem, ArchivedPayment,
+    CreditNote, CreditNoteItem, Invoice, InvoiceItem, Payment
+)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Same-day lines: the invoice first, then returns against it, then payments.
+KIND_ORDER = {'invoice': 0, 'credit_note': 1, 'payment': 2}
+
+
+class InvalidStatementCursor(ValueError):
+    pass
+
+
+def encode_cursor(line):
+    raw = f"{line['date'].isoformat()}|{KIND_ORDER[line['type']]}|{line['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        day, kind, pk = raw.split('|')
+        return date.fromisoformat(day), int(kind), int(pk)
+    except (TypeError, ValueError):
+        raise InvalidStatementCursor('Invalid statement cursor.')
+
+
+def _entries_sql():
+    """The UNION ALL of every ledger line of customer %(customer)s, amounts in kobo."""
+    tables = {
+        'invoice': Invoice._meta.db_table, 'invoice_item': InvoiceItem._meta.db_table,
+        'payment': Payment._meta.db_table,
+        'credit_note': CreditNote._meta.db_table, 'credit_note_item': CreditNoteItem._meta.db_table,
+    }
+    archived = {
+        'invoice': ArchivedInvoice._meta.db_table, 'invoice_item': ArchivedInvoiceItem._meta.db_table,
+        'payment': ArchivedPayment._meta.db_table,
+        'credit_note': ArchivedCreditNote._meta.db_table, 'credit_note_item': ArchivedCreditNoteItem._meta.db_table,
+    }
+    kobo = 'CAST(ROUND(COALESCE({}, 0) * 100) AS BIGINT)'
+    parts = []
+    for is_archived, t in ((0, tables), (1, archived)):
+        parts += [
+            f'''
+            SELECT 'invoice' AS kind, {KIND_ORDER['invoice']} AS seq, i.id AS entry_id, i.invoice_date AS entry_date,
+                   i.id AS invoice_id, '' AS memo, {is_archived} AS archived,
+                   {kobo.format(f"(SELECT SUM(li.quantity * li.unit_price) FROM {t['invoice_item']} li WHERE li.invoice_id = i.id)")} AS debit,
+                   0 AS credit
+            FROM {t['invoice']} i WHERE i.customer_id = %(customer)s
+            ''',
+            f'''
+            SELECT 'credit_note', {KIND_ORDER['credit_note']}, c.id, c.date, c.original_invoice_id, c.reason, {is_archived},
+                   0,
+                   {kobo.format(f"(SELECT SUM(ci.quantity * ci.unit_price) FROM {t['credit_note_item']} ci WHERE ci.credit_note_id = c.id)")}
+            FROM {t['credit_note']} c JOIN {t['invoice']} ci_invoice ON ci_invoice.id = c.original_invoice_id
+            WHERE ci_invoice.customer_id = %(customer)s
+            ''',
+            f'''
+            SELECT 'payment', {KIND_ORDER['payment']}, p.id, p.payment_date, p.invoice_id, p.notes, {is_archived},
+                   0, {kobo.format('p.amount')}
+            FROM {t['payment']} p JOIN {t['invoice']} p_invoice ON p_invoice.id = p.invoice_id
+            WHERE p_invoice.customer_id = %(customer)s
+            ''',
+        ]
+    return ' UNION ALL '.join(parts)
+
+
+def _money(kobo):
+    return (Decimal(int(kobo or 0)) / 100).quantize(Decimal('0.01'))
+
+
+def customer_statement(customer_id, start=None, end=None, cursor=None, limit=DEFAULT_PAGE_SIZE, using=None):
+    """
+    The statement of one customer between `start` and `end` (inclusive, either
+    may be None), `limit` lines at a time after `cursor`. Returns the period
+    totals, the lines with their running balance, and the cursor of the next
+    page (None on the last one).
+    """
+    after = decode_cursor(cursor) if cursor else None
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    params = {'customer': customer_id, 'start': start, 'end': end, 'limit': limit + 1}
+
+    conditions = []
+    if start:
+        conditions.append('entry_date >= %(start)s')
+    if end:
+        conditions.append('entry_date <= %(end)s')
+    in_period = ' AND '.join(conditions) or '1 = 1'
+    before_period = 'entry_date < %(start)s' if start else '1 = 0'
+    page_filter = in_period
+    if after:
+        params.update(after_date=after[0], after_seq=after[1], after_id=after[2])
+        page_filter += ' AND (entry_date, seq, entry_id) > (%(after_date)s, %(after_seq)s, %(after_id)s)'
+
+    sql = f'''
+        WITH entries AS ({_entries_sql()}),
+        ledger AS (
+            SELECT entries.*,
+                   SUM(debit - credit) OVER (ORDER BY entry_date, seq, entry_id ROWS UNBOUNDED PRECEDING) AS balance
+            FROM entries
+        ),
+        totals AS (
+            SELECT COALESCE(SUM(CASE WHEN {before_period} THEN debit - credit ELSE 0 END), 0) AS opening,
+                   COALESCE(SUM(CASE WHEN {in_period} THEN debit ELSE 0 END), 0) AS period_debits,
+                   COALESCE(SUM(CASE WHEN {in_period} THEN credit ELSE 0 END), 0) AS period_credits,
+                   COUNT(CASE WHEN {in_period} THEN 1 END) AS period_lines
+            FROM entries
+        ),
+        page AS (
+            SELECT * FROM ledger WHERE {page_filter}
+            ORDER BY entry_date, seq, entry_id
+            LIMIT %(limit)s
+        )
+        SELECT totals.opening, totals.period_debits, totals.period_credits, totals.period_lines,
+               page.kind, page.entry_id, page.entry_date, page.invoice_id, page.memo, page.archived,
+               page.debit, page.credit, page.balance
+        FROM totals LEFT JOIN page ON 1 = 1
+        ORDER BY page.entry_date, page.seq, page.entry_id
+    '''
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql, params)
+        rows = db_cursor.fetchall()
+
+    opening, debits, credits, count = rows[0][:4]
+    lines = [
+        {
+            'type': kind,
+            'id': entry_id,
+            'date': parse_date(entry_date) if isinstance(entry_date, str) else entry_date,
+            'invoice_id': invoice_id,
+            'memo': memo or '',
+            'archived': bool(archived),
+            'debit': _money(debit),
+            'credit': _money(credit),
+            'balance': _money(balance),
+        }
+        for *_, kind, entry_id, entry_date, invoice_id, memo, archived, debit, credit, balance in rows
+        if kind is not None
+    ]
+    has_more = len(lines) > limit
+    lines = lines[:limit]
+    return {
+        'customer_id': customer_id,
+        'from': start,
+        'to': end,
+        'opening_balance': _money(opening),
+        'total_debits': _money(debits),
+        'total_credits': _money(credits),
+        'closing_balance': _money(opening + debits - credits),
+        'line_count': count,
+        'lines': lines,
+        'next_cursor': encode_cursor(lines[-1]) if has_more else None,
+    }
@@ -0,0 +1,87 @@
+"""
+Delta-sync change feed.
+
+Clients keep a local replica and call GET /api/changes/?since=<token> to get
+only the rows created, updated or deleted after the token. Updates are found
+through the indexed `updated_at` columns. Deletes come from Tombstone rows.
+Item, payment and credit-note writes touch their invoice's `updated_at`
+(see management/signals.py), so an invoice's nested payload is re-sent
+whenever any part of it changes.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .ledger import invoice_credited_subquery
+from .models import Author, Book, Customer, Invoice, Publisher, RouteAxis, Tombstone
+from .serializers import (
+    AuthorSerializer, BookSerializer, CustomerSerializer, InvoiceSerializer, PublisherSerializer, RouteAxisSerializer
+)
+
+# feed name -> (model, queryset factory, serializer)
+FEEDS = {
+    'customers': (Customer, lambda: Customer.objects.select_related('route_axis', 'referred_by__route_axis'), CustomerSerializer),
+    'books': (Book, lambda: Book.objects.select_related('author', 'publisher'), BookSerializer),
+    'invoices': (
+        Invoice,
+        lambda: Invoice.objects.select_related('customer').prefetch_related('items__book', 'payment_set').annotate(
+            credit_applied=invoice_credited_subquery()
+        ),
+        InvoiceSerializer,
+    ),
+    'authors': (Author, lambda: Author.objects.all(), AuthorSerializer),
+    'publishers': (Publisher, lambda: Publisher.objects.all(), PublisherSerializer),
+    'route_axes': (RouteAxis, lambda: RouteAxis.objects.all(), RouteAxisSerializer),
+}
+
+
+class InvalidSyncToken(ValueError):
+    pass
+
+
+def encode_token(moment):
+    return str(int(moment.timestamp() * 1_000_000))
+
+
+def decode_token(token):
+    try:
+        return datetime.fromtimestamp(int(token) / 1_000_000, tz=dt_timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise InvalidSyncToken('Invalid sync token.')
+
+
+def changes_since(token=None, feeds=None):
+    """
+    Collect the changes for the requested feeds. With no token, or one older
+    than the tombstone retention window, every row is returned and `reset` is
+    set, so the client knows to replace its replica rather than merge.
+    """
+    started = timezone.now()
+    since = decode_token(token) if token else None
+    retention = timedelta(days=getattr(settings, 'SYNC_TOMBSTONE_RETENTION_DAYS', 90))
+    reset = since is None or since < started - retention
+
+    changes = {}
+    for name in feeds or FEEDS:
+        model, queryset, serializer_class = FEEDS[name]
+        rows = queryset()
+        deleted = []
+        if not reset:
+            rows = rows.filter(updated_at__gte=since)
+            deleted = list(Tombstone.objects.filter(
+                model=model._meta.model_name, deleted_at__gte=since
+            ).values_list('object_id', flat=True).distinct())
+        changes[name] = {'updated': serializer_class(rows.order_by('pk'), many=True).data, 'deleted': deleted}
+
+    # Hand back a token a little before this request started: a write whose
+    # transaction was still open now will have an updated_at before `started`
+    # but commit after it. Rows in the overlap are simply sent twice.
+    overlap = timedelta(seconds=getattr(settings, 'SYNC_OVERLAP_SECONDS', 5))
+    return {'token': encode_token(started - overlap), 'reset': reset, 'changes': changes}
+
+
+def prune_tombstones():
+    cutoff = timezone.now() - timedelta(days=getattr(settings, 'SYNC_TOMBSTONE_RETENTION_DAYS', 90))
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
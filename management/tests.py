@@ -1,3 +1,878 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, router as django_router
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import events
+from .archive import archive_settled_invoices
+from .cache import detail_cache
+from .importers import import_file
+from .models import (
+    ArchivedInvoice, Author, Book, CreditNote, CreditNoteItem, Customer, CustomerArchiveSummary, Invoice, InvoiceItem,
+    Payment, Publisher, RouteAxis, Tombstone
+)
+from .renderers import ORJSONRenderer
+from .routers import AnalyticsRouter, reporting_reads
+from .snapshots import reporting
+from .statements import MAX_PAGE_SIZE, customer_statement
+from .writes import run_write
+
+
+class LedgerFixtures:
+    """Small builders for the catalogue and ledger rows the API tests need."""
+
+    @classmethod
+    def make_book(cls, title='Primer', price='100.00', stock=50):
+        author, _ = Author.objects.get_or_create(name='A. Author')
+        publisher, _ = Publisher.objects.get_or_create(name='Pub House')
+        return Book.objects.create(title=title, author=author, publisher=publisher, price=Decimal(price), quantity_in_stock=stock)
+
+    @classmethod
+    def make_customer(cls, name='School', referred_by=None):
+        route, _ = RouteAxis.objects.get_or_create(name='North')
+        phone = f'080{Customer.objects.count():08d}'
+        return Customer.objects.create(
+            school_name=name, route_axis=route, address='1 Road', contact_person='Head', phone_number=phone, referred_by=referred_by
+        )
+
+    @classmethod
+    def make_invoice(cls, customer, book, quantity=2, unit_price='100.00', paid=None, credited=None, due_in=30, **extra):
+        invoice = Invoice.objects.create(customer=customer, due_date=date.today() + timedelta(days=due_in), **extra)
+        InvoiceItem.objects.create(invoice=invoice, book=book, quantity=quantity, unit_price=Decimal(unit_price))
+        if paid:
+            Payment.objects.create(invoice=invoice, amount=Decimal(paid))
+        if credited:
+            note = CreditNote.objects.create(customer=customer, original_invoice=invoice, reason='Returns')
+            CreditNoteItem.objects.create(credit_note=note, book=book, quantity=1, unit_price=Decimal(credited))
+        return invoice
+
+
+class APITestBase(LedgerFixtures, TestCase):
+    """Reads the test database, never a developer's analytics snapshot."""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Primary keys restart with every test; versions and payloads must too.
+        detail_cache.backend.clear()
+        patcher = mock.patch('management.snapshots.snapshot_supported', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def count_queries(client, url):
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url)
+    return response, len(queries)
+
+
+class InvoiceListQueryTests(APITestBase):
+    """?fields= and the full invoice/debtor lists cost the same number of queries for 2 or 8 invoices."""
+
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book()
+        self.customer = self.make_customer()
+
+    def add_invoices(self, count):
+        for _ in range(count):
+            self.make_invoice(self.customer, self.book, paid='50.00', credited='20.00')
+
+    def assert_constant(self, url):
+        self.add_invoices(2)
+        _, few = count_queries(self.client, url)
+        self.add_invoices(6)
+        response, many = count_queries(self.client, url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(few, many, url)
+        return response
+
+    def test_invoice_list(self):
+        response = self.assert_constant('/api/invoices/')
+        row = response.json()[0]
+        self.assertEqual(Decimal(str(row['credit_applied'])), Decimal('20.00'))
+        self.assertEqual(Decimal(str(row['balance_due'])), Decimal('130.00'))
+
+    def test_invoice_credit_fields_only(self):
+        response = self.assert_constant('/api/invoices/?fields=id,credit_applied')
+        self.assertEqual(set(response.json()[0]), {'id', 'credit_applied'})
+
+    def test_debtors_list(self):
+        response = self.assert_constant('/api/debtors/')
+        row = response.json()[0]
+        self.assertEqual(row['customer_id'], self.customer.pk)
+        self.assertEqual(Decimal(str(row['balance_due'])), Decimal('130.00'))
+
+    def test_debtor_customer_fields_only(self):
+        response = self.assert_constant('/api/debtors/?fields=id,customer_id,credit_applied')
+        self.assertEqual(response.json()[0]['customer_id'], self.customer.pk)
+
+    def test_unknown_fields_are_rejected_by_name(self):
+        invoice = self.make_invoice(self.customer, self.book)
+        for url in ('/api/invoices/', f'/api/invoices/{invoice.pk}/', '/api/debtors/', '/api/books/'):
+            response = self.client.get(url + '?fields=id,colour,size')
+            self.assertEqual(response.status_code, 400, url)
+            self.assertEqual(response.json(), {'error': 'Unknown field(s): colour, size.'}, url)
+        self.assertEqual(self.client.get('/api/books/?fields=id,publisher&expand=publisher').status_code, 200)
+
+    def test_credit_note_create_ignores_fields(self):
+        invoice = self.make_invoice(self.customer, self.book)
+        response = self.client.post('/api/credit-notes/?fields=id', {
+            'customer': self.customer.pk, 'original_invoice': invoice.pk, 'reason': 'Damaged',
+            'items': [{'book_id': self.book.pk, 'quantity': 1, 'unit_price': '100.00'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(set(response.json()), {'customer', 'original_invoice', 'reason', 'items'})
+
+
+class ReferralClosureTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.root = self.make_customer('Root')
+        self.child = self.make_customer('Child', referred_by=self.root)
+        self.grandchild = self.make_customer('Grandchild', referred_by=self.child)
+        self.other = self.make_customer('Other')
+
+    def test_downline_is_nested_tree(self):
+        response = self.client.get(f'/api/customers/{self.root.pk}/downline/')
+        self.assertEqual(response.status_code, 200)
+        tree = response.json()
+        self.assertEqual(tree['id'], self.root.pk)
+        [child] = tree['referred_customers']
+        self.assertEqual((child['id'], child['depth']), (self.child.pk, 1))
+        self.assertEqual([node['id'] for node in child['referred_customers']], [self.grandchild.pk])
+
+    def test_downline_max_depth(self):
+        tree = self.client.get(f'/api/customers/{self.root.pk}/downline/?max_depth=1').json()
+        self.assertEqual(tree['referred_customers'][0]['referred_customers'], [])
+
+    def test_moving_a_referrer_moves_the_subtree(self):
+        self.child.referred_by = self.other
+        self.child.save()
+        self.assertEqual(self.client.get(f'/api/customers/{self.root.pk}/downline/').json()['referred_customers'], [])
+        stats = self.client.get(f'/api/customers/{self.other.pk}/referral_stats/').json()
+        self.assertEqual((stats['downline_size'], stats['downline_depth']), (2, 2))
+
+    def test_cycle_is_rejected(self):
+        response = self.client.patch(f'/api/customers/{self.root.pk}/', {'referred_by_id': self.grandchild.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_referral_stats_sum_downline_balances(self):
+        book = self.make_book()
+        self.make_invoice(self.child, book, quantity=2, unit_price='100.00', paid='50.00')
+        self.make_invoice(self.grandchild, book, quantity=1, unit_price='100.00', credited='10.00')
+        stats = self.client.get(f'/api/customers/{self.root.pk}/referral_stats/').json()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(Decimal(str(stats['total_invoiced'])), Decimal('300.00'))
+        self.assertEqual(Decimal(str(stats['outstanding_balance'])), Decimal('240.00'))
+
+    def test_unknown_or_malformed_pk_is_404(self):
+        for pk in ('999999', 'abc'):
+            for endpoint in ('downline', 'referral_stats'):
+                self.assertEqual(self.client.get(f'/api/customers/{pk}/{endpoint}/').status_code, 404, (pk, endpoint))
+
+
+class RouteOperationsTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.primer, self.reader = self.make_book('Primer'), self.make_book('Reader', price='50.00')
+        self.alpha, self.beta = self.make_customer('Alpha'), self.make_customer('Beta')
+        self.route = self.alpha.route_axis
+        self.make_invoice(self.alpha, self.primer, quantity=3, paid='100.00')
+        self.make_invoice(self.beta, self.primer, quantity=2, credited='100.00')
+        self.make_invoice(self.beta, self.reader, quantity=4, unit_price='50.00')
+        old = self.make_invoice(self.alpha, self.reader, quantity=7, unit_price='50.00', paid='350.00')
+        Invoice.objects.filter(pk=old.pk).update(invoice_date=date.today() - timedelta(days=60))
+        elsewhere = self.make_customer('Elsewhere')
+        elsewhere.route_axis = RouteAxis.objects.create(name='South')
+        elsewhere.save()
+        self.make_invoice(elsewhere, self.primer, quantity=9)
+
+    def operations(self, query=''):
+        return count_queries(self.client, f'/api/route-axes/{self.route.pk}/operations/{query}')
+
+    def test_pick_list_totals_books_over_the_route_and_period(self):
+        since = (date.today() - timedelta(days=30)).isoformat()
+        data = self.operations(f'?from={since}')[0].json()
+        self.assertEqual(
+            [(row['title'], row['quantity'], row['schools']) for row in data['pick_list']],
+            [('Primer', 5, 2), ('Reader', 4, 1)],
+        )
+        self.assertEqual(data['total_units'], 9)
+        everything = self.operations()[0].json()
+        self.assertEqual(everything['total_units'], 16)
+
+    def test_balances_net_payments_and_credits(self):
+        data = self.operations()[0].json()
+        balances = {row['school_name']: Decimal(str(row['outstanding_balance'])) for row in data['schools']}
+        self.assertEqual(balances, {'Alpha': Decimal('200.00'), 'Beta': Decimal('300.00')})
+        self.assertEqual(Decimal(str(data['total_outstanding'])), Decimal('500.00'))
+
+    def test_query_count_does_not_grow_with_the_route(self):
+        _, before = self.operations()
+        for n in range(5):
+            self.make_invoice(self.make_customer(f'New {n}'), self.reader)
+        response, after = self.operations()
+        self.assertEqual(len(response.json()['schools']), 7)
+        self.assertEqual(before, after)
+        self.assertLessEqual(after, 3)
+
+    def test_unknown_or_malformed_pk_and_bad_dates(self):
+        for pk in ('999999', 'abc'):
+            self.assertEqual(self.client.get(f'/api/route-axes/{pk}/operations/').status_code, 404, pk)
+        self.assertEqual(self.operations('?from=yesterday')[0].status_code, 400)
+
+
+class HistoryEndpointTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book()
+        self.customer = self.make_customer()
+        for _ in range(12):
+            self.make_invoice(self.customer, self.book, quantity=1, unit_price='10.00')
+
+    def test_detail_embeds_bounded_history_with_lifetime_totals(self):
+        detail = self.client.get(f'/api/customers/{self.customer.pk}/').json()
+        self.assertEqual(len(detail['invoices']), 10)
+        self.assertEqual(detail['lifetime_totals']['invoice_count'], 12)
+        self.assertEqual(len(self.client.get(f'/api/customers/{self.customer.pk}/?history=3').json()['invoices']), 3)
+        book = self.client.get(f'/api/books/{self.book.pk}/').json()
+        self.assertEqual((len(book['sale_history']), book['lifetime_totals']['units_sold']), (10, 12))
+
+    def test_history_sub_resources_page_through_everything(self):
+        page = self.client.get(f'/api/customers/{self.customer.pk}/invoices/?page_size=5&page=3').json()
+        self.assertEqual((page['count'], len(page['results'])), (12, 2))
+        self.assertEqual(Decimal(str(page['results'][0]['balance_due'])), Decimal('10.00'))
+        sales = self.client.get(f'/api/books/{self.book.pk}/sales/?page_size=5').json()
+        self.assertEqual((sales['count'], len(sales['results'])), (12, 5))
+
+    def test_unknown_or_malformed_pk_is_404(self):
+        for url in ('/api/customers/abc/invoices/', '/api/customers/999999/invoices/', '/api/books/abc/sales/', '/api/books/999999/sales/'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+
+class ResponseFormatTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        for index in range(30):
+            self.make_book(title=f'Title {index} ', price='12.50')
+
+    def test_json_matches_the_stock_encoder(self):
+        data = self.client.get('/api/books/').data
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_table_format_sends_columns_once(self):
+        table = self.client.get('/api/books/?format=table&fields=id,title,price').json()
+        self.assertEqual(table['columns'], ['id', 'title', 'price'])
+        self.assertEqual(len(table['rows']), 30)
+        self.assertEqual(table['rows'][0][2], '12.50')
+
+    def test_large_responses_are_compressed_for_clients_that_accept_it(self):
+        response = self.client.get('/api/books/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))), 30)
+        self.assertFalse(self.client.get('/api/books/').has_header('Content-Encoding'))
+
+
+class ArchiveTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book()
+        self.customer = self.make_customer()
+        for _ in range(20):
+            self.make_invoice(self.customer, self.book, quantity=2, unit_price='50.00', paid='90.00', credited='10.00', status='PAID')
+        self.open_invoice = self.make_invoice(self.customer, self.book, quantity=1, unit_price='30.00')
+        Invoice.objects.update(invoice_date=date.today() - timedelta(days=400))
+        self.before = self.client.get(f'/api/customers/{self.customer.pk}/').json()['lifetime_totals']
+
+    def test_moves_settled_invoices_and_keeps_lifetime_totals(self):
+        counts = archive_settled_invoices(chunk_size=8)
+        self.assertEqual((counts['invoices'], counts['items'], counts['payments'], counts['credit_note_items']), (20, 20, 20, 20))
+        self.assertEqual(list(Invoice.objects.values_list('id', flat=True)), [self.open_invoice.pk])
+        self.assertEqual(ArchivedInvoice.objects.count(), 20)
+        self.assertFalse(CreditNote.objects.exists() or Payment.objects.exists())
+        self.assertEqual(self.client.get(f'/api/customers/{self.customer.pk}/').json()['lifetime_totals'], self.before)
+        listing = self.client.get('/api/invoices/?include_archived=1').json()
+        self.assertEqual((len(listing), sum(row.get('archived', False) for row in listing)), (21, 20))
+
+    def test_history_sub_resources_page_archived_rows_in_on_request(self):
+        Invoice.objects.filter(pk=self.open_invoice.pk).update(invoice_date=date.today() - timedelta(days=395))
+        archived_ids = sorted(Invoice.objects.filter(status='PAID').values_list('id', flat=True), reverse=True)
+        archive_settled_invoices()
+        invoices = f'/api/customers/{self.customer.pk}/invoices/'
+        sales = f'/api/books/{self.book.pk}/sales/'
+        self.assertEqual(self.client.get(invoices).json()['count'], 1)
+        self.assertEqual(self.client.get(sales).json()['count'], 1)
+
+        first = self.client.get(invoices + '?include_archived=1&page_size=8').json()
+        self.assertEqual(first['count'], 21)
+        self.assertEqual([row['id'] for row in first['results']], [self.open_invoice.pk, *archived_ids[:7]])
+        self.assertEqual([row.get('archived', False) for row in first['results'][:2]], [False, True])
+        self.assertEqual(Decimal(str(first['results'][1]['balance_due'])), Decimal('0.00'))
+        last = self.client.get(invoices + '?include_archived=1&page_size=8&page=3').json()
+        self.assertEqual([row['id'] for row in last['results']], archived_ids[15:])
+
+        sold = self.client.get(sales + '?include_archived=1&page_size=50').json()
+        self.assertEqual(sold['count'], 21)
+        self.assertEqual([row['invoice_id'] for row in sold['results']], [self.open_invoice.pk, *archived_ids])
+        self.assertEqual(sold['results'][1]['customer_name'], self.customer.school_name)
+
+    def test_one_bulk_delete_per_table_and_one_tombstone_per_invoice(self):
+        with CaptureQueriesContext(connection) as queries:
+            archive_settled_invoices(chunk_size=100)
+        self.assertLess(len(queries), 40)
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 5)
+        self.assertFalse(CreditNoteItem.objects.exists() or InvoiceItem.objects.exclude(invoice=self.open_invoice).exists())
+        self.assertEqual(Tombstone.objects.filter(model='invoice').count(), 20)
+        self.assertFalse(Tombstone.objects.exclude(model='invoice').exists())
+
+    def test_archived_invoice_leaves_the_sync_feed_and_its_cached_detail(self):
+        invoice_id = Invoice.objects.filter(status='PAID').values_list('id', flat=True).first()
+        self.assertEqual(self.client.get(f'/api/invoices/{invoice_id}/').status_code, 200)
+        token = self.client.get('/api/changes/?feeds=invoices').json()['token']
+        archive_settled_invoices()
+        self.assertEqual(self.client.get(f'/api/invoices/{invoice_id}/').status_code, 404)
+        feed = self.client.get(f'/api/changes/?feeds=invoices&since={token}').json()['changes']['invoices']
+        self.assertIn(invoice_id, feed['deleted'])
+
+
+class DetailCacheTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book()
+        self.referrer = self.make_customer('Referrer')
+        self.customer = self.make_customer('School', referred_by=self.referrer)
+        self.invoice = self.make_invoice(self.customer, self.book)
+
+    def assert_cached(self, url, cached=True):
+        response, queries = count_queries(self.client, url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries == 0, cached, url)
+        return response.json()
+
+    def warm(self, *urls):
+        for url in urls:
+            self.client.get(url)
+
+    def test_repeat_reads_are_served_from_cache(self):
+        self.warm(f'/api/invoices/{self.invoice.pk}/')
+        self.assert_cached(f'/api/invoices/{self.invoice.pk}/')
+        self.assert_cached(f'/api/invoices/{self.invoice.pk}/?fields=id', cached=False)
+
+    def test_payment_invalidates_invoice_and_customer(self):
+        urls = f'/api/invoices/{self.invoice.pk}/', f'/api/customers/{self.customer.pk}/', f'/api/books/{self.book.pk}/'
+        self.warm(*urls)
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('25.00'))
+        self.assertEqual(Decimal(str(self.assert_cached(urls[0], cached=False)['amount_paid'])), Decimal('25.00'))
+        self.assert_cached(urls[1], cached=False)
+        self.assert_cached(urls[2])
+
+    def test_contact_change_only_invalidates_the_customer(self):
+        urls = f'/api/customers/{self.customer.pk}/', f'/api/invoices/{self.invoice.pk}/', f'/api/customers/{self.referrer.pk}/'
+        self.warm(*urls)
+        self.customer.phone_number = '0809999999'
+        self.customer.save()
+        self.assert_cached(urls[0], cached=False)
+        self.assert_cached(urls[1])
+        self.assert_cached(urls[2])
+
+    def test_rename_invalidates_payloads_that_embed_the_name(self):
+        urls = f'/api/invoices/{self.invoice.pk}/', f'/api/customers/{self.referrer.pk}/'
+        self.warm(*urls)
+        self.customer.school_name = 'Renamed School'
+        self.customer.save()
+        self.assertEqual(self.assert_cached(urls[0], cached=False)['customer_name'], 'Renamed School')
+        self.assertEqual(self.assert_cached(urls[1], cached=False)['referred_customers'][0]['school_name'], 'Renamed School')
+
+    def test_new_referrer_invalidates_both_referrers(self):
+        other = self.make_customer('Other')
+        urls = f'/api/customers/{self.referrer.pk}/', f'/api/customers/{other.pk}/', f'/api/invoices/{self.invoice.pk}/'
+        self.warm(*urls)
+        self.customer.referred_by = other
+        self.customer.save()
+        self.assertEqual(self.assert_cached(urls[0], cached=False)['referred_customers'], [])
+        self.assertEqual(len(self.assert_cached(urls[1], cached=False)['referred_customers']), 1)
+        self.assert_cached(urls[2])
+
+
+class CustomerPaymentTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book()
+        self.customer = self.make_customer()
+        # Balances 200, 100 (after a credit) and 300, due in that order.
+        self.first = self.make_invoice(self.customer, self.book, quantity=2, unit_price='100.00', due_in=-20)
+        self.second = self.make_invoice(self.customer, self.book, quantity=1, unit_price='150.00', credited='50.00', due_in=-5)
+        self.third = self.make_invoice(self.customer, self.book, quantity=3, unit_price='100.00', due_in=10)
+
+    def pay(self, amount, customer=None):
+        return self.client.post(f'/api/customers/{(customer or self.customer).pk}/record_payment/', {'amount': amount}, format='json')
+
+    def test_allocates_oldest_due_first(self):
+        response = self.pay('350.00')
+        self.assertEqual(response.status_code, 200)
+        applied = [(row['invoice_id'], Decimal(str(row['applied'])), row['status']) for row in response.json()['allocations']]
+        self.assertEqual(applied, [
+            (self.first.pk, Decimal('200.00'), 'PAID'),
+            (self.second.pk, Decimal('100.00'), 'PAID'),
+            (self.third.pk, Decimal('50.00'), 'PARTIALLY_PAID'),
+        ])
+        self.assertEqual(Decimal(str(response.json()['outstanding_after'])), Decimal('250.00'))
+        statuses = dict(Invoice.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[i.pk] for i in (self.first, self.second, self.third)], ['PAID', 'PAID', 'PARTIALLY_PAID'])
+        self.assertEqual(Payment.objects.count(), 3)
+
+    def test_exact_outstanding_settles_everything(self):
+        response = self.pay('600.00')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(str(response.json()['outstanding_after'])), Decimal('0.00'))
+        self.assertEqual(set(Invoice.objects.values_list('status', flat=True)), {'PAID'})
+
+    def test_allocation_is_visible_to_cached_details(self):
+        self.client.get(f'/api/invoices/{self.first.pk}/')
+        self.pay('200.00')
+        self.assertEqual(self.client.get(f'/api/invoices/{self.first.pk}/').json()['status'], 'PAID')
+
+    def test_rejects_overpayment_and_bad_amounts(self):
+        # The open balances total exactly 600.00; not even a kobo more is taken.
+        for amount in ('600.01', '600.50'):
+            self.assertEqual(self.pay(amount).status_code, 400, amount)
+        for amount in ('0', '-5', 'abc', 'NaN'):
+            self.assertEqual(self.pay(amount).status_code, 400, amount)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_unknown_customer_and_customer_without_open_invoices(self):
+        for pk in ('999999', 'abc'):
+            self.assertEqual(self.client.post(f'/api/customers/{pk}/record_payment/', {'amount': '1'}).status_code, 404, pk)
+        self.assertEqual(self.pay('10.00', customer=self.make_customer('Debt Free')).status_code, 400)
+
+
+class SyncFeedTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book()
+        self.customer = self.make_customer()
+        self.invoice = self.make_invoice(self.customer, self.book)
+        self.quiet = self.make_invoice(self.customer, self.book)
+        self.token = self.client.get('/api/changes/').json()['token']
+        # Push everything written so far out of the token's overlap window.
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        for model in (Author, Book, Customer, Invoice, Publisher, RouteAxis):
+            model.objects.update(updated_at=an_hour_ago)
+
+    def changes(self, feeds):
+        response = self.client.get(f'/api/changes/?since={self.token}&feeds={feeds}')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['reset'])
+        return response.json()['changes']
+
+    def test_first_call_returns_everything(self):
+        body = self.client.get('/api/changes/?feeds=invoices,books').json()
+        self.assertTrue(body['reset'])
+        self.assertEqual(len(body['changes']['invoices']['updated']), 2)
+        self.assertEqual(set(body['changes']), {'invoices', 'books'})
+
+    def test_item_and_payment_writes_resend_their_invoice(self):
+        Payment.objects.create(invoice=self.invoice, amount=Decimal('10.00'))
+        invoices = self.changes('invoices')['invoices']
+        self.assertEqual([row['id'] for row in invoices['updated']], [self.invoice.pk])
+        self.assertEqual(Decimal(str(invoices['updated'][0]['amount_paid'])), Decimal('10.00'))
+
+    def test_deletes_come_back_as_tombstones(self):
+        invoice_id = self.invoice.pk
+        self.invoice.delete()
+        invoices = self.changes('invoices')['invoices']
+        self.assertEqual((invoices['updated'], invoices['deleted']), ([], [invoice_id]))
+        self.assertEqual(set(Tombstone.objects.values_list('model', flat=True)), {'invoice'})
+
+    def test_bad_token_and_unknown_feed(self):
+        self.assertEqual(self.client.get('/api/changes/?since=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/api/changes/?feeds=invoices,ghosts').status_code, 400)
+
+    def test_other_models_keep_fast_deletes(self):
+        for _ in range(3):
+            Tombstone.objects.create(model='invoice', object_id=1)
+        with CaptureQueriesContext(connection) as queries:
+            Tombstone.objects.all().delete()
+        self.assertEqual(len(queries), 1)
+
+
+class DashboardEventTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.subscription = self.loop.run_until_complete(self._subscribe())
+        self.addCleanup(self.subscription.close)
+        self.book = self.make_book()
+        self.customer = self.make_customer()
+
+    async def _subscribe(self):
+        return events.get_broker().subscribe()
+
+    def next_event(self):
+        frame = self.loop.run_until_complete(self.subscription.get(timeout=1)).decode()
+        name, data = frame.strip().split('\n')
+        return name.removeprefix('event: '), json.loads(data.removeprefix('data: '))
+
+    def test_one_event_per_transaction_with_new_balances(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            invoice = self.make_invoice(self.customer, self.book, quantity=2, unit_price='100.00', paid='40.00', credited='10.00')
+        name, data = self.next_event()
+        self.assertEqual(name, 'ledger')
+        [row] = data['invoices']
+        self.assertEqual((row['id'], row['balance_due'], row['customer_name']), (invoice.pk, '150.00', 'School'))
+        self.assertEqual(data['stats']['debtors_count'], 1)
+        self.assertTrue(self.subscription._queue.empty())
+
+    def test_deleted_invoice_is_reported_as_removed(self):
+        invoice = self.make_invoice(self.customer, self.book)
+        invoice_id = invoice.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            invoice.delete()
+        self.assertEqual(self.next_event()[1]['removed'], [invoice_id])
+
+    def test_stream_needs_asgi(self):
+        self.assertEqual(self.client.get('/api/dashboard-events/').status_code, 501)
+
+
+class BulkCatalogueTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.cheap = self.make_book('Cheap', price='10.00', stock=1)
+        self.dear = self.make_book('Dear', price='99.99', stock=2)
+        self.other_publisher = Publisher.objects.create(name='Elsewhere')
+        self.untouched = Book.objects.create(title='Untouched', author=self.cheap.author, publisher=self.other_publisher, price=Decimal('50.00'))
+
+    def post(self, action, payload):
+        return self.client.post(f'/api/books/{action}/', payload, format='json')
+
+    def prices(self):
+        return dict(Book.objects.values_list('title', 'price'))
+
+    def test_reprice_by_publisher_rounds_and_audits(self):
+        self.client.get(f'/api/books/{self.dear.pk}/')
+        response = self.post('bulk_reprice', {'percent': 7.5, 'publisher': self.cheap.publisher_id})
+        self.assertEqual((response.status_code, response.json()['affected']), (200, 2))
+        self.assertEqual(self.prices(), {'Cheap': Decimal('10.75'), 'Dear': Decimal('107.49'), 'Untouched': Decimal('50.00')})
+        self.assertEqual(response.json()['audit']['details']['prices'][str(self.dear.pk)], ['99.99', '107.49'])
+        self.assertEqual(self.client.get(f'/api/books/{self.dear.pk}/').json()['price'], '107.49')
+
+    def test_reprice_never_goes_below_zero_and_needs_a_filter(self):
+        self.assertEqual(self.post('bulk_reprice', {'amount': -20}).status_code, 400)
+        self.post('bulk_reprice', {'amount': -20, 'all_books': True})
+        self.assertEqual(self.prices(), {'Cheap': Decimal('0.00'), 'Dear': Decimal('79.99'), 'Untouched': Decimal('30.00')})
+
+    def test_restock_sums_repeated_lines(self):
+        lines = [{'book_id': self.cheap.pk, 'quantity': 5}, {'book_id': self.cheap.pk, 'quantity': 3}, {'book_id': self.dear.pk, 'quantity': 1}]
+        self.assertEqual(self.post('bulk_restock', {'lines': lines}).status_code, 200)
+        self.assertEqual(dict(Book.objects.values_list('title', 'quantity_in_stock'))['Cheap'], 9)
+        response = self.post('bulk_restock', {'lines': [{'book_id': 999999, 'quantity': 1}]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_create_checks_foreign_keys_up_front(self):
+        book = {'title': 'New', 'price': '5.00', 'quantity_in_stock': 3, 'author_id': self.cheap.author_id, 'publisher_id': self.other_publisher.pk}
+        response = self.post('bulk_create', {'books': [book, {**book, 'title': 'Newer'}]})
+        self.assertEqual((response.status_code, response.json()['affected']), (200, 2))
+        response = self.post('bulk_create', {'books': [{**book, 'author_id': 999999}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Book.objects.count(), 5)
+
+
+class SpreadsheetImportTests(APITestBase):
+    def upload(self, kind, text, name='upload.csv', dry_run=False):
+        url = f'/api/{kind}/import_file/' + ('?dry_run=1' if dry_run else '')
+        return self.client.post(url, {'file': SimpleUploadedFile(name, text.encode())}, format='multipart')
+
+    def test_books_create_missing_authors_and_report_bad_rows(self):
+        self.make_book()
+        response = self.upload('books', (
+            'Title,Author,Publisher,Price,Quantity in stock\n'
+            'Reader One,a. author,New Press,120.50,4\n'
+            'Reader Two,B. Writer,New Press,80,\n'
+            'Reader Three,B. Writer,New Press,,2\n'
+            'Reader Four,B. Writer,New Press,cheap,2\n'
+        ))
+        report = response.json()
+        self.assertEqual((response.status_code, report['created'], report['skipped']), (200, 2, 2))
+        self.assertEqual(report['created_references'], {'author': 1, 'publisher': 1})
+        self.assertEqual([(error['row'], list(error['errors'])) for error in report['errors']], [(4, ['price']), (5, ['price'])])
+        self.assertEqual(Book.objects.get(title='Reader Two').quantity_in_stock, 0)
+        self.assertEqual(Author.objects.count(), 2)
+
+    def test_price_column_is_required(self):
+        response = self.upload('books', 'title,author,publisher\nReader,A,B\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('price', response.json()['error'])
+
+    def test_dry_run_saves_nothing(self):
+        report = self.upload('books', 'title,author,publisher,price\nReader,A,B,1\n', dry_run=True).json()
+        self.assertEqual((report['created'], report['dry_run']), (1, True))
+        self.assertFalse(Book.objects.exists() or Author.objects.exists())
+
+    def test_customers_link_referrers_listed_later_in_the_file(self):
+        existing = self.make_customer('Existing')
+        response = self.upload('customers', (
+            'school_name,route_axis,contact_person,phone_number,address,referred_by_phone\n'
+            f'Child,North,Head,0801,Road,0802\n'
+            f'Parent,South,Head,0802,Road,{existing.phone_number}\n'
+            f'Dupe,South,Head,0802,Road,\n'
+        ))
+        report = response.json()
+        self.assertEqual((report['created'], report['skipped']), (2, 1))
+        tree = self.client.get(f'/api/customers/{existing.pk}/downline/').json()
+        self.assertEqual(tree['referred_customers'][0]['referred_customers'][0]['school_name'], 'Child')
+
+    def test_xlsx_without_openpyxl_asks_for_csv(self):
+        with mock.patch.dict('sys.modules', {'openpyxl': None}):
+            response = self.upload('books', 'not a workbook', name='catalogue.xlsx')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('CSV', response.json()['error'])
+
+
+class WriteCoordinationTests(LedgerFixtures, TransactionTestCase):
+    """Outside a test transaction, so run_write() really opens (and retries) its own."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def locked_once(self, target):
+        calls = []
+
+        def flaky(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                target(*args, **kwargs)
+                raise OperationalError('database is locked')
+            return target(*args, **kwargs)
+        return flaky, calls
+
+    def test_locked_write_is_retried_and_rolled_back_in_between(self):
+        flaky, calls = self.locked_once(lambda: Author.objects.create(name=f'Author {Author.objects.count()}'))
+        with override_settings(SQLITE_WRITE_RETRY_BASE_DELAY=0):
+            run_write(flaky)
+        self.assertEqual((len(calls), list(Author.objects.values_list('name', flat=True))), (2, ['Author 0']))
+
+    def test_import_is_retried_from_the_start_of_the_file(self):
+        flaky, calls = self.locked_once(import_file)
+        upload = SimpleUploadedFile('books.csv', b'title,author,publisher,price\nReader,A,B,1\n')
+        with mock.patch('management.views.import_file', flaky), override_settings(SQLITE_WRITE_RETRY_BASE_DELAY=0):
+            response = self.client.post('/api/books/import_file/', {'file': upload}, format='multipart')
+        self.assertEqual((response.status_code, response.json()['created']), (200, 1))
+        self.assertEqual((len(calls), Book.objects.count()), (2, 1))
+
+
+class ReconcileLedgerTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        book, customer = self.make_book(), self.make_customer()
+        self.settled = self.make_invoice(customer, book, quantity=1, unit_price='100.00', paid='100.00')
+        self.part_paid = self.make_invoice(customer, book, paid='10.00', status='PARTIALLY_PAID')
+        self.fine = self.make_invoice(customer, book)
+        for _ in range(3):
+            self.make_invoice(customer, book, quantity=1, unit_price='20.00', paid='20.00', status='PAID')
+        Invoice.objects.filter(status='PAID').update(invoice_date=date.today() - timedelta(days=400))
+        archive_settled_invoices()
+        CustomerArchiveSummary.objects.filter(customer=customer).update(total_paid=Decimal('1.00'))
+        self.customer = customer
+
+    def reconcile(self, *args):
+        out = io.StringIO()
+        call_command('reconcile_ledger', '--workers=1', '--chunk-size=2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_reports_drift_without_changing_anything(self):
+        output = self.reconcile()
+        self.assertIn('invoices: 1 drifted row(s).', output)
+        self.assertIn('customer_summaries: 1 drifted row(s).', output)
+        self.assertIn('book_summaries: 0 drifted row(s).', output)
+        self.assertEqual(Invoice.objects.get(pk=self.settled.pk).status, 'UNPAID')
+
+    def test_repair_fixes_statuses_and_summaries(self):
+        self.reconcile('--repair')
+        self.assertEqual(Invoice.objects.get(pk=self.settled.pk).status, 'PAID')
+        self.assertEqual(CustomerArchiveSummary.objects.get(customer=self.customer).total_paid, Decimal('60.00'))
+        self.assertIn('invoices: 0 drifted row(s).', self.reconcile())
+
+    def test_credit_note_alone_does_not_change_the_expected_status(self):
+        book = self.make_book(title='Reader')
+        response = self.client.post('/api/credit-notes/', {
+            'customer': self.customer.pk, 'original_invoice': self.fine.pk, 'reason': 'Damaged',
+            'items': [{'book_id': book.pk, 'quantity': 1, 'unit_price': '50.00'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('invoices: 1 drifted row(s).', self.reconcile('--repair'))
+        self.assertEqual(Invoice.objects.get(pk=self.fine.pk).status, 'UNPAID')
+        self.assertIn('invoices: 0 drifted row(s).', self.reconcile())
+
+
+class StatementTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        book, self.customer = self.make_book(), self.make_customer()
+        start = date(2025, 1, 1)
+        # Invoices of 100 on days 0, 10, ... 90, the even ones credited 10 the same day; each paid 30 five days later.
+        for number in range(10):
+            invoice = self.make_invoice(self.customer, book, quantity=1, unit_price='100.00', paid='30.00', credited='10.00' if number % 2 == 0 else None)
+            day = start + timedelta(days=10 * number)
+            Invoice.objects.filter(pk=invoice.pk).update(invoice_date=day)
+            Payment.objects.filter(invoice=invoice).update(payment_date=day + timedelta(days=5))
+            CreditNote.objects.filter(original_invoice=invoice).update(date=day)
+        Invoice.objects.filter(invoice_date__lt=date(2025, 1, 25)).update(status='PAID')
+        with mock.patch('management.archive.date') as archive_date:
+            archive_date.today.return_value = date(2026, 6, 1)
+            archive_settled_invoices()
+        self.url = f'/api/customers/{self.customer.pk}/statement/'
+
+    def test_pages_chain_into_the_full_statement(self):
+        full = self.client.get(self.url + '?page_size=500').json()
+        self.assertEqual((full['line_count'], full['next_cursor']), (25, None))
+        self.assertEqual(Decimal(str(full['closing_balance'])), Decimal('650.00'))
+        self.assertEqual(sum(line['archived'] for line in full['lines']), 8)
+
+        lines, url = [], self.url + '?page_size=4'
+        while url:
+            page = self.client.get(url).json()
+            lines += page['lines']
+            url = page['next']
+        self.assertEqual(lines, full['lines'])
+        self.assertEqual(lines[-1]['balance'], full['closing_balance'])
+        first_day = [(line['type'], Decimal(str(line['debit'])), Decimal(str(line['credit']))) for line in lines[:2]]
+        self.assertEqual(first_day, [('invoice', Decimal('100'), Decimal('0')), ('credit_note', Decimal('0'), Decimal('10'))])
+
+    def test_period_has_an_opening_balance(self):
+        period = self.client.get(self.url + '?from=2025-02-01&to=2025-02-28').json()
+        # January: 4 invoices, 2 credits and 3 payments.
+        self.assertEqual(Decimal(str(period['opening_balance'])), Decimal('290.00'))
+        self.assertEqual(
+            [(line['date'], line['type']) for line in period['lines']],
+            [('2025-02-05', 'payment'), ('2025-02-10', 'invoice'), ('2025-02-10', 'credit_note'),
+             ('2025-02-15', 'payment'), ('2025-02-20', 'invoice'), ('2025-02-25', 'payment')],
+        )
+        self.assertEqual(Decimal(str(period['closing_balance'])), Decimal(str(period['lines'][-1]['balance'])))
+
+    def test_bad_parameters(self):
+        for query in ('?from=2025-13-01', '?from=2025-03-01&to=2025-02-01', '?page_size=ten', '?page_size=0', '?cursor=bm9wZQ'):
+            self.assertEqual(self.client.get(self.url + query).status_code, 400, query)
+        for pk in ('999999', 'abc'):
+            self.assertEqual(self.client.get(f'/api/customers/{pk}/statement/').status_code, 404, pk)
+
+    def test_page_size_is_capped(self):
+        with mock.patch('management.views.customer_statement', wraps=customer_statement) as statement:
+            self.assertEqual(self.client.get(self.url + '?page_size=100000').status_code, 200)
+        self.assertEqual(statement.call_args.args[-1], MAX_PAGE_SIZE)
+
+
+class AdminChangelistTests(LedgerFixtures, TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.book = self.make_book()
+        self.customer = self.make_customer('Referred', referred_by=self.make_customer('Referrer'))
+
+    def test_changelists_do_not_query_per_row(self):
+        def add_rows():
+            invoice = self.make_invoice(self.customer, self.book, paid='10.00', credited='5.00')
+            self.make_book(title=f'Book {invoice.pk}')
+        for model in ('invoice', 'invoiceitem', 'payment', 'creditnote', 'creditnoteitem', 'customer', 'book'):
+            url = f'/admin/management/{model}/'
+            add_rows()
+            _, few = count_queries(self.client, url)
+            for _ in range(4):
+                add_rows()
+            response, many = count_queries(self.client, url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(few, many, url)
+
+
+class ReorderForecastTests(APITestBase):
+    def setUp(self):
+        super().setUp()
+        self.fast = self.make_book('Fast Seller', stock=5)
+        self.slow = self.make_book('Slow Seller', stock=500)
+        customer = self.make_customer()
+        # Two units of the fast seller a day for the last eight weeks, one of the slow one a week.
+        for days_ago in range(1, 57):
+            invoice = Invoice.objects.create(customer=customer, due_date=date.today())
+            InvoiceItem.objects.create(invoice=invoice, book=self.fast, quantity=2, unit_price=Decimal('100.00'))
+            if days_ago % 7 == 0:
+                InvoiceItem.objects.create(invoice=invoice, book=self.slow, quantity=1, unit_price=Decimal('100.00'))
+            Invoice.objects.filter(pk=invoice.pk).update(invoice_date=date.today() - timedelta(days=days_ago))
+
+    def test_suggests_the_title_about_to_run_out(self):
+        response = self.client.get('/api/books/reorders/?lead_time_days=7&cover_days=14')
+        self.assertEqual(response.status_code, 200)
+        [group] = response.json()['publishers']
+        [book] = group['books']
+        # The 28-day window ends today, so it holds the sales of 1 to 27 days ago.
+        self.assertEqual((book['id'], book['sold_last_28_days']), (self.fast.pk, 54))
+        self.assertLessEqual(book['days_of_cover'], 3)
+        # Short history, so the rate is blended down towards the long-run mean, but still well past stock.
+        self.assertGreater(book['suggested_quantity'], 2 * book['quantity_in_stock'])
+
+    def test_publisher_filter_and_bad_parameters(self):
+        other = Publisher.objects.create(name='Quiet Press')
+        self.assertEqual(self.client.get(f'/api/books/reorders/?publisher={other.pk}').json()['publishers'], [])
+        for query in ('lead_time_days=0', 'cover_days=soon', 'publisher=abc'):
+            self.assertEqual(self.client.get(f'/api/books/reorders/?{query}').status_code, 400, query)
+
+    def test_without_numpy_the_endpoint_is_not_implemented(self):
+        with mock.patch('management.forecasting.np', None):
+            response = self.client.get('/api/books/reorders/')
+        self.assertEqual(response.status_code, 501)
+        self.assertIn('numpy', response.json()['error'])
+
+
+class AnalyticsSnapshotTests(APITestBase):
+    def test_router_sends_reads_to_the_snapshot_only_while_reporting(self):
+        router = AnalyticsRouter()
+        self.assertIsNone(router.db_for_read(Invoice))
+        with reporting_reads():
+            self.assertEqual((router.db_for_read(Invoice), router.db_for_write(Invoice)), ('analytics', 'default'))
+            with reporting_reads(False):
+                self.assertIsNone(router.db_for_read(Invoice))
+        self.assertIsNone(router.db_for_read(Invoice))
+        self.assertIs(router.allow_migrate('analytics', 'management'), False)
+        self.assertIsNone(router.allow_migrate('default', 'management'))
+
+    @mock.patch('management.snapshots.refresh_in_background')
+    def test_reporting_views_read_the_snapshot_and_say_how_old_it_is(self, refresh):
+        @reporting
+        def view(request):
+            return HttpResponse(django_router.db_for_read(Invoice))
+
+        with mock.patch('management.snapshots.snapshot_supported', return_value=True), \
+                mock.patch('management.snapshots.snapshot_taken_at', return_value=time.time() - 42):
+            response = view(None)
+            self.assertEqual((response.content, response['X-Report-Source']), (b'analytics', 'snapshot'))
+            self.assertIn(response['X-Snapshot-Age'], ('42', '43'))
+            refresh.assert_not_called()
+            with override_settings(ANALYTICS_SNAPSHOT_MAX_AGE=10):
+                view(None)
+            refresh.assert_called_once()
+        response = view(None)
+        self.assertEqual((response.content, response['X-Report-Source']), (b'default', 'live'))
+
+    def test_ledger_views_stay_live(self):
+        customer = self.make_customer()
+        self.make_invoice(customer, self.make_book())
+        for url in ('/api/debtors/', f'/api/customers/{customer.pk}/statement/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertFalse(response.has_header('X-Report-Source'), url)
+        self.assertEqual(self.client.get('/api/debtors/?format=table')['X-Report-Source'], 'live')
+        self.assertEqual(self.client.get('/api/insights/')['X-Report-Source'], 'live')
@@ -8,6 +8,7 @@ from .views import (
 from .views import CreditNoteViewSet 
 from .views import DebtorsListView 
 from .views import business_insights 
+from .views import cache_stats, sync_changes, dashboard_events
 
 
 router = DefaultRouter()
@@ -22,8 +23,11 @@ router.register(r'authors', AuthorViewSet, basename='author')
 
 urlpatterns = [
     path('dashboard-stats/', dashboard_stats, name='dashboard-stats'),
+    path('dashboard-events/', dashboard_events, name='dashboard-events'),
     path('debtors/', DebtorsListView.as_view(), name='debtors-list'),
     path('insights/', business_insights, name='business-insights'),
+    path('cache-stats/', cache_stats, name='cache-stats'),
+    path('changes/', sync_changes, name='sync-changes'),
     path('', include(router.urls)),
 ]
 
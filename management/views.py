@@ -1,35 +1,138 @@
+import asyncio
+
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import api_view, action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, Sum, F, Value, DecimalField, Prefetch, OuterRef, Subquery
+from django.db.models import Q, Sum, F, Value, DecimalField, Prefetch, OuterRef, Subquery, Count, Max
 from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_date
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from decimal import Decimal, ROUND_HALF_UP
 
 from .models import (
     Customer, Book, Publisher, Invoice, InvoiceItem,
-    Payment, Author, RouteAxis, CreditNote
+    Payment, Author, RouteAxis, CreditNote, CustomerReferralPath, ArchivedInvoice, ArchivedInvoiceItem
+)
+from .cache import detail_cache
+from .catalogue import CatalogueError, create_books, reprice, restock
+from .importers import ImportFileError, import_file
+from .writes import CoordinatedWriteMixin, coordinated_write
+from .events import dashboard_counters, get_broker
+from .forecasting import (
+    DEFAULT_COVER_DAYS, DEFAULT_LEAD_TIME_DAYS, ForecastError, ForecastUnavailable, reorder_suggestions
+)
+from .payments import PaymentError, allocate_customer_payment, parse_amount
+from .renderers import TabularJSONRenderer
+from .snapshots import reporting
+from .statements import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidStatementCursor, customer_statement
+from .sync import FEEDS, InvalidSyncToken, changes_since
+from .ledger import (
+    customer_balance_annotations, invoice_balance_annotations, invoice_credited_subquery, archived_invoice_balance_annotations
 )
 from .serializers import (
     CustomerSerializer, BookSerializer, PublisherSerializer, InvoiceSerializer,
     InvoiceWriteSerializer, DebtorInvoiceSerializer, RouteAxisSerializer, AuthorSerializer,
     CustomerDetailSerializer, CustomerWriteSerializer, BookDetailSerializer, BookWriteSerializer,
-    CreditNoteWriteSerializer, PublisherDetailSerializer, AuthorDetailSerializer, RouteAxisDetailSerializer
+    CreditNoteWriteSerializer, PublisherDetailSerializer, AuthorDetailSerializer, RouteAxisDetailSerializer,
+    NestedInvoiceSerializer, BookSaleHistorySerializer, ArchivedInvoiceSerializer, CatalogueAuditSerializer,
+    ArchivedNestedInvoiceSerializer, ArchivedBookSaleHistorySerializer
 )
 from rest_framework import generics
 from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.utils.urls import replace_query_param
+from .serializers import parse_field_list
+
+class SparseQuerysetMixin:
+    """
+    Server half of ?fields= / ?expand= (see SparseFieldsetMixin): on reads,
+    reject field names the serializer does not have (400), then let it
+    rebuild the queryset's joins, prefetches and columns for just the fields
+    it will render.
+    """
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        serializer_class = self.get_serializer_class()
+        fields = parse_field_list(self.request.query_params.get('fields'))
+        expand = parse_field_list(self.request.query_params.get('expand'))
+        unknown = serializer_class.unknown_fields(fields) if fields and hasattr(serializer_class, 'unknown_fields') else []
+        if unknown:
+            raise ValidationError({'error': f"Unknown field(s): {', '.join(unknown)}."})
+        if (fields or expand) and hasattr(serializer_class, 'optimize_queryset'):
+            queryset = serializer_class.optimize_queryset(queryset, fields, expand)
+        return queryset
+
+
+class CachedRetrieveMixin:
+    """
+    Serve retrieve() from the versioned detail cache. The key covers the
+    object's version and the query string, so ?fields=/?history= variants
+    are cached separately and any write to the object or its dependent rows
+    (see management/signals.py) makes the next read a miss.
+    """
+    cache_kind = None
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        # Take the key before reading, so a write that lands mid-request
+        # leaves this payload under an already-retired version.
+        key = detail_cache.key(self.cache_kind, pk, request.GET.urlencode())
+        data = detail_cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = super().retrieve(request, *args, **kwargs)
+        detail_cache.set(key, response.data)
+        return response
+
+
+class HistoryPagination(PageNumberPagination):
+    """Paging for the full-history sub-resources behind the bounded detail previews."""
+    page_size = 25
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+def paginated_history(view, queryset, serializer_class, archived=None, date_field=None):
+    """
+    One page of `queryset`, newest first. With ?include_archived=1 and
+    `archived=(queryset, serializer_class)` the archived rows are paged in
+    with the live ones: the union of (date, id) keys of both tables is
+    paged in SQL, then each table loads only its rows on the page.
+    """
+    paginator = HistoryPagination()
+    if archived is None or not _flag_param(view.request, 'include_archived'):
+        page = paginator.paginate_queryset(queryset, view.request, view=view)
+        return paginator.get_paginated_response(serializer_class(page, many=True).data)
+
+    sources = {False: (queryset, serializer_class), True: archived}
+    keys = [
+        source.order_by().annotate(sort_date=F(date_field), is_archived=Value(flag)).values_list('sort_date', 'id', 'is_archived')
+        for flag, (source, _) in sources.items()
+    ]
+    page = paginator.paginate_queryset(keys[0].union(keys[1], all=True).order_by('-sort_date', '-id'), view.request, view=view)
+    rows = {}
+    for flag, (source, serializer) in sources.items():
+        objects = source.in_bulk([pk for _, pk, is_archived in page if bool(is_archived) == flag])
+        rows.update({(flag, obj.pk): data for obj, data in zip(objects.values(), serializer(objects.values(), many=True).data)})
+    return paginator.get_paginated_response([rows[bool(is_archived), pk] for _, pk, is_archived in page])
+
 
 # --- Primary Model ViewSets ---
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(CoordinatedWriteMixin, CachedRetrieveMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
     queryset = Customer.objects.select_related(
-        'route_axis', 'referred_by'
+        'route_axis', 'referred_by__route_axis'
     ).prefetch_related(
-        'invoice_set__items__book', 
-        'invoice_set__payment_set', 
-        'invoice_set__creditnote_set__items',
         'referred_customers'
     ).all()
+    cache_kind = 'customer'
     
     filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_fields = ['route_axis']
@@ -42,11 +145,135 @@ class CustomerViewSet(viewsets.ModelViewSet):
             return CustomerDetailSerializer
         return CustomerSerializer
 
-
-class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.select_related('author', 'publisher').prefetch_related(
-        'invoiceitem_set__invoice__customer'
-    )
+    @action(detail=True, methods=['post'])
+    @coordinated_write
+    def record_payment(self, request, pk=None):
+        """Take one lump-sum payment and allocate it oldest-due-first across the customer's open invoices."""
+        pk = _int_pk(pk)
+        if pk is None or not Customer.objects.filter(pk=pk).exists():
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+        if not request.data.get('amount'):
+            return Response({'error': 'Amount is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            result = allocate_customer_payment(pk, parse_amount(request.data['amount']), request.data.get('notes', ''))
+        except PaymentError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], parser_classes=[MultiPartParser, FormParser])
+    @coordinated_write
+    def import_file(self, request):
+        """Import schools from an uploaded CSV/XLSX `file` (see management/importers.py). ?dry_run=1 validates only."""
+        return _import_response(request, 'customers')
+
+    @action(detail=True, methods=['get'])
+    def invoices(self, request, pk=None):
+        """
+        Every invoice of a customer, newest first, paginated, with SQL-computed
+        balances. ?include_archived=1 pages the archived invoices in as well.
+        """
+        pk = _int_pk(pk)
+        if pk is None or not Customer.objects.filter(pk=pk).exists():
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+        queryset = Invoice.objects.filter(customer_id=pk).annotate(**invoice_balance_annotations()).order_by('-invoice_date', '-id')
+        archived = ArchivedInvoice.objects.filter(customer_id=pk).annotate(**archived_invoice_balance_annotations())
+        return paginated_history(
+            self, queryset, NestedInvoiceSerializer, archived=(archived, ArchivedNestedInvoiceSerializer), date_field='invoice_date'
+        )
+
+    @action(detail=True, methods=['get'])
+    def statement(self, request, pk=None):
+        """
+        Account statement: ?from=&to= (YYYY-MM-DD, optional), ?page_size= (1 to
+        MAX_PAGE_SIZE; larger values are capped), ?cursor= from the previous
+        page's next_cursor. Live and archived invoices, credit notes and
+        payments in date order with a running balance, built in one query (see
+        management/statements.py). Reads the live database: a statement is
+        proof of what the customer owes now.
+        """
+        pk = _int_pk(pk)
+        customer = Customer.objects.filter(pk=pk).values('id', 'school_name').first() if pk is not None else None
+        if customer is None:
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            start, end = _parse_date_param(request, 'from'), _parse_date_param(request, 'to')
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = request.query_params.get('page_size') or str(DEFAULT_PAGE_SIZE)
+        if not page_size.isdigit() or int(page_size) < 1:
+            return Response({'error': 'page_size must be a positive integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = min(int(page_size), MAX_PAGE_SIZE)
+        if start and end and start > end:
+            return Response({'error': "'from' must not be after 'to'."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            result = customer_statement(
+                customer['id'], start, end, request.query_params.get('cursor'), page_size
+            )
+        except InvalidStatementCursor as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        result['school_name'] = customer['school_name']
+        if result['next_cursor']:
+            result['next'] = request.build_absolute_uri(
+                replace_query_param(request.get_full_path(), 'cursor', result['next_cursor'])
+            )
+        else:
+            result['next'] = None
+        return Response(result)
+
+    @action(detail=True, methods=['get'])
+    def downline(self, request, pk=None):
+        """The full referral tree below a customer, read from the closure table in one query."""
+        pk = _int_pk(pk)
+        if pk is None:
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+        paths = CustomerReferralPath.objects.filter(ancestor_id=pk)
+        max_depth = request.query_params.get('max_depth')
+        if max_depth:
+            if not max_depth.isdigit():
+                return Response({'error': 'max_depth must be a non-negative integer.'}, status=status.HTTP_400_BAD_REQUEST)
+            paths = paths.filter(depth__lte=int(max_depth))
+        rows = paths.order_by('depth', 'descendant__school_name').values(
+            'depth', 'descendant_id', 'descendant__school_name', 'descendant__referred_by_id'
+        )
+
+        nodes = {}
+        for row in rows:
+            node = {'id': row['descendant_id'], 'school_name': row['descendant__school_name'], 'depth': row['depth'], 'referred_customers': []}
+            nodes[node['id']] = node
+            parent = nodes.get(row['descendant__referred_by_id'])
+            if row['depth'] and parent is not None:
+                parent['referred_customers'].append(node)
+        if pk not in nodes:
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(nodes[pk])
+
+    @action(detail=True, methods=['get'])
+    def referral_stats(self, request, pk=None):
+        """Position in the referral network plus revenue and debt aggregated over the whole downline."""
+        pk = _int_pk(pk)
+        if pk is None:
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+        upline = CustomerReferralPath.objects.filter(descendant_id=pk).aggregate(paths=Count('id'), depth=Max('depth'))
+        if not upline['paths']:
+            return Response({'error': 'Customer not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Per-school balances get their own names: an aggregate may not reuse the name of the annotation it sums.
+        balances = customer_balance_annotations('descendant_id')
+        downline = CustomerReferralPath.objects.filter(ancestor_id=pk, depth__gt=0).annotate(
+            **{f'school_{name}': expression for name, expression in balances.items()}
+        ).aggregate(
+            downline_size=Count('id'),
+            downline_depth=Max('depth'),
+            **{name: Coalesce(Sum(f'school_{name}'), Value(Decimal('0.00'))) for name in balances},
+        )
+        downline['downline_depth'] = downline['downline_depth'] or 0
+        downline['net_revenue'] = downline['total_invoiced'] - downline['total_credited']
+        return Response({'id': pk, 'depth': upline['depth'], **downline})
+
+
+class BookViewSet(CoordinatedWriteMixin, CachedRetrieveMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
+    queryset = Book.objects.select_related('author', 'publisher', 'archive_summary')
+    cache_kind = 'book'
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, OrderingFilter]
     filterset_fields = ['author', 'publisher']
     search_fields = ['title']
@@ -59,8 +286,82 @@ class BookViewSet(viewsets.ModelViewSet):
             return BookWriteSerializer
         return BookSerializer
 
+    @action(detail=True, methods=['get'])
+    def sales(self, request, pk=None):
+        """Every sale of a title, newest first, paginated. ?include_archived=1 pages archived sales in as well."""
+        pk = _int_pk(pk)
+        if pk is None or not Book.objects.filter(pk=pk).exists():
+            return Response({'error': 'Book not found.'}, status=status.HTTP_404_NOT_FOUND)
+        queryset = InvoiceItem.objects.filter(book_id=pk).select_related('invoice__customer').order_by('-invoice__invoice_date', '-id')
+        archived = ArchivedInvoiceItem.objects.filter(book_id=pk).select_related('invoice__customer')
+        return paginated_history(
+            self, queryset, BookSaleHistorySerializer, archived=(archived, ArchivedBookSaleHistorySerializer), date_field='invoice__invoice_date'
+        )
+
+    @action(detail=False, methods=['post'], parser_classes=[MultiPartParser, FormParser])
+    @coordinated_write
+    def import_file(self, request):
+        """Import a catalogue from an uploaded CSV/XLSX `file` (see management/importers.py). ?dry_run=1 validates only."""
+        return _import_response(request, 'books')
+
+    @action(detail=False, methods=['get'])
+    def reorders(self, request):
+        """
+        Reorder suggestions by publisher from the sales forecast (see
+        management/forecasting.py): ?lead_time_days=14&cover_days=30&publisher=<id>.
+        """
+        params = request.query_params
+        try:
+            result = reorder_suggestions(
+                lead_time_days=params.get('lead_time_days') or DEFAULT_LEAD_TIME_DAYS,
+                cover_days=params.get('cover_days') or DEFAULT_COVER_DAYS,
+                publisher=params.get('publisher') or None,
+            )
+        except ForecastUnavailable as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        except ForecastError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+    # --- Bulk catalogue operations (management/catalogue.py) ---
 
-class PublisherViewSet(viewsets.ModelViewSet):
+    def _audit_response(self, operation, *args, **kwargs):
+        try:
+            audit = operation(*args, **kwargs)
+        except CatalogueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'affected': audit.affected, 'audit': CatalogueAuditSerializer(audit).data}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    @coordinated_write
+    def bulk_reprice(self, request):
+        """
+        Apply a price list change in one UPDATE:
+        {"percent": 7.5 | "amount": -200, "publisher": id(s), "author": id(s), "book_ids": [...], "all_books": false}
+        """
+        data = request.data
+        return self._audit_response(
+            reprice, percent=data.get('percent'), amount=data.get('amount'), publisher=data.get('publisher'),
+            author=data.get('author'), book_ids=data.get('book_ids'), all_books=str(data.get('all_books', '')).lower() in ('1', 'true', 'yes'),
+            notes=data.get('notes', ''),
+        )
+
+    @action(detail=False, methods=['post'])
+    @coordinated_write
+    def bulk_restock(self, request):
+        """Add stock to many books: {"lines": [{"book_id": 1, "quantity": 20}, ...]}"""
+        return self._audit_response(restock, request.data.get('lines'), notes=request.data.get('notes', ''))
+
+    @action(detail=False, methods=['post'])
+    @coordinated_write
+    def bulk_create(self, request):
+        """Create many books at once: {"books": [<BookWriteSerializer payload>, ...]}"""
+        serializer = BookWriteSerializer(data=request.data.get('books') or [], many=True)
+        serializer.is_valid(raise_exception=True)
+        return self._audit_response(create_books, serializer.validated_data, notes=request.data.get('notes', ''))
+
+
+class PublisherViewSet(CoordinatedWriteMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
     queryset = Publisher.objects.prefetch_related('book_set__author')
     serializer_class = PublisherSerializer
     filter_backends = [filters.SearchFilter]
@@ -73,7 +374,7 @@ class PublisherViewSet(viewsets.ModelViewSet):
         return PublisherSerializer
 
 
-class AuthorViewSet(viewsets.ModelViewSet):
+class AuthorViewSet(CoordinatedWriteMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
     queryset = Author.objects.prefetch_related('book_set__publisher')
     serializer_class = AuthorSerializer
     filter_backends = [filters.SearchFilter]
@@ -86,8 +387,10 @@ class AuthorViewSet(viewsets.ModelViewSet):
         return AuthorSerializer
 
 
-class RouteAxisViewSet(viewsets.ModelViewSet):
-    queryset = RouteAxis.objects.prefetch_related('customer_set')
+class RouteAxisViewSet(CoordinatedWriteMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
+    queryset = RouteAxis.objects.prefetch_related(
+        Prefetch('customer_set', queryset=Customer.objects.select_related('route_axis', 'referred_by__route_axis'))
+    )
     serializer_class = RouteAxisSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ['name']
@@ -98,28 +401,93 @@ class RouteAxisViewSet(viewsets.ModelViewSet):
             return RouteAxisDetailSerializer
         return RouteAxisSerializer
 
-class CreditNoteViewSet(viewsets.ModelViewSet):
-    queryset = CreditNote.objects.all()
+    @action(detail=True, methods=['get'])
+    def operations(self, request, pk=None):
+        """
+        Delivery planning for one route: the consolidated pick list of books
+        invoiced to its schools between ?from= and ?to= (invoice dates,
+        inclusive), and every school's outstanding balance. Three queries
+        regardless of how many schools are on the route.
+        """
+        pk = _int_pk(pk)
+        route = RouteAxis.objects.filter(pk=pk).values('id', 'name').first() if pk is not None else None
+        if route is None:
+            return Response({'error': 'Route axis not found.'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            date_from = _parse_date_param(request, 'from')
+            date_to = _parse_date_param(request, 'to')
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        items = InvoiceItem.objects.filter(invoice__customer__route_axis_id=pk)
+        if date_from:
+            items = items.filter(invoice__invoice_date__gte=date_from)
+        if date_to:
+            items = items.filter(invoice__invoice_date__lte=date_to)
+        pick_list = list(
+            items.values('book_id', 'book__title').annotate(
+                quantity=Sum('quantity'), schools=Count('invoice__customer', distinct=True)
+            ).order_by('book__title')
+        )
+
+        schools = list(
+            Customer.objects.filter(route_axis_id=pk).annotate(
+                **customer_balance_annotations()
+            ).order_by('school_name').values('id', 'school_name', 'address', 'contact_person', 'phone_number', 'outstanding_balance')
+        )
+
+        return Response({
+            'id': route['id'],
+            'name': route['name'],
+            'from': date_from,
+            'to': date_to,
+            'pick_list': [
+                {'book_id': row['book_id'], 'title': row['book__title'], 'quantity': row['quantity'], 'schools': row['schools']}
+                for row in pick_list
+            ],
+            'total_units': sum(row['quantity'] for row in pick_list),
+            'schools': schools,
+            'total_outstanding': sum((row['outstanding_balance'] for row in schools), Decimal('0.00')),
+        })
+
+class CreditNoteViewSet(CoordinatedWriteMixin, viewsets.ModelViewSet):
+    queryset = CreditNote.objects.prefetch_related('items')
     serializer_class = CreditNoteWriteSerializer
 
 
-class InvoiceViewSet(viewsets.ModelViewSet):
+class InvoiceViewSet(CoordinatedWriteMixin, CachedRetrieveMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
     serializer_class = InvoiceSerializer
+    cache_kind = 'invoice'
     filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_fields = ['status', 'customer']
     search_fields = ['id', 'customer__school_name', 'items__book__title']
 
     def get_queryset(self):
         return Invoice.objects.select_related('customer').prefetch_related(
-            'items__book', 'payment_set', 'creditnote_set__items'
-        ).order_by('-invoice_date')
+            'items__book', 'payment_set'
+        ).annotate(credit_applied=invoice_credited_subquery()).order_by('-invoice_date')
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
             return InvoiceWriteSerializer
         return self.serializer_class
 
+    def list(self, request, *args, **kwargs):
+        """Live invoices only, unless ?include_archived=1 asks for archived ones too (listed after the live ones)."""
+        response = super().list(request, *args, **kwargs)
+        if not _flag_param(request, 'include_archived'):
+            return response
+        archived = ArchivedInvoice.objects.select_related('customer').prefetch_related(
+            'items__book', 'payments'
+        ).annotate(**archived_invoice_balance_annotations()).order_by('-invoice_date')
+        for backend in self.filter_backends:
+            archived = backend().filter_queryset(request, archived, self)
+        serializer = ArchivedInvoiceSerializer(archived, many=True, context=self.get_serializer_context())
+        response.data = [*response.data, *serializer.data]
+        return response
+
     @action(detail=True, methods=['post'])
+    @coordinated_write
     def record_payment(self, request, pk=None):
         invoice = self.get_object()
         amount_str = request.data.get('amount')
@@ -165,22 +533,101 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         return Response(final_serializer.data, status=status.HTTP_200_OK)
 
 
+def _int_pk(pk):
+    """The URL's pk as an int, or None when it cannot be one (the caller answers 404)."""
+    return int(pk) if str(pk).isdigit() else None
+
+
+def _flag_param(request, name):
+    return request.query_params.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _import_response(request, kind):
+    upload = request.FILES.get('file')
+    if upload is None:
+        return Response({'error': "Upload the spreadsheet as 'file'."}, status=status.HTTP_400_BAD_REQUEST)
+    # From the top: run_write() repeats the whole call if the database was locked.
+    upload.file.seek(0)
+    try:
+        report = import_file(kind, upload.file, upload.name, dry_run=_flag_param(request, 'dry_run'))
+    except ImportFileError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(report, status=status.HTTP_200_OK)
+
+
+def _parse_date_param(request, name):
+    """Read an optional YYYY-MM-DD query parameter, raising ValueError if it is malformed."""
+    raw = request.query_params.get(name)
+    if not raw:
+        return None
+    parsed = parse_date(raw)
+    if parsed is None:
+        raise ValueError(f"'{name}' must be a date in YYYY-MM-DD format.")
+    return parsed
+
+
 # --- Dashboard and Debtors API Views ---
 
 @api_view(['GET'])
 def dashboard_stats(request):
-    customer_count = Customer.objects.count()
-    book_count = Book.objects.count()
-    debtors_count = Invoice.objects.filter(Q(status='UNPAID') | Q(status='PARTIALLY_PAID')).count()
-    stats = {
-        'customer_count': customer_count,
-        'book_count': book_count,
-        'debtors_count': debtors_count,
-    }
-    return Response(stats)
+    return Response(dashboard_counters())
+
+
+EVENT_STREAM_HEARTBEAT_SECONDS = 20
 
 
-class DebtorsListView(generics.ListAPIView):
+async def dashboard_events(request):
+    """
+    Server-Sent Events stream of dashboard deltas (see management/events.py).
+    Needs the ASGI entry point: under WSGI a stream would pin a worker thread
+    for as long as the tab stays open.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Live updates need the ASGI server (core/asgi.py).'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+    subscription = get_broker().subscribe()
+
+    async def stream():
+        try:
+            yield b'retry: 5000\n\n'
+            while True:
+                try:
+                    yield await subscription.get(timeout=EVENT_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment lines keep proxies from closing an idle stream.
+                    yield b': keep-alive\n\n'
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@api_view(['GET'])
+def cache_stats(request):
+    """Hit/miss counters of the detail response cache (this process only)."""
+    return Response(detail_cache.stats())
+
+
+@api_view(['GET'])
+def sync_changes(request):
+    """
+    Change feed for client-side replicas: ?since=<token from the previous
+    call>&feeds=customers,books,invoices. Returns a new token plus, per feed,
+    the rows updated and the ids deleted since `since`.
+    """
+    feeds = parse_field_list(request.query_params.get('feeds')) or list(FEEDS)
+    unknown = [name for name in feeds if name not in FEEDS]
+    if unknown:
+        return Response({'error': f"Unknown feed(s): {', '.join(unknown)}. Available: {', '.join(FEEDS)}."}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        return Response(changes_since(request.query_params.get('since'), feeds))
+    except InvalidSyncToken as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class DebtorsListView(SparseQuerysetMixin, generics.ListAPIView):
     """
     A dedicated, sortable list view for all debtors.
     Now with annotation to allow sorting by calculated fields.
@@ -210,10 +657,18 @@ class DebtorsListView(generics.ListAPIView):
         ).annotate(
             balance_due=F('total_amount') - F('amount_paid') - F('credit_applied')
         ).select_related('customer').prefetch_related('items', 'payment_set')
+
+    def list(self, request, *args, **kwargs):
+        # The on-screen list stays live so it agrees with the dashboard's event
+        # deltas; only the ?format=table export reads the analytics snapshot.
+        if request.accepted_renderer.format == TabularJSONRenderer.format:
+            return reporting(super().list)(request, *args, **kwargs)
+        return super().list(request, *args, **kwargs)
         
         
 
 @api_view(['GET'])
+@reporting
 def business_insights(request):
     """
     An API view that calculates and returns key business intelligence metrics.
@@ -234,7 +689,7 @@ def business_insights(request):
 
     # --- Top 3 Best Customers (Lifetime Value) ---
     best_customers_query = Customer.objects.annotate(
-        total_spent=Coalesce(Sum('invoice__payment__amount'), Value(Decimal('0.00')))
+        total_spent=Coalesce(Sum('invoice__payment__amount'), Value(Decimal('0.00'))) + Coalesce(F('archive_summary__total_paid'), Value(Decimal('0.00')))
     ).order_by('-total_spent')[:3]
 
     best_customers = [
@@ -243,7 +698,7 @@ def business_insights(request):
 
     # --- Top 3 Best-Selling Books (by Revenue) ---
     best_selling_books_query = Book.objects.annotate(
-        total_revenue=Coalesce(Sum(F('invoiceitem__quantity') * F('invoiceitem__unit_price')), Value(Decimal('0.00')))
+        total_revenue=Coalesce(Sum(F('invoiceitem__quantity') * F('invoiceitem__unit_price')), Value(Decimal('0.00'))) + Coalesce(F('archive_summary__revenue'), Value(Decimal('0.00')))
     ).order_by('-total_revenue')[:3]
 
     best_selling_books = [
@@ -0,0 +1,172 @@
+"""
+Write coordination for SQLite.
+
+SQLite allows one writer at a time. A DEFERRED transaction that reads first
+and writes later can deadlock with another one doing the same; SQLite then
+fails one of them with "database is locked" straight away, whatever the busy
+timeout. So every mutating API call goes through run_write():
+
+* the work runs in one short transaction, opened with BEGIN IMMEDIATE (see
+  `transaction_mode` in settings.DATABASES): the write lock is taken up front
+  and waiting writers queue inside SQLite's busy handler;
+* if the lock still cannot be had, the whole call is retried a bounded number
+  of times with exponential backoff and jitter.
+
+With SQLITE_GROUP_COMMIT enabled, writes are instead handed to one writer
+thread per process. It runs whatever has queued up within a few milliseconds
+in a single transaction, each write in its own savepoint, and commits once.
+Under load that turns many fsyncs into one.
+"""
+import random
+import threading
+import time
+from concurrent.futures import Future
+from functools import wraps
+from queue import Empty, SimpleQueue
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection, transaction
+
+LOCKED_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+
+
+def is_lock_error(exc):
+    return isinstance(exc, OperationalError) and any(message in str(exc).lower() for message in LOCKED_MESSAGES)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def with_retry(func, *args, **kwargs):
+    """Run func(*args, **kwargs) in one transaction, retrying it while the database is locked."""
+    if connection.in_atomic_block:
+        # Already inside someone else's transaction: a retry could not undo their work.
+        return func(*args, **kwargs)
+    attempts = _setting('SQLITE_WRITE_RETRY_ATTEMPTS', 5)
+    delay = _setting('SQLITE_WRITE_RETRY_BASE_DELAY', 0.05)
+    max_delay = _setting('SQLITE_WRITE_RETRY_MAX_DELAY', 1.0)
+    for attempt in range(1, attempts + 1):
+        try:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        except OperationalError as exc:
+            if attempt == attempts or not is_lock_error(exc):
+                raise
+        time.sleep(random.uniform(0, min(max_delay, delay * 2 ** (attempt - 1))))
+
+
+class GroupCommitQueue:
+    """A single writer thread that commits queued writes together."""
+
+    def __init__(self, max_batch=32, window=0.002):
+        self.max_batch = max_batch
+        self.window = window
+        self._jobs = SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write and block until its group has committed; returns its result or raises its error."""
+        if threading.current_thread() is self._thread:
+            # A write issued from inside another queued write is part of that write.
+            return func(*args, **kwargs)
+        self._start()
+        future = Future()
+        self._jobs.put((future, func, args, kwargs))
+        return future.result()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sqlite-group-commit', daemon=True)
+                self._thread.start()
+
+    def _take_group(self):
+        group = [self._jobs.get()]
+        deadline = time.monotonic() + self.window
+        while len(group) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                group.append(self._jobs.get(timeout=remaining) if remaining > 0 else self._jobs.get_nowait())
+            except Empty:
+                break
+        return group
+
+    def _run(self):
+        while True:
+            group = self._take_group()
+            close_old_connections()
+            try:
+                outcomes = with_retry(self._commit_group, group)
+            except Exception as exc:
+                # The group transaction itself failed (lock never obtained, commit error): fail every write in it.
+                for future, *_ in group:
+                    future.set_exception(exc)
+                continue
+            for (future, *_), (ok, value) in zip(group, outcomes):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _commit_group(self, group):
+        outcomes = []
+        for _, func, args, kwargs in group:
+            try:
+                with transaction.atomic():
+                    outcomes.append((True, func(*args, **kwargs)))
+            except Exception as exc:
+                if is_lock_error(exc):
+                    raise
+                outcomes.append((False, exc))
+        return outcomes
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def group_commit_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = GroupCommitQueue(
+                    max_batch=_setting('SQLITE_GROUP_COMMIT_MAX_BATCH', 32),
+                    window=_setting('SQLITE_GROUP_COMMIT_WINDOW', 0.002),
+                )
+    return _queue
+
+
+def run_write(func, *args, **kwargs):
+    """Run one mutating operation the way settings ask for: retried, queued, or (with coordination off) as-is."""
+    if not _setting('SQLITE_WRITE_COORDINATION', True):
+        return func(*args, **kwargs)
+    if _setting('SQLITE_GROUP_COMMIT', False) and not connection.in_atomic_block:
+        return group_commit_queue().submit(func, *args, **kwargs)
+    return with_retry(func, *args, **kwargs)
+
+
+def coordinated_write(func):
+    """Decorator for ViewSet actions that write."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_write(func, *args, **kwargs)
+    return wrapper
+
+
+class CoordinatedWriteMixin:
+    """Routes a ViewSet's create/update/destroy through run_write()."""
+
+    @coordinated_write
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
+    @coordinated_write
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    @coordinated_write
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)